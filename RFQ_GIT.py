@@ -1,35 +1,641 @@
 import sys
 import os
 import shutil
+import copy
+import io
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import threading
+import hashlib
+import pickle
+import json
+import zipfile
+import zlib
 import xml.etree.ElementTree as ET
+from lxml import etree
 from docx import Document
-from docx.oxml.ns import qn
+from docx.oxml.ns import nsmap, qn
+from docx.oxml.parser import parse_xml
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from docx.opc.packuri import CONTENT_TYPES_URI, PACKAGE_URI
+from docx.opc.pkgwriter import _ContentTypesItem
 from docxcompose.composer import Composer
-import pandas as pd
+from docxcompose.properties import CustomProperties
 import re
-from collections import defaultdict
+from bisect import bisect_right
+from functools import lru_cache
+from collections import defaultdict, OrderedDict
 from datetime import datetime
+import time
+import logging
+import contextlib
+import contextvars
+from collections import deque
 from docx.enum.section import WD_SECTION
 from docx.shared import Pt
+from docx.table import Table, _Cell, _Row
+from docx.text.paragraph import Paragraph
+
+# --- Sökvägar ---
+
+BASE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend_data")
+TEMPLATE_FILE = "startmall lägga till rader.docx"
+TRANSLATION_FILE = "database_RFQ.xlsx"
+HISSIDA_FILE = "hissida.docx"
+AVSLUT_FILE = "avslutningsmall dynamisk ta bort delar.docx"
+RESULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "output", "cache")
+
+# --- Loggning ---
+
+# Nivåer: INFO för förlopp, DEBUG för detaljer per tabell/rad och TRACE för
+# varje enskilt värde (av som standard). Meddelanden formateras först när de skrivs.
+TRACE = 5
+logging.addLevelName(TRACE, "TRACE")
+logger = logging.getLogger("rfq")
+
+def configure_logging(level=None):
+    """Loggning till stderr; nivån tas annars från RFQ_LOG_LEVEL (standard INFO)."""
+    level = level or os.environ.get("RFQ_LOG_LEVEL", "INFO")
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    logger.setLevel(level.upper() if isinstance(level, str) else level)
+
+# --- Mätning per steg ---
+
+_active_report = contextvars.ContextVar("rfq_stage_report", default=None)
+
+def _current_rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+class StageReport:
+    """
+    Väggtid och antal anrop per steg för en generering, plus minnestoppen
+    (RSS, avläst vid varje stegslut). Steg kan vara nästlade, t.ex. ingår
+    fill_placeholders i hissida och avslut.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.info = {}
+        self.total_seconds = 0.0
+        self.rss_start_bytes = None
+        self.peak_rss_bytes = None
+
+    @contextlib.contextmanager
+    def activate(self):
+        """Gör rapporten aktiv för stage() i den här tråden/kontexten."""
+        token = _active_report.set(self)
+        self.rss_start_bytes = self.peak_rss_bytes = _current_rss_bytes()
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.total_seconds += time.perf_counter() - start
+            _active_report.reset(token)
+
+    def add(self, name, seconds):
+        entry = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0})
+        entry["seconds"] += seconds
+        entry["calls"] += 1
+        rss = _current_rss_bytes()
+        if rss is not None and (self.peak_rss_bytes is None or rss > self.peak_rss_bytes):
+            self.peak_rss_bytes = rss
+
+    def as_dict(self):
+        return {
+            "total_seconds": self.total_seconds,
+            "stages": {name: dict(entry) for name, entry in self.stages.items()},
+            "rss_start_bytes": self.rss_start_bytes,
+            "peak_rss_bytes": self.peak_rss_bytes,
+            **self.info,
+        }
+
+    def server_timing(self):
+        """Värde för HTTP-huvudet Server-Timing (millisekunder per steg)."""
+        parts = [f"{name};dur={entry['seconds'] * 1000:.1f}" for name, entry in self.stages.items()]
+        parts.append(f"total;dur={self.total_seconds * 1000:.1f}")
+        return ", ".join(parts)
+
+@contextlib.contextmanager
+def stage(name):
+    """Mäter ett steg i den aktiva StageReport; gör ingenting utan aktiv rapport."""
+    report = _active_report.get()
+    if report is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        report.add(name, time.perf_counter() - start)
+
+class StageMetrics:
+    """Sammanställning av StageReport över många genereringar (för app.py)."""
+
+    def __init__(self, window=1000):
+        self.generations = 0
+        self.failures = 0
+        self._samples = defaultdict(lambda: deque(maxlen=window))
+        self._lock = threading.Lock()
+
+    def add(self, report: StageReport = None, failed=False):
+        with self._lock:
+            self.generations += 1
+            self.failures += failed
+            if report is None:
+                return
+            self._samples["total"].append(report.total_seconds)
+            for name, entry in report.stages.items():
+                self._samples[name].append(entry["seconds"])
+
+    def snapshot(self):
+        with self._lock:
+            stages = {}
+            for name, samples in self._samples.items():
+                ordered = sorted(samples)
+                stages[name] = {
+                    "samples": len(ordered),
+                    "mean_seconds": sum(ordered) / len(ordered),
+                    "p50_seconds": ordered[len(ordered) // 2],
+                    "p95_seconds": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                    "max_seconds": ordered[-1],
+                }
+            return {"generations": self.generations, "failures": self.failures, "stages": stages}
+
+# --- Fel ---
+
+class RFQError(Exception):
+    """Genereringen misslyckades. `stage` anger vilket steg som gick fel."""
+
+    def __init__(self, message, stage="generate"):
+        super().__init__(message)
+        self.stage = stage
+
+class RFQInputError(RFQError):
+    """Indata (XML-filen) kunde inte tolkas."""
+
+    def __init__(self, message):
+        super().__init__(message, stage="xml")
+
+# --- Mallcache ---
+
+_active_templates = contextvars.ContextVar("rfq_template_cache", default=None)
+
+class TemplateCache:
+    """
+    Håller varje .docx-mall parsad i minnet och lämnar ut djupkopior per
+    användning. Mallen läses om automatiskt om filen har ändrats (mtime/storlek).
+    Media-delarnas bytes delas mellan kopiorna eftersom de aldrig ändras.
+
+    `prepare` är en funktion som körs en gång på den inlästa mallen (t.ex.
+    prepare_page_template), så att kopiorna redan är städade. Med lazy=True
+    läses mallar först när de behövs (preload gör ingenting) och första
+    användningen får det nyinlästa dokumentet utan kopia – för engångskörningar
+    där de flesta mallar bara används en gång. load_template och
+    renderingsplanerna använder den aktiva cachen (activate), annars den
+    gemensamma `template_cache`.
+    """
+
+    def __init__(self, lazy=False):
+        self.lazy = lazy
+        self._entries = {}
+        self._plans = {}
+        self._placeholders = {}
+        self._lent = set()
+        self._lock = threading.Lock()
+        self.stats = defaultdict(lambda: {"loads": 0, "copies": 0, "load_time": 0.0, "copy_time": 0.0})
+
+    @staticmethod
+    def _signature(path):
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+
+    def _load(self, path, prepare):
+        start = time.perf_counter()
+        doc = Document(path)
+        if prepare is not None:
+            prepare(doc)
+        self.stats[path]["loads"] += 1
+        self.stats[path]["load_time"] += time.perf_counter() - start
+        return doc
+
+    def _pristine(self, path, prepare):
+        signature = self._signature(path)
+        entry = self._entries.get((path, prepare))
+        if entry is None or entry[0] != signature:
+            entry = (signature, self._load(path, prepare))
+            self._entries[(path, prepare)] = entry
+        return entry[1]
+
+    def preload(self, *paths, prepare=None):
+        if self.lazy:
+            return
+        with self._lock:
+            for path in paths:
+                self._pristine(path, prepare)
+
+    def get(self, path, prepare=None):
+        with self._lock:
+            if self.lazy and (path, prepare) not in self._lent:
+                self._lent.add((path, prepare))
+                return self._load(path, prepare)
+            pristine = self._pristine(path, prepare)
+            start = time.perf_counter()
+            doc = copy.deepcopy(pristine)
+            self.stats[path]["copies"] += 1
+            self.stats[path]["copy_time"] += time.perf_counter() - start
+        return doc
+
+    def plan(self, path, prepare, compile):
+        """
+        Renderingsplan byggd av `compile` på en kopia av mallen, en gång per
+        mallversion. None om mallen inte går att kompilera (TemplatePlanError).
+        """
+        with self._lock:
+            signature = self._signature(path)
+            entry = self._plans.get((path, prepare, compile))
+            if entry is None or entry[0] != signature:
+                try:
+                    plan = compile(copy.deepcopy(self._pristine(path, prepare)))
+                except TemplatePlanError as e:
+                    logger.warning("Ingen renderingsplan för %s: %s", os.path.basename(path), e)
+                    plan = None
+                entry = (signature, plan)
+                self._plans[(path, prepare, compile)] = entry
+            return entry[1]
+
+    def placeholders(self, path, prepare=None):
+        """Mallens platshållare (template_placeholders), en gång per mallversion och utan kopia."""
+        with self._lock:
+            signature = self._signature(path)
+            entry = self._placeholders.get((path, prepare))
+            if entry is None or entry[0] != signature:
+                entry = (signature, template_placeholders(self._pristine(path, prepare)))
+                self._placeholders[(path, prepare)] = entry
+            return entry[1]
+
+    @contextlib.contextmanager
+    def activate(self):
+        """Gör cachen aktiv för load_template och renderingsplaner i den här tråden/kontexten."""
+        token = _active_templates.set(self)
+        try:
+            yield self
+        finally:
+            _active_templates.reset(token)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._plans.clear()
+            self._placeholders.clear()
+            self._lent.clear()
+
+template_cache = TemplateCache()
+
+def active_template_cache():
+    return _active_templates.get() or template_cache
+
+def load_template(path, prepare=None):
+    with stage("load_template"):
+        return active_template_cache().get(path, prepare)
+
+# --- Översättningstabell ---
+
+def load_translation_dict(translation_file):
+    import pandas as pd  # Bara när tabellen måste kompileras om
+
+    df = pd.read_excel(translation_file)
+    return {
+        normalize_key(str(row["english"]).strip()): str(row["generic_swedish"]).strip()
+        for _, row in df.iterrows()
+        if pd.notna(row["english"]) and pd.notna(row["generic_swedish"])
+    }
+
+class TranslationStore:
+    """
+    Kompilerad översättningstabell. database_RFQ.xlsx konverteras en gång till
+    en pickle-fil bredvid xlsx-filen (nycklad på normalize_key(english)) och
+    byggs bara om när xlsx-filens innehåll ändras. En process som redan läst
+    tabellen märker ändringar först vid refresh(), som generatorn anropar per
+    generering innan cachenycklarna räknas ut.
+    """
+
+    def __init__(self, xlsx_path, compiled_path=None):
+        self.xlsx_path = xlsx_path
+        self.compiled_path = compiled_path or os.path.splitext(xlsx_path)[0] + ".translations.pickle"
+        self._table = None
+        self._loaded = None  # (mtime/storlek, sha256) för filen som _table lästes från
+        self._lock = threading.Lock()
+
+    def _signature(self):
+        st = os.stat(self.xlsx_path)
+        return (st.st_mtime_ns, st.st_size)
+
+    def _xlsx_hash(self):
+        with open(self.xlsx_path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def _read_compiled(self, xlsx_hash):
+        try:
+            with open(self.compiled_path, "rb") as f:
+                stored_hash, table = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            return None
+        return table if stored_hash == xlsx_hash else None
+
+    def _write_compiled(self, xlsx_hash, table):
+        tmp_path = f"{self.compiled_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                pickle.dump((xlsx_hash, table), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.compiled_path)
+        except OSError as e:
+            # Skrivskyddad katalog: tabellen används ändå från minnet
+            logger.warning("Kunde inte spara kompilerad översättningstabell: %s", e)
+
+    def _load_locked(self):
+        if self._table is None:
+            signature = self._signature()
+            xlsx_hash = self._xlsx_hash()
+            table = self._read_compiled(xlsx_hash)
+            if table is None:
+                table = load_translation_dict(self.xlsx_path)
+                self._write_compiled(xlsx_hash, table)
+            self._table = table
+            self._loaded = (signature, xlsx_hash)
+        return self._table, self._loaded[1]
+
+    def _reload_locked(self):
+        self._table = None
+        loaded = self._load_locked()
+        _translate.cache_clear()  # memoiserade översättningar kommer från den gamla tabellen
+        return loaded
+
+    def load(self):
+        """Tabellen och innehållshashen för den, från samma inläsning."""
+        with self._lock:
+            return self._load_locked()
+
+    def refresh(self):
+        """
+        Läser om tabellen om xlsx-filen har ändrats sedan den lästes in och
+        returnerar innehållshashen för tabellen som används. Cachenycklar ska
+        bygga på den, inte på filen, så att de alltid stämmer med översättningarna.
+        Jämförelsen och omläsningen sker under låset, så samtidiga anrop ser
+        samma tabell och hash.
+        """
+        with self._lock:
+            _, xlsx_hash = self._load_locked()
+            current = self._signature()
+            if current != self._loaded[0]:
+                if self._xlsx_hash() == xlsx_hash:
+                    self._loaded = (current, xlsx_hash)  # Bara mtime ändrad
+                else:
+                    logger.info("Översättningstabellen har ändrats; läser in den igen.")
+                    _, xlsx_hash = self._reload_locked()
+            return xlsx_hash
+
+    def reload(self):
+        with self._lock:
+            return self._reload_locked()
+
+    def get(self, norm_key, default=None):
+        table = self._table if self._table is not None else self.load()[0]
+        return table.get(norm_key, default)
+
+translation_store = TranslationStore(os.path.join(BASE_PATH, TRANSLATION_FILE))
+
+def set_translation_file(xlsx_path):
+    global translation_store
+    if os.path.abspath(xlsx_path) != os.path.abspath(translation_store.xlsx_path):
+        translation_store = TranslationStore(xlsx_path)
+    return translation_store
+
+# --- Resultatcache ---
+
+_file_hashes = {}
+
+def file_content_hash(path):
+    """sha256 av filens innehåll; räknas bara om när mtime/storlek ändras."""
+    st = os.stat(path)
+    signature = (st.st_mtime_ns, st.st_size)
+    cached = _file_hashes.get(path)
+    if cached is None or cached[0] != signature:
+        with open(path, "rb") as f:
+            cached = (signature, hashlib.sha256(f.read()).hexdigest())
+        _file_hashes[path] = cached
+    return cached[1]
+
+class ResultCache:
+    """
+    Innehållsadresserad cache för färdiga dokument på disk. Nyckeln är en hash
+    av extraherade data plus innehållshashar för mallar, översättningstabell och
+    generatorkoden. Storleken begränsas (LRU på filernas mtime, som uppdateras
+    vid träff).
+    """
+
+    def __init__(self, directory=RESULT_CACHE_DIR, max_bytes=200 * 2**20, max_entries=500):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(elevators, global_data, group_defs, dependencies):
+        """`dependencies` är innehållshashar för allt utöver indata som påverkar dokumentet."""
+        # datum sätts vid genereringen och ska inte ge cachemissar; dagens datum
+        # ingår i stället så att ett cachat dokument aldrig får ett gammalt datum
+        data = {
+            "elevators": elevators,
+            "global_data": {k: v for k, v in global_data.items() if k != "datum"},
+            "group_defs": group_defs,
+            "date": datetime.today().strftime("%Y-%m-%d"),
+            "dependencies": list(dependencies),
+        }
+        encoded = json.dumps(data, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        return hashlib.sha256(encoded).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.docx")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Kunde inte spara i resultatcachen: %s", e)
+            return
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".docx"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        entries.sort(reverse=True)
+
+        total = 0
+        for index, (_, size, name) in enumerate(entries):
+            total += size
+            if index >= self.max_entries or total > self.max_bytes:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                    with self._lock:
+                        self.evictions += 1
+                except OSError:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+def has_docproperty_fields(doc):
+    """Om dokumentet har DOCPROPERTY-fält som Composer.append löser upp (och därmed ändrar)."""
+    properties = CustomProperties(doc)
+    return bool(properties.keys()) and bool(properties.find_docprops_in_document())
+
+class FragmentCache:
+    """
+    Minnescache för renderade delar av dokumentet (huvudmall, hissidor och
+    avslut), nyckade på sina indata. Vid en reviderad XML byggs bara de delar
+    om vars indata ändrats; resten hämtas härifrån och sätts ihop på nytt.
+    """
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(kind, *inputs):
+        encoded = json.dumps([kind, *inputs], sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+        return hashlib.sha256(encoded).hexdigest()
+
+    def get(self, key, copy_doc=False):
+        """
+        Returnerar den cachade delen eller None. Composer läser bara de dokument
+        som läggs till, så de kan delas; huvudmallen ändras av Composer och
+        hämtas därför med copy_doc=True.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            doc, shared = entry
+            if copy_doc or not shared:
+                return copy.deepcopy(doc)
+            return doc
+
+    def put(self, key, doc, copy_doc=False):
+        if self.max_entries <= 0:
+            return
+        # Composer löser upp DOCPROPERTY-fält i källdokumentet; sådana delar
+        # kan inte delas mellan genereringar
+        shared = not copy_doc and not has_docproperty_fields(doc)
+        stored = doc if shared else copy.deepcopy(doc)
+        with self._lock:
+            self._entries[key] = (stored, shared)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
 
 # --- Funktioner ---
 
+# Samma nycklar och värden återkommer för varje hiss, hissida och avslutsregel;
+# normalisering, översättning och versalisering memoiseras därför (begränsat)
+KEY_SEPARATORS = re.compile(r"[ /,\[\];:()\-]")
+REPEATED_UNDERSCORES = re.compile(r"_+")
+CODE_PREFIX = re.compile(r"^[A-ZÅÄÖ]{2,}([- ]|$)")
+
+@lru_cache(maxsize=8192)
 def normalize_key(text):
     text = text.lower().strip()
-    text = re.sub(r"[ /,\[\];:()\-]", "_", text)
-    text = re.sub(r"_+", "_", text)
+    text = KEY_SEPARATORS.sub("_", text)
+    text = REPEATED_UNDERSCORES.sub("_", text)
     return text.strip("_")
 
 def translate_value_if_possible(value, key=None):
     if key == "numpag":
         return "{{numpag}}"  # Låt stå kvar tills vi byter ut den i generate_final_doc
-    norm_key = normalize_key(value)
     if key == "counterweight_with_safety_gear":
         return "Ja" if value.strip() == "1" else "Nej"
-    result = translation_dict.get(norm_key, value)
-    print(f" Placeholder: '{key}' - '{value}' - '{result}'")
+    return _translate(value, key, translation_store)
+
+@lru_cache(maxsize=4096)
+def _translate(value, key, store):
+    result = store.get(normalize_key(value), value)
+    logger.log(TRACE, "Placeholder: '%s' - '%s' - '%s'", key, value, result)
     return result
 
+def memo_stats():
+    """Träffstatistik för de memoiserade funktionerna (för profilering)."""
+    stats = {}
+    for name, function in (("normalize_key", normalize_key), ("translate", _translate), ("capitalize", _capitalize)):
+        info = function.cache_info()
+        lookups = info.hits + info.misses
+        stats[name] = {
+            "hits": info.hits,
+            "misses": info.misses,
+            "hit_rate": info.hits / lookups if lookups else 0.0,
+            "size": info.currsize,
+            "maxsize": info.maxsize,
+        }
+    return stats
+
+def clear_memo_caches():
+    normalize_key.cache_clear()
+    _translate.cache_clear()
+    _capitalize.cache_clear()
+
 def is_valid_elevator(data):
     return "general_information" in data and data["general_information"].strip()
 
@@ -37,63 +643,104 @@ def extract_machineroom_type(desc):
     match = re.search(r"[PGB]([WTSU])", desc.upper())
     return match.group(1) if match else ""
 
-def extract_multiple_elevators(xml_path):
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
-    ns = {'ns': root.tag.split('}')[0].strip('{')} if '}' in root.tag else {}
-
-    global_data = {}
-    grouped_elevators = []
-    manual_elevators = []
-    current_elevator = {}
-    last_general_info = None
-    manual_hiss_skapad = False
-    grouped_buffer = []
-    current_group_mode = False
-    expected_group_columns = None
-
-    for table in root.findall('.//Table', ns):
-        rows = table.findall('TR', ns)
-        if not rows:
+def iter_tables(xml_source):
+    """
+    Strömmar XML-filen med iterparse och ger varje <Table> (i dokumentordning)
+    som en lista av rader, där varje rad är en lista av TH/TD-celler.
+    Färdigbehandlade element rensas direkt så att hela trädet aldrig ligger i minnet.
+    """
+    stack = []
+    table_depth = 0
+    for event, elem in ET.iterparse(xml_source, events=("start", "end")):
+        if event == "start":
+            stack.append(elem)
+            if elem.tag == "Table":
+                table_depth += 1
             continue
 
-        header_cells = [c for c in rows[0] if c.tag in ('TH', 'TD')]
-        num_columns = len(header_cells)
+        stack.pop()
+        if elem.tag == "Table":
+            table_depth -= 1
+            if table_depth == 0:
+                # Nästlade tabeller behandlas i samma ordning som findall('.//Table')
+                for table in elem.iter("Table"):
+                    rows = table.findall("TR")
+                    if rows:
+                        yield [[c for c in row if c.tag in ("TH", "TD")] for row in rows]
+        if table_depth == 0:
+            elem.clear()
+            if stack:
+                stack[-1].remove(elem)
+
+class ElevatorExtractor:
+    """
+    Tolkar tabellerna i en XML-export en i taget: hissar (grupperade tabeller
+    med fler än två kolumner eller singeltabeller), globala data och
+    gruppdefinitioner. Används av extract_project för att läsa filen i ett pass.
+    """
+
+    def __init__(self):
+        self.global_data = {}
+        self.group_defs = []
+        self.grouped_elevators = []
+        self.manual_elevators = []
+        self.current_elevator = {}
+        self.last_general_info = None
+        self.manual_hiss_skapad = False
+        self.grouped_buffer = []
+        self.current_group_mode = False
+        self.expected_group_columns = None
+
+    def feed(self, rows):
+        header_cells = rows[0]
         header_texts = [c.text.strip() if c.text else '' for c in header_cells]
-        print(f" Tabell med {num_columns} kolumner: {header_texts}")
+        self._collect_group_def(header_texts)
+        self._collect_elevators(rows, header_texts)
+
+    def _collect_group_def(self, header_texts):
+        if not header_texts:
+            return
+        if normalize_key(header_texts[0]) == "general_information" and len(header_texts) > 1:
+            names = [normalize_key(cell) for cell in header_texts[1:]]
+            self.group_defs.append({
+                "hissbeteckning": ", ".join(name.split("_")[0].upper() for name in names if name),
+                "antal_hissar": str(len(names))
+            })
+
+    def _collect_elevators(self, rows, header_texts):
+        num_columns = len(header_texts)
+        logger.debug("Tabell med %d kolumner: %s", num_columns, header_texts)
 
         treat_as_grouped = num_columns > 2
 
         if treat_as_grouped:
-            if not current_group_mode:
-                expected_group_columns = num_columns
+            if not self.current_group_mode:
+                self.expected_group_columns = num_columns
                 num_hissar = num_columns - 1
-                grouped_buffer = [{} for _ in range(num_hissar)]
-                current_group_mode = True
-            elif num_columns != expected_group_columns:
-                for e in grouped_buffer:
+                self.grouped_buffer = [{} for _ in range(num_hissar)]
+                self.current_group_mode = True
+            elif num_columns != self.expected_group_columns:
+                for e in self.grouped_buffer:
                     if is_valid_elevator(e):
-                        grouped_elevators.append(e)
-                grouped_buffer = []
-                current_group_mode = False
-                expected_group_columns = None
-                continue
+                        self.grouped_elevators.append(e)
+                self.grouped_buffer = []
+                self.current_group_mode = False
+                self.expected_group_columns = None
+                return
 
-            for row in rows:
-                cells = [c for c in row if c.tag in ('TH', 'TD')]
+            for cells in rows:
                 if len(cells) >= num_columns:
                     key = normalize_key((cells[0].text or '').strip())
                     if not key:
                         continue
                     for i in range(1, num_columns):
                         value = cells[i].text.strip() if cells[i].text else ""
-                        grouped_buffer[i - 1][key] = value
-                        grouped_buffer[i - 1]["group_id"] = f"group_{len(grouped_elevators) // (num_columns - 1) + 1}"
+                        self.grouped_buffer[i - 1][key] = value
+                        self.grouped_buffer[i - 1]["group_id"] = f"group_{len(self.grouped_elevators) // (num_columns - 1) + 1}"
 
         elif num_columns in (1, 2):
             temp_data = {}
-            for row in rows:
-                cells = [c for c in row if c.tag in ('TH', 'TD')]
+            for cells in rows:
                 if len(cells) == 1:
                     key = normalize_key((cells[0].text or '').strip())
                     if key:
@@ -106,99 +753,137 @@ def extract_multiple_elevators(xml_path):
 
             general_info = temp_data.get("general_information")
             if general_info:
-                if general_info != last_general_info:
-                    if is_valid_elevator(current_elevator):
-                        manual_elevators.append(current_elevator)
-                    print(f" Startar ny singelhiss: {general_info}")
-                    current_elevator = temp_data
-                    last_general_info = general_info
-                    manual_hiss_skapad = True
+                if general_info != self.last_general_info:
+                    if is_valid_elevator(self.current_elevator):
+                        self.manual_elevators.append(self.current_elevator)
+                    logger.debug("Startar ny singelhiss: %s", general_info)
+                    self.current_elevator = temp_data
+                    self.last_general_info = general_info
+                    self.manual_hiss_skapad = True
                 else:
-                    current_elevator.update(temp_data)
-            elif last_general_info:
-                current_elevator.update(temp_data)
+                    self.current_elevator.update(temp_data)
+            elif self.last_general_info:
+                self.current_elevator.update(temp_data)
             else:
-                global_data.update(temp_data)
+                self.global_data.update(temp_data)
+
+    def finish(self):
+        if self.current_group_mode:
+            for e in self.grouped_buffer:
+                if is_valid_elevator(e):
+                    self.grouped_elevators.append(e)
 
-    if current_group_mode:
-        for e in grouped_buffer:
-            if is_valid_elevator(e):
-                grouped_elevators.append(e)
+        if is_valid_elevator(self.current_elevator) and self.manual_hiss_skapad:
+            self.manual_elevators.append(self.current_elevator)
 
-    if is_valid_elevator(current_elevator) and manual_hiss_skapad:
-        manual_elevators.append(current_elevator)
+        elevators = self.grouped_elevators + self.manual_elevators
 
-    elevators = grouped_elevators + manual_elevators
+        logger.info("%d hissar hittade i XML", len(elevators))
+        if logger.isEnabledFor(TRACE):
+            for idx, e in enumerate(elevators, 1):
+                logger.log(TRACE, "Hiss %d: %s", idx, e)
+            logger.log(TRACE, "Globala data: %s", self.global_data)
 
-    print(f"\n{len(elevators)} hissar hittade i XML")
-    for idx, e in enumerate(elevators, 1):
-        print(f"\n--- HISS {idx} ---")
-        for k, v in e.items():
-            print(f"{k}: {v}")
+        return elevators, self.global_data, self.group_defs
 
-    print("\n--- GLOBAL DATA ---")
-    for k, v in global_data.items():
-        print(f"{k}: {v}")
+def extract_project(xml_source):
+    """Läser hissar, globala data och gruppdefinitioner i ett enda pass över XML-filen."""
+    extractor = ElevatorExtractor()
+    for rows in iter_tables(xml_source):
+        extractor.feed(rows)
+    return extractor.finish()
 
+def extract_multiple_elevators(xml_path):
+    elevators, global_data, _ = extract_project(xml_path)
     return elevators, global_data
 
 def extract_elevator_groups_from_xml(xml_path):
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
-    ns = {'ns': root.tag.split('}')[0].strip('{')} if '}' in root.tag else {}
-
-    groups = []
-    for table in root.findall('.//Table', ns):
-        rows = table.findall('TR', ns)
-        if not rows:
-            continue
-        header_cells = [c.text.strip() if c.text else "" for c in rows[0] if c.tag in ('TH', 'TD')]
-        if not header_cells:
-            continue
-        if normalize_key(header_cells[0]) == "general_information" and len(header_cells) > 1:
-            names = [normalize_key(cell) for cell in header_cells[1:]]
-            group = {
-                "hissbeteckning": ", ".join(name.split("_")[0].upper() for name in names if name),
-                "antal_hissar": str(len(names))
-            }
-            groups.append(group)
-    return groups
-
-def group_elevators_by_spec(elevators):
-    key_fields = [
-        "range_of_use", "rated_load_q_kg", "rated_speed_v_m_s", "number_of_floors",
-        "car_entrance_type", "door_type", "car_shell_width_bb_mm", "car_shell_depth_dd_mm",
-        "car_clear_intern_height_ch_mm", "shaft_width_ww_mm", "shaft_depth_wd_mm",
-        "min_shaft_pit_depth_ph_mm", "shaft_headroom_height_sh_mm",
-        "fire_class_country", "counterweight_with_safety_gear", "control_system"
-    ]
-
-    groups = defaultdict(list)
-    for e in elevators:
-        spec_key = tuple((k, e.get(k, "")) for k in key_fields)
-        groups[spec_key].append(e)
+    return extract_project(xml_path)[2]
+
+class ElevatorTable:
+    """
+    Kolumnvis hisstabell: en internerad värdelista per fält och hissetiketter
+    (t.ex. "A1") beräknade en gång. group_by indexerar raderna per värdetupel
+    och sparar resultatet, så att hissidor, avslutsregler och sammanslagningar
+    delar samma grupperingar i stället för att gå igenom hissarna var för sig.
+    """
+
+    def __init__(self, elevators):
+        self.elevators = elevators
+        self.labels = []
+        for e in elevators:
+            words = e.get("general_information", "").split()
+            self.labels.append(words[0].upper() if words else "")
+        self._columns = {}
+        self._groups = {}
+
+    def __len__(self):
+        return len(self.elevators)
+
+    def column(self, field, strip=False):
+        """Alla hissars värde för `field` ("" om det saknas), valfritt utan blanksteg."""
+        column = self._columns.get((field, strip))
+        if column is None:
+            values = (e.get(field, "") for e in self.elevators)
+            column = [sys.intern(v.strip() if strip else v) for v in values]
+            self._columns[(field, strip)] = column
+        return column
+
+    def group_by(self, fields, strip=False):
+        """{värdetupel: [radindex]} i den ordning grupperna först förekommer."""
+        fields = tuple(fields)
+        groups = self._groups.get((fields, strip))
+        if groups is None:
+            groups = {}
+            columns = [self.column(field, strip) for field in fields]
+            for row, values in enumerate(zip(*columns)):
+                rows = groups.get(values)
+                if rows is None:
+                    groups[values] = [row]
+                else:
+                    rows.append(row)
+            self._groups[(fields, strip)] = groups
+        return groups
+
+    def group_labels(self, rows):
+        return [self.labels[row] for row in rows if self.labels[row]]
+
+SPEC_KEY_FIELDS = (
+    "range_of_use", "rated_load_q_kg", "rated_speed_v_m_s", "number_of_floors",
+    "car_entrance_type", "door_type", "car_shell_width_bb_mm", "car_shell_depth_dd_mm",
+    "car_clear_intern_height_ch_mm", "shaft_width_ww_mm", "shaft_depth_wd_mm",
+    "min_shaft_pit_depth_ph_mm", "shaft_headroom_height_sh_mm",
+    "fire_class_country", "counterweight_with_safety_gear", "control_system"
+)
+
+def group_elevators_by_spec(elevators, table: ElevatorTable = None):
+    table = table or ElevatorTable(elevators)
 
     grouped = []
-    for group in groups.values():
-        base = group[0].copy()
-        base["antal_hissar"] = str(len(group))
-        base["hissbeteckning"] = ", ".join(e.get("general_information", "").split()[0].upper() for e in group if e.get("general_information"))
+    for rows in table.group_by(SPEC_KEY_FIELDS).values():
+        base = elevators[rows[0]].copy()
+        base["antal_hissar"] = str(len(rows))
+        base["hissbeteckning"] = ", ".join(table.group_labels(rows))
         desc = base.get("network_description", "")
         mr_type = extract_machineroom_type(desc)
         if mr_type:
-            base["machineroom_type"] = mr_type + "2" if len(group) > 1 else mr_type
+            base["machineroom_type"] = mr_type + "2" if len(rows) > 1 else mr_type
         grouped.append(base)
 
     return grouped
 
 def adjust_translation_by_context(paragraph_text: str, placeholder: str, translated: str) -> str:
     """Justera versalisering beroende på meningens position, men skydda koder och förkortningar."""
-    try:
-        before = paragraph_text.split(placeholder)[0].strip()
-        starts_sentence = not before or before.endswith((". ", ": ", "? ", "! ", "\n"))
+    position = paragraph_text.find(placeholder)
+    before = (paragraph_text if position < 0 else paragraph_text[:position]).strip()
+    starts_sentence = not before or before.endswith((". ", ": ", "? ", "! ", "\n"))
+    return _capitalize(translated, starts_sentence)
 
+@lru_cache(maxsize=4096)
+def _capitalize(translated, starts_sentence):
+    try:
         # Skydda om översättningen börjar med t.ex. LED-, AISI 441, HR64, KES800 etc
-        if re.match(r"^[A-ZÅÄÖ]{2,}([- ]|$)", translated):  # t.ex. LED- eller AISI 
+        if CODE_PREFIX.match(translated):  # t.ex. LED- eller AISI 
             return translated
 
         # Skydda hisskoder som A1, A4 osv
@@ -214,111 +899,306 @@ def adjust_translation_by_context(paragraph_text: str, placeholder: str, transla
     except Exception:
         return translated
 
-def fill_placeholders_in_doc(doc, data, suppress_keys: list = None):
-    import re
+PLACEHOLDER_PATTERN = re.compile(r"\{\{(.*?)\}\}")
+W_P, W_TBL, W_TR, W_TC, W_T = qn("w:p"), qn("w:tbl"), qn("w:tr"), qn("w:tc"), qn("w:t")
+W_SECTPR, W_HEADER_REF, W_FOOTER_REF = qn("w:sectPr"), qn("w:headerReference"), qn("w:footerReference")
+V_IMAGEDATA = "{urn:schemas-microsoft-com:vml}imagedata"
+
+def _is_vmerge_continuation(tc):
+    # python-docx läser sådana celler via cellen ovanför (se _Row.cells)
+    return tc.vMerge == "continue"
+
+def _document_position(element):
+    position = []
+    parent = element.getparent()
+    while parent is not None:
+        position.append(parent.index(element))
+        element, parent = parent, parent.getparent()
+    return position[::-1]
+
+class PlaceholderIndex:
+    """
+    Index över var {{nyckel}}-platshållare finns i ett dokuments brödtext.
+    Byggs med ett enda varv över trädet och följer samma struktur som
+    python-docx (stycken och tabeller direkt i body, celler, nästlade tabeller;
+    vMerge-fortsättningsceller hoppas över). Funktionerna som lägger till eller
+    tar bort rader håller indexet uppdaterat, så varje ifyllnad blir en uppslagning.
+    """
+
+    builds = 0  # Antal fulla genomgångar av dokumentträd, för profilering
+
+    def __init__(self, doc):
+        self.doc = doc
+        self._paragraphs = defaultdict(dict)  # "{{nyckel}}" -> {w:p: None}
+        self._keys_by_paragraph = {}
+        self._index_container(doc.element.body)
+        PlaceholderIndex.builds += 1
+
+    def _index_container(self, container):
+        for child in container.iterchildren(W_P, W_TBL):
+            if child.tag == W_P:
+                self._index_paragraph(child)
+            else:
+                for tr in child.iterchildren(W_TR):
+                    self.add_row(tr)
+
+    def _index_paragraph(self, p):
+        # Snabb förkontroll på rå w:t-text innan den dyrare p.text byggs
+        if "{" not in "".join(p.itertext(W_T)):
+            return
+        text = p.text
+        if "{{" not in text:
+            return
+        keys = {m.group(0) for m in PLACEHOLDER_PATTERN.finditer(text)}
+        if keys:
+            self._keys_by_paragraph[p] = keys
+            for key in keys:
+                self._paragraphs[key][p] = None
+
+    def _discard_paragraph(self, p):
+        for key in self._keys_by_paragraph.pop(p, ()):
+            self._paragraphs[key].pop(p, None)
+
+    def add_row(self, tr):
+        for tc in tr.iterchildren(W_TC):
+            if not _is_vmerge_continuation(tc):
+                self._index_container(tc)
+
+    def remove_row(self, tr):
+        for p in tr.iter(W_P):
+            self._discard_paragraph(p)
+
+    def refresh(self, p):
+        self._discard_paragraph(p)
+        self._index_paragraph(p)
+
+    def placeholders(self):
+        """Platshållarna som finns kvar i brödtexten, i den ordning de indexerades."""
+        return [key for key, paragraphs in self._paragraphs.items() if paragraphs]
+
+    def paragraphs(self, placeholder=None):
+        if placeholder is None:
+            return list(self._keys_by_paragraph)
+        return list(self._paragraphs.get(placeholder, ()))
+
+    def first_cell(self, placeholder):
+        """Första cellen (i dokumentordning) vars text innehåller platshållaren, som (tbl, tr, tc)."""
+        cells = [p.getparent() for p in self.paragraphs(placeholder) if p.getparent().tag == W_TC]
+        if not cells:
+            return None
+        tc = min(cells, key=_document_position)
+        tr = tc.getparent()
+        return tr.getparent(), tr, tc
+
+    def tables(self, placeholders):
+        """Alla tabeller (innersta nivån) med en cell som innehåller någon av platshållarna."""
+        tables = {}
+        for placeholder in placeholders:
+            for p in self.paragraphs(placeholder):
+                tc = p.getparent()
+                if tc.tag == W_TC:
+                    tables[tc.getparent().getparent()] = None
+        return sorted(tables, key=_document_position)
+
+def _table_proxy(doc, tbl):
+    return Table(tbl, doc._body)
+
+def replace_placeholders_in_runs(paragraph, replacements_for):
+    """
+    Ersätter {{...}} i ett stycke utan att bygga om det: platshållarna hittas
+    på run-offset i en genomläsning och bara de runs som berörs skrivs om, så
+    att formateringen i övriga runs behålls. Ersättningen får formateringen
+    från den run där platshållaren börjar. `replacements_for(full_text, matches)`
+    ger ersättningstexten för varje träff. Returnerar antal ersatta platshållare.
+    """
+    runs = paragraph.runs
+    texts = [run.text for run in runs]
+    full_text = "".join(texts)
+    matches = list(PLACEHOLDER_PATTERN.finditer(full_text))
+    if not matches:
+        return 0
+
+    for k, text in _splice_run_texts(texts, matches, replacements_for(full_text, matches)).items():
+        runs[k].text = text
+    return len(matches)
+
+def _splice_run_texts(texts, matches, values):
+    """Nya texter {runindex: text} för de runs som platshållarna (träffar i den sammanslagna texten) berör."""
+    starts = []
+    offset = 0
+    for text in texts:
+        starts.append(offset)
+        offset += len(text)
+
+    texts = list(texts)
+    changed = set()
+    # Bakifrån, så att offseten för tidigare träffar fortfarande stämmer
+    for match, value in reversed(list(zip(matches, values))):
+        first = bisect_right(starts, match.start()) - 1
+        last = bisect_right(starts, match.end() - 1) - 1
+        head = texts[first][:match.start() - starts[first]]
+        tail = texts[last][match.end() - starts[last]:]
+        if first == last:
+            texts[first] = head + value + tail
+        else:
+            texts[first] = head + value
+            for k in range(first + 1, last):
+                texts[k] = ""
+            texts[last] = tail
+        changed.update(range(first, last + 1))
+    return {k: texts[k] for k in sorted(changed)}
+
+def _may_contain_placeholder(p):
+    return "{{" in "".join(p.itertext(W_T))
+
+def fill_placeholders_in_doc(doc, data, suppress_keys: list = None, index: PlaceholderIndex = None):
+    with stage("fill_placeholders"):
+        _fill_placeholders(doc, data, suppress_keys, index)
+
+def _fill_placeholders(doc, data, suppress_keys, index):
+    replacements_for = _placeholder_replacements(data, suppress_keys)
+
+    def process_runs(paragraph):
+        replace_placeholders_in_runs(paragraph, replacements_for)
+
+    if index is None:
+        index = PlaceholderIndex(doc)
+    for p in index.paragraphs():
+        process_runs(Paragraph(p, doc._body))
+        index.refresh(p)
+
+    _fill_header_placeholders(doc, process_runs)
+
+def _placeholder_replacements(data, suppress_keys=None):
+    """`replacements_for(full_text, matches)` för replace_placeholders_in_runs, med värden ur `data`."""
     normalized_data = {normalize_key(k): v for k, v in data.items()}
-    pattern = r"\{\{(.*?)\}\}"
-    filled_keys = set(normalized_data.keys())
-    print("✅ Ifyllda nycklar:", filled_keys)
+    if logger.isEnabledFor(TRACE):
+        logger.log(TRACE, "Ifyllda nycklar: %s", sorted(normalized_data))
 
     if suppress_keys is None:
         suppress_keys = []
     suppress_keys = set(normalize_key(k) for k in suppress_keys)
 
-    def process_runs(paragraph):
-        full_text = "".join(run.text for run in paragraph.runs)
-        matches = re.findall(pattern, full_text)
-        if not matches:
-            return
+    def replacements_for(full_text, matches):
+        # Platshållarna ersätts i tur och ordning; versaliseringen avgörs av
+        # texten före platshållaren efter tidigare ersättningar
+        values = {}
         for match in matches:
-            norm_key = normalize_key(match)
-            raw_value = normalized_data.get(norm_key, "fyll i manuellt")
+            placeholder = match.group(0)
+            if placeholder in values:
+                continue
+            norm_key = normalize_key(match.group(1))
             if norm_key in suppress_keys:
-                full_text = full_text.replace(f"{{{{{match}}}}}", "")
+                value = ""
             else:
+                raw_value = normalized_data.get(norm_key, "fyll i manuellt")
                 translated = translate_value_if_possible(raw_value, key=norm_key)
-                adjusted = adjust_translation_by_context(full_text, f"{{{{{match}}}}}", translated)
-                full_text = full_text.replace(f"{{{{{match}}}}}", adjusted)
-        # Töm alla runs
-        for run in paragraph.runs:
-            run.text = ""
-        # Skriv tillbaka som en run
-        if paragraph.runs:
-            paragraph.runs[0].text = full_text
-        else:
-            paragraph.add_run(full_text)
+                value = adjust_translation_by_context(full_text, placeholder, translated)
+            full_text = full_text.replace(placeholder, value)
+            values[placeholder] = value
+        return [values[match.group(0)] for match in matches]
 
+    return replacements_for
 
-    def process_all_paragraphs_in_tables(tables):
-        for table in tables:
-            for row in table.rows:
-                for cell in row.cells:
-                    for para in cell.paragraphs:
-                        process_runs(para)
-                    process_all_paragraphs_in_tables(cell.tables)
-
-    for para in doc.paragraphs:
-        process_runs(para)
-    process_all_paragraphs_in_tables(doc.tables)
-
+def _fill_header_placeholders(doc, process_runs):
     for section in doc.sections:
         header = section.header
         for para in header.paragraphs:
-            process_runs(para)
+            if _may_contain_placeholder(para._p):
+                process_runs(para)
         for table in header.tables:
             for row in table.rows:
                 for cell in row.cells:
                     for para in cell.paragraphs:
-                        process_runs(para)
+                        if _may_contain_placeholder(para._p):
+                            process_runs(para)
 
-def fill_group_headings_dynamic(doc, group_headings):
-    pattern = "{{section_heading}}"
+def template_placeholders(doc):
+    """
+    Alla {{nyckel}}-platshållare som fill_placeholders_in_doc skulle gå igenom
+    (brödtext och sidhuvud), i dokumentordning. Värdet är True om platshållaren
+    bara står i rader som försvinner med OPTIONAL_ROW_PLACEHOLDERS.
+    """
+    index = PlaceholderIndex(doc)
+    optional_keys = {normalize_key(k) for k in OPTIONAL_ROW_PLACEHOLDERS}
+    optional_paragraphs = {p for row, _ in _rows_with_placeholders(doc, optional_keys, index) for p in row._tr.iter(W_P)}
+    found = {}
 
-    def process_table(table):
-        for row in list(table.rows):
-            for cell in row.cells:
-                if pattern in cell.text:
-                    template_row = row
-                    table._tbl.remove(row._tr)
-                    for heading in group_headings:
-                        new_row = table.add_row()
-                        for i, cell in enumerate(row.cells):
-                            new_cell = new_row.cells[i]
-                            text = cell.text.replace(pattern, heading)
-                            new_cell.text = text
-                    return True  # Avsluta efter att vi har ersatt
-                for nested_table in cell.tables:
-                    if process_table(nested_table):
-                        return True
-        return False
-
-    for table in doc.tables:
-        if process_table(table):
-            break  # Klar efter första ersättningen
+    def collect(paragraph, optional=False):
+        for m in PLACEHOLDER_PATTERN.finditer(paragraph.text):
+            found[m.group(0)] = found.get(m.group(0), True) and optional
 
-def fill_dynamic_text_rows(doc: Document, elevators: list, key, placeholder: str,
-                           singular_template: str, grouped_template: str,
-                           passive_template: str = None):
-    from collections import defaultdict
+    for p in index.paragraphs():
+        collect(p, p in optional_paragraphs)
+    _fill_header_placeholders(doc, collect)
+    return found
 
-    groups = defaultdict(list)
+def fill_group_headings_dynamic(doc, group_headings, index: PlaceholderIndex = None):
+    pattern = "{{section_heading}}"
 
-    for e in elevators:
-        label = e.get("general_information", "").strip().split()[0].upper()
+    if index is None:
+        index = PlaceholderIndex(doc)
+    found = index.first_cell(pattern)
+    if found is None:
+        return
+    tbl, tr, _ = found
+    table = _table_proxy(doc, tbl)
+    row = _Row(tr, table)
+
+    table._tbl.remove(row._tr)
+    index.remove_row(tr)
+    for heading in group_headings:
+        new_row = table.add_row()
+        for i, cell in enumerate(row.cells):
+            new_cell = new_row.cells[i]
+            text = cell.text.replace(pattern, heading)
+            new_cell.text = text
+        index.add_row(new_row._tr)
+
+def group_elevators_for_rules(elevators: list, rules: list, table: ElevatorTable = None):
+    """
+    Grupperar etiketterna för alla regler via ElevatorTable, så att regler med
+    samma nyckel delar index. Ger per regel antingen {värde: [etiketter]}
+    (None = saknar värde) eller, för regler med value_filter,
+    {"labels": [...], "value": senast matchade värde}.
+    """
+    table = table or ElevatorTable(elevators)
+    results = []
+
+    for rule in rules:
+        key = rule["key"]
+        if "value_filter" in rule:
+            matched = {"labels": [], "value": None}
+            value_filter = rule["value_filter"]
+            for label, value in zip(table.labels, table.column(key, strip=True)):
+                if value_filter(value):
+                    matched["labels"].append(label)
+                    matched["value"] = value
+            results.append(matched)
+            continue
 
-        if isinstance(key, tuple):  # Flera nycklar (t.ex. handrail_type och handrail_material)
-            values = tuple(e.get(k, "").strip() for k in key)
+        # Flera nycklar (t.ex. handrail_type och handrail_material) ger tupler som värde
+        fields = key if isinstance(key, tuple) else (key,)
+        groups = {}
+        missing_rows = []
+        for values, rows in table.group_by(fields, strip=True).items():
             if all(values):
-                groups[values].append(label)
-            else:
-                groups[None].append(label)
-        else:
-            value = e.get(key, "").strip()
-            if value:
-                groups[value].append(label)
+                groups[values if isinstance(key, tuple) else values[0]] = [table.labels[row] for row in rows]
             else:
-                groups[None].append(label)
-
+                if not missing_rows:
+                    groups[None] = None  # platsen i ordningen: första hissen utan värde
+                missing_rows.extend(rows)
+        if missing_rows:
+            groups[None] = [table.labels[row] for row in sorted(missing_rows)]
+        results.append(groups)
+
+    return results
+
+def _dynamic_row_texts(rule, groups):
+    key = rule["key"]
+    singular_template = rule["singular_template"]
+    grouped_template = rule["grouped_template"]
+    passive_template = rule.get("passive_template")
     texts = []
 
     def adjust(text_template, *translated_values):
@@ -353,119 +1233,135 @@ def fill_dynamic_text_rows(doc: Document, elevators: list, key, placeholder: str
                     translated = translate_value_if_possible(val, key=key)
                     texts.append(adjust(grouped_template, hiss_text, translated))
 
-    def replace_placeholder_in_table(table):
-        for row in list(table.rows):
-            for cell in row.cells:
-                if placeholder in cell.text:
-                    table._tbl.remove(row._tr)
-                    for text in texts:
-                        new_row = table.add_row()
-                        for i, c in enumerate(row.cells):
-                            new_cell = new_row.cells[i]
-                            if i == 0:
-                                para = new_cell.paragraphs[0]
-                                for run in para.runs:
-                                    run.text = ""
-                                para.add_run(text)
-
-                                # Kopiera stil
-                                original_para = cell.paragraphs[0]
-                                para.style = original_para.style
-                                para.paragraph_format.left_indent = original_para.paragraph_format.left_indent
-                                para.paragraph_format.first_line_indent = original_para.paragraph_format.first_line_indent
-                                para.paragraph_format.right_indent = original_para.paragraph_format.right_indent
-                                para.paragraph_format.space_before = Pt(3)
-                            else:
-                                new_cell.text = c.text
-                    return True
-                for nested in cell.tables:
-                    if replace_placeholder_in_table(nested):
-                        return True
-        return False
-
-    for table in doc.tables:
-        if replace_placeholder_in_table(table):
-            break
+    return texts
+
+def _static_row_texts(rule, matched):
+    if matched["labels"]:
+        hissar = ", ".join(sorted(set(matched["labels"])))
+        return [rule["text_template"].format(hissar, matched["value"])]
+    if rule.get("fallback_text"):
+        return [rule["fallback_text"]]
+    return None  # Inget att fylla och ingen fallback
+
+def _rule_row_texts(rule, groups):
+    if "value_filter" in rule:
+        return _static_row_texts(rule, groups)
+    return _dynamic_row_texts(rule, groups)
+
+def row_rule_texts(elevators: list, rules: list, table: ElevatorTable = None):
+    """{platshållare: rader} för radreglerna; None betyder att raden lämnas orörd."""
+    grouped = group_elevators_for_rules(elevators, rules, table=table)
+    return {rule["placeholder"]: _rule_row_texts(rule, groups) for rule, groups in zip(rules, grouped)}
+
+def replace_placeholder_row(doc, placeholder: str, texts: list, index: PlaceholderIndex):
+    """Ersätter första raden med `placeholder` med en ny rad per text (stilen kopieras från originalet)."""
+    found = index.first_cell(placeholder)
+    if found is None:
+        return
+    tbl, tr, tc = found
+    table = _table_proxy(doc, tbl)
+    row = _Row(tr, table)
+    cell = _Cell(tc, table)
+
+    table._tbl.remove(row._tr)
+    index.remove_row(tr)
+    for text in texts:
+        new_row = table.add_row()
+        for i, c in enumerate(row.cells):
+            new_cell = new_row.cells[i]
+            if i == 0:
+                para = new_cell.paragraphs[0]
+                for run in para.runs:
+                    run.text = ""
+                para.add_run(text)
+
+                # Kopiera stil
+                original_para = cell.paragraphs[0]
+                para.style = original_para.style
+                para.paragraph_format.left_indent = original_para.paragraph_format.left_indent
+                para.paragraph_format.first_line_indent = original_para.paragraph_format.first_line_indent
+                para.paragraph_format.right_indent = original_para.paragraph_format.right_indent
+                para.paragraph_format.space_before = Pt(3)
+            else:
+                new_cell.text = c.text
+        index.add_row(new_row._tr)
 
-def fill_static_row_if_present(doc: Document, elevators: list, key: str, value_filter, placeholder: str, text_template: str, fallback_text: str = None):
+def apply_row_rules(doc: Document, elevators: list, rules: list, index: PlaceholderIndex = None, timings: dict = None,
+                    table: ElevatorTable = None):
+    """
+    Kör en uppsättning radregler (se AVSLUT_ROW_RULES): hissarna grupperas för
+    alla regler i ett pass, sedan slås varje platshållare upp i indexet. Att lägga
+    till en regel kostar alltså ingen extra genomgång av dokumentet.
+    Om `timings` anges summeras tiden per platshållare där.
+    """
+    if index is None:
+        index = PlaceholderIndex(doc)
+    grouped = group_elevators_for_rules(elevators, rules, table=table)
+
+    for rule, groups in zip(rules, grouped):
+        start = time.perf_counter()
+        texts = _rule_row_texts(rule, groups)
+        if texts is not None:
+            replace_placeholder_row(doc, rule["placeholder"], texts, index)
+        if timings is not None:
+            timings[rule["placeholder"]] = timings.get(rule["placeholder"], 0.0) + time.perf_counter() - start
+
+def fill_dynamic_text_rows(doc: Document, elevators: list, key, placeholder: str,
+                           singular_template: str, grouped_template: str,
+                           passive_template: str = None, index: PlaceholderIndex = None):
+    rule = {
+        "placeholder": placeholder,
+        "key": key,
+        "singular_template": singular_template,
+        "grouped_template": grouped_template,
+        "passive_template": passive_template,
+    }
+    apply_row_rules(doc, elevators, [rule], index=index)
+
+def fill_static_row_if_present(doc: Document, elevators: list, key: str, value_filter, placeholder: str, text_template: str, fallback_text: str = None, index: PlaceholderIndex = None):
     """
     Om någon hiss uppfyller villkoret (via value_filter), ersätt placeholder med angiven text.
     text_template måste ha två {}: en för hissbeteckningar, en för värde.
     fallback_text används om ingen hiss matchar.
     """
-    matched_labels = []
-    matched_value = None
-
-    for e in elevators:
-        value = e.get(key, "").strip()
-        if value_filter(value):
-            label = e.get("general_information", "").strip().split()[0].upper()
-            matched_labels.append(label)
-            matched_value = value
-
-    if matched_labels:
-        hissar = ", ".join(sorted(set(matched_labels)))
-        text = text_template.format(hissar, matched_value)
-    elif fallback_text:
-        text = fallback_text
-    else:
-        return  # Inget att fylla och ingen fallback
-
-    def replace_placeholder_in_table(table):
-        for row in list(table.rows):
-            for cell in row.cells:
-                if placeholder in cell.text:
-                    table._tbl.remove(row._tr)
-                    new_row = table.add_row()
-                    for i, c in enumerate(row.cells):
-                        new_cell = new_row.cells[i]
-                        if i == 0:
-                            para = new_cell.paragraphs[0]
-                            for run in para.runs:
-                                run.text = ""
-                            para.add_run(text)
-
-                            original_para = cell.paragraphs[0]
-                            para.style = original_para.style
-                            para.paragraph_format.left_indent = original_para.paragraph_format.left_indent
-                            para.paragraph_format.first_line_indent = original_para.paragraph_format.first_line_indent
-                            para.paragraph_format.right_indent = original_para.paragraph_format.right_indent
-                            para.paragraph_format.space_before = Pt(3)  # lägg till spacing om du vill
-                        else:
-                            new_cell.text = c.text
-                    return True
-                for nested in cell.tables:
-                    if replace_placeholder_in_table(nested):
-                        return True
-        return False
-
-    for table in doc.tables:
-        if replace_placeholder_in_table(table):
-            break
+    rule = {
+        "placeholder": placeholder,
+        "key": key,
+        "value_filter": value_filter,
+        "text_template": text_template,
+        "fallback_text": fallback_text,
+    }
+    apply_row_rules(doc, elevators, [rule], index=index)
 
 
-def remove_rows_for_placeholders(doc: Document, placeholder_keys: list, data: dict):
+def remove_rows_for_placeholders(doc: Document, placeholder_keys: list, data: dict, index: PlaceholderIndex = None):
     norm_keys = {normalize_key(k) for k in placeholder_keys}
 
-    def remove_rows_in_table(table):
+    if index is None:
+        index = PlaceholderIndex(doc)
+
+    for row, keys in _rows_with_placeholders(doc, norm_keys, index):
+        for norm_key in keys:
+            if _is_empty_value(data.get(norm_key, "")):
+                logger.debug("Tar bort rad – nyckel saknas eller tom: %s", norm_key)
+                row._tr.getparent().remove(row._tr)
+                index.remove_row(row._tr)
+                break
+
+def _is_empty_value(value):
+    return not value or str(value).strip() == ""
+
+def _rows_with_placeholders(doc, norm_keys, index):
+    """(rad, nycklar) för varje tabellrad vars text innehåller någon av platshållarna."""
+    # Bara tabeller som faktiskt innehåller någon av platshållarna behöver gås igenom;
+    # nästlade tabeller med träffar kommer med som egna poster
+    for tbl in index.tables(f"{{{{{norm_key}}}}}" for norm_key in norm_keys):
+        table = _table_proxy(doc, tbl)
         for row in list(table.rows):
             row_text = " ".join(cell.text for cell in row.cells)
-
-            for norm_key in norm_keys:
-                if f"{{{{{norm_key}}}}}" in row_text:
-                    value = data.get(norm_key, "")
-                    if not value or str(value).strip() == "":
-                        print(f"  Tar bort rad – nyckel saknas eller tom: {norm_key}")
-                        row._tr.getparent().remove(row._tr)
-                        break
-
-            # Bearbeta nested tables även om raden togs bort
-            for cell in row.cells:
-                for nested_table in cell.tables:
-                    remove_rows_in_table(nested_table)
-
-    for table in doc.tables:
-        remove_rows_in_table(table)
+            keys = [norm_key for norm_key in norm_keys if f"{{{{{norm_key}}}}}" in row_text]
+            if keys:
+                yield row, keys
 
 def remove_different_first_page(doc):
     for section in doc.sections:
@@ -476,9 +1372,9 @@ def remove_different_first_page(doc):
 def insert_section_break_next_page(doc):
     try:
         doc.add_section(WD_SECTION.NEW_PAGE)
-        print(" Section Break (Next Page) infogad korrekt.")
+        logger.debug("Section Break (Next Page) infogad korrekt.")
     except Exception as e:
-        print(f" Kunde inte infoga Section Break: {e}")
+        logger.warning("Kunde inte infoga Section Break: %s", e)
 
 def clear_headers_and_footers(doc):
     for section in doc.sections:
@@ -507,15 +1403,25 @@ def remove_paragraphs_with_drawing_no_text_raw(doc):
         if has_drawing and not has_text:
             p.getparent().remove(p)
 
+MARGIN_ATTRIBUTES = ("top_margin", "bottom_margin", "left_margin", "right_margin", "header_distance", "footer_distance")
+
+def section_margins(doc):
+    """
+    Marginalerna i dokumentets första sektion. Värdena är vanliga int (EMU), så
+    att de kan skickas till en annan process: Length-klasserna som Twips
+    återskapas inte rätt av pickle.
+    """
+    template_sec = doc.sections[0]
+    return {name: None if value is None else int(value)
+            for name, value in ((name, getattr(template_sec, name)) for name in MARGIN_ATTRIBUTES)}
+
+def apply_margins(doc, margins):
+    for section in doc.sections:
+        for name, value in margins.items():
+            setattr(section, name, value)
+
 def copy_margins_from_template(source, target):
-    template_sec = source.sections[0]
-    for section in target.sections:
-        section.top_margin = template_sec.top_margin
-        section.bottom_margin = template_sec.bottom_margin
-        section.left_margin = template_sec.left_margin
-        section.right_margin = template_sec.right_margin
-        section.header_distance = template_sec.header_distance
-        section.footer_distance = template_sec.footer_distance
+    apply_margins(target, section_margins(source))
 
 def placeholders_missing_in_all_elevators(placeholders: list, elevators: list):
     norm_keys = {normalize_key(p) for p in placeholders}
@@ -537,12 +1443,13 @@ def merge_elevator_data(elevators, global_data=None):
     return merged
 
 def merge_groups_by_key(groups, key):
-    merged = defaultdict(list)
-    for g in groups:
-        k = g.get(key, "")
-        hissar = g.get("hissbeteckning", "")
+    table = ElevatorTable(groups)
+    designations = table.column("hissbeteckning")
+    merged = {}
+    for (k,), rows in table.group_by((key,)).items():
+        hissar = [h.strip() for row in rows if designations[row] for h in designations[row].split(",")]
         if k and hissar:
-            merged[k].extend(h.strip() for h in hissar.split(","))
+            merged[k] = hissar
     merged_list = []
     for k, hissar in merged.items():
         base = groups[0].copy()
@@ -552,394 +1459,1392 @@ def merge_groups_by_key(groups, key):
         merged_list.append(base)
     return merged_list
 
-def group_elevators_by_keys(elevators, keys):
-    grouped = defaultdict(list)
-    for elevator in elevators:
-        group_key = tuple(elevator.get(k, "") for k in keys)
-        grouped[group_key].append(elevator)
+def group_elevators_by_keys(elevators, keys, table: ElevatorTable = None):
+    table = table or ElevatorTable(elevators)
 
     result = []
-    for group in grouped.values():
-        base = group[0].copy()
-        base["hissbeteckning"] = ", ".join(
-            e.get("general_information", "").split()[0].upper()
-            for e in group if e.get("general_information")
-        )
-        base["antal_hissar"] = str(len(group))
+    for rows in table.group_by(keys).values():
+        first = elevators[rows[0]]
+        base = first.copy()
+        base["hissbeteckning"] = ", ".join(table.group_labels(rows))
+        base["antal_hissar"] = str(len(rows))
         for k in keys:
-            base[k] = group[0].get(k, "")
+            base[k] = first.get(k, "")
         result.append(base)
     return result
 
-def generate_final_doc(template_path, elevator_groups, all_elevators, hissida_path, avslut_path, translation_dict, group_defs, global_data=None):
-    master = Document(template_path)
-
-    # Skapa dynamiska grupprubriker från group_defs
-    group_headings = []
-    for i, group in enumerate(group_defs):
-        names = [e.strip().split()[0].upper() for e in group.get("hissbeteckning", "").split(",") if e.strip()]
-        if names:
-            if len(names) == 1:
-                heading = f"Grupp {i+1}: {names[0]}"
-            else:
-                heading = f"Grupp {i+1}: {names[0]}–{names[-1]}"
-            group_headings.append(heading)
+# Regler för de dynamiska raderna i avslutningsmallen. Varje regel ersätter raden
+# med `placeholder`. Regler med "value_filter" listar de hissar vars värde matchar
+# (text_template/fallback_text), övriga grupperar hissarna per värde på `key`
+# (en nyckel eller en tupel av nycklar) och använder singular/grouped/passive-mallarna.
+AVSLUT_ROW_RULES = [
+    {
+        "placeholder": "{{ceiling_type_group}}",
+        "key": "ceiling_type",
+        "singular_template": 'Tak i hisskorgar ska vara av typ {}.',
+        "grouped_template": 'Hissar med beteckning {} har tak i hisskorgen av typ {}.',
+    },
+    {
+        "placeholder": "{{floor_type_group}}",
+        "key": "flooring_material",
+        "singular_template": 'Golv i hissar ska vara av typ {}.',
+        "grouped_template": 'Hissar med beteckning {} skall ha golv av typ {}.',
+        "passive_template": "Hissar med beteckning {} skall ha lokalt golv av typ [fyll i vilket golv].",
+    },
+    {
+        "placeholder": "{{car_door_panel_group}}",
+        "key": "car_door_panel_decoration_aside",
+        "singular_template": 'Korgdörrar skall vara av material {}.',
+        "grouped_template": 'Hissar med beteckning {} skall ha korgdörrar av typ {}.',
+    },
+    {
+        "placeholder": "{{car_front_wall_material_group}}",
+        "key": "car_front_wall_material",
+        "singular_template": 'Korgöppningar för hiss skall vara av material {}.',
+        "grouped_template": 'Korgöppningar för hissar med beteckning {} skall vara av material {}.',
+    },
+    {
+        "placeholder": "{{maximum_starts_per_hour_group}}",
+        "key": "maximum_starts_per_hour",
+        "singular_template": 'Drivsystem skall vara dimensionerat för minst {} starter per timma.',
+        "grouped_template": 'Drivsystem för hissar med beteckning {} skall vara dimensionerat för minst {} starter per timme.',
+    },
+    {
+        "placeholder": "{{elevator_complementary_standard_group}}",
+        "key": "elevator_complementary_standard",
+        "value_filter": lambda v: "EN81-72 2020" in v,
+        "text_template": "Hissar med beteckning {} skall vara brandbekämpningshissar enligt {}.",
+        "fallback_text": "Inga hissar är brandbekämpningshissar.",
+    },
+    {
+        "placeholder": "{{handrail_group}}",
+        "key": ("handrail_type", "handrail_material"),
+        "singular_template": 'Handledare skall vara {} i {}, på distans från korgvägg. Handledare monteras med överkant 900 mm över golv. Alla kanter, infästningar etc skall vara väl rundade och avfasade.',
+        "grouped_template": 'Hissar med beteckning {} skall ha handledare av typ {} i {}, på distans från korgvägg. Handledare monteras med överkant 900 mm över golv. Alla kanter, infästningar etc skall vara väl rundade och avfasade.',
+    },
+    {
+        "placeholder": "{{car_mirror_group}}",
+        "key": ("car_mirror_size", "car_mirror_position"),
+        "singular_template": "Spegel skall vara {}. Spegel skall monteras på korgs {}.",
+        "grouped_template": "Hissar med beteckning {} skall ha {} spegel, monterad på korgs {}.",
+        "passive_template": "Hissar med beteckning {} saknar angiven typ för spegel.",
+    },
+    {
+        "placeholder": "{{car_door_model_a_side_group}}",
+        "key": "car_door_model_a_side",
+        "singular_template": "Korgdörr inklusive dörrmaskineri skall vara utförda och konstruerade för minst {} cykler (öppning och stängning) per år.",
+        "grouped_template": "Hissar med beteckning {} skall ha korgdörr inklusive dörrmaskineri utfört och konstruerat för minst {} cykler (öppning och stängning) per år.",
+    },
+    {
+        "placeholder": "{{car_fan_type_group}}",
+        "key": "car_fan_type",
+        "singular_template": "Hisskorgar skall förses med {} som skall styras med 5 minuters frånslagsfördröjning.",
+        "grouped_template": "Hissar med beteckning {} skall ha {}, styrd med 5 minuters frånslagsfördröjning.",
+        "passive_template": "Hissar med beteckning {} skall förses med passiv ventilation i erforderlig omfattning.",
+    },
+    {
+        "placeholder": "{{flip_chair_type_group}}",
+        "key": "flip_chair_type",
+        "singular_template": "Fällsits skall monteras på korgvägg. Korgvägg skall förstärkas för infästning av fällsits.",
+        "grouped_template": "Hissar med beteckning {} skall ha fällsits monterad på korgvägg. Korgvägg skall förstärkas för infästning av fällsits.",
+    },
+    {
+        "placeholder": "{{buffer_rails_quantity_group}}",
+        "key": "buffer_rails_quantity",
+        "singular_template": "{} rad/rader med avbärarlister skall monteras ovan sockel på vägg som ej har dörröppning.",
+        "grouped_template": "Hissar med beteckning {} skall ha {} rad/rader med avbärarlister monterad ovan sockel på vägg som ej har dörröppning.",
+        "passive_template": "Hissar med beteckning {} skall ej ha avbärarlister.",
+    },
+    {
+        "placeholder": "{{car_door_panel_decoration_aside_group}}",
+        "key": "car_door_panel_decoration_aside",
+        "singular_template": "Korgdörrar skall vara av {}.",
+        "grouped_template": "Hissar med beteckning {} skall ha korgdörrar av typ {}.",
+        "passive_template": "Hissar med beteckning {} saknar angivet material för korgdörrar.",
+    },
+    {
+        "placeholder": "{{prl_group}}",
+        "key": "prl",
+        "value_filter": lambda v: bool(v.strip()),
+        "text_template": "Följande hissar skall ha prioriterad körning: {}.",
+    },
+    {
+        "placeholder": "{{ebd_emergency_battery_drive_group}}",
+        "key": "ebd_emergency_battery_drive",
+        "value_filter": lambda v: bool(v.strip()),
+        "text_template": "Automatisk nödsänkning krävs för följande hissar: {}.",
+    },
+    {
+        "placeholder": "{{door_type_group}}",
+        "key": "door_type",
+        "singular_template": "Schaktdörr skall vara av typ {} och med dagöppningar motsvarande korgdörrar.",
+        "grouped_template": "Hissar med beteckning {} skall ha schaktdörr av typ {}, med dagöppningar motsvarande korgdörrar.",
+        "passive_template": "Hissar med beteckning {} saknar angiven schaktdörrstyp.",
+    },
+    {
+        "placeholder": "{{landing_door_model_group}}",
+        "key": "landing_door_model",
+        "singular_template": "Schaktdörrar skall vara utförda och konstruerade för minst {} cykler (öppning och stängning) per år.",
+        "grouped_template": "Schaktdörrar i hissar med beteckning {} skall vara utförda och konstruerade för minst {} cykler (öppning och stängning) per år.",
+    },
+    {
+        "placeholder": "{{finishing_a_group}}",
+        "key": "finishing_a",
+        "singular_template": "Schaktdörrar för hiss skall vara av typ {}.",
+        "grouped_template": "Hissar med beteckning {} skall ha schaktdörrar av typ {}.",
+        "passive_template": "Hissar med beteckning {} saknar angiven typ för schaktdörr.",
+    },
+    {
+        "placeholder": "{{landing_door_frame_front_group}}",  # Vi ersätter bara den ena, men båda behövs
+        "key": ("landing_door_frame_front", "finishing_a"),
+        "singular_template": "För hiss monteras schaktdörrar i {} utförande, samt skall vara av material {}.",
+        "grouped_template": "Hissar med beteckning {} skall ha schaktdörrar i {} utförande och av material {}.",
+        "passive_template": "Hissar med beteckning {} saknar angivet dörrkarm- eller materialutförande.",
+    },
+    {
+        "placeholder": "{{sill_type_a_group}}",  # Vi använder bara en placeholder för radmatchning
+        "key": ("sill_type_a", "landing_door_sill_material"),
+        "singular_template": "Trösklar skall utföras med placering {} med tröskelprofil i {}.",
+        "grouped_template": "Hissar med beteckning {} skall ha trösklar utförda med placering {} med tröskelprofil i {}.",
+        "passive_template": "Hissar med beteckning {} saknar uppgift om tröskeltyp eller material.",
+    },
+    {
+        "placeholder": "{{signalisation_series_group}}",
+        "key": "signalisation_series",
+        "singular_template": "Manöver- och indikeringsdon i hissarna skall vara av typ {}.",
+        "grouped_template": "Hissar med beteckning {} skall ha manöver- och indikeringsdon av typ {}.",
+        "passive_template": "Hissar med beteckning {} saknar angiven typ av manöver- och indikeringsdon.",
+    },
+    {
+        "placeholder": "{{cover_plate_materials_group}}",
+        "key": ("lcs_lci_material", "cop_face_plate_material"),
+        "singular_template": "Täcklock för anrop skall vara av material {}, täcklock för tryckknappspanel i korg skall vara av material {}.",
+        "grouped_template": "Hissar med beteckning {} skall ha täcklock för anrop av material {}, och täcklock för tryckknappspanel i korg av material {}.",
+        "passive_template": "Hissar med beteckning {} saknar angivet material för täcklock vid anrop eller i korg.",
+    },
+    {
+        "placeholder": "{{control_system_group}}",
+        "key": "control_system",
+        "singular_template": "Hissar skall ha styrning för {}.",
+        "grouped_template": "Hissar med beteckning {} skall ha styrning för {}.",
+        "passive_template": "Hissar med beteckning {} saknar angiven styrningstyp.",
+    },
+    {
+        "placeholder": "{{lcs_lci_placement_group}}",
+        "key": "lcs_lci_placement",
+        "singular_template": "Anropsknapp, var med hiss kan kallas till stannplanet, skall placeras vid sidan av schaktdörr. Anropsknappar skall placeras {}.",
+        "grouped_template": "Hissar med beteckning {} skall ha anropsknapp, var med hiss kan kallas till stannplanet, placerad vid sidan av schaktdörr. Anropsknappar skall placeras {}.",
+        "passive_template": "Hissar med beteckning {} saknar angiven placering för anropsknappar.",
+    },
+    {
+        "placeholder": "{{wall_b_finishing_group}}",
+        "key": "wall_b_finishing",
+        "singular_template": "Korgväggar i hiss skall vara av typ {}.",
+        "grouped_template": "Hissar med beteckning {} skall ha korgväggar av typ {}.",
+        "passive_template": "Hissar med beteckning {} saknar angiven typ för korgväggar.",
+    },
+]
+
+def fill_avslut_rows(avslut, all_elevators, index: PlaceholderIndex = None, timings: dict = None,
+                     table: ElevatorTable = None):
+    """Fyller de dynamiska raderna i avslutningsmallen utifrån alla individuella hissar."""
+    with stage("avslut_rules"):
+        apply_row_rules(avslut, all_elevators, AVSLUT_ROW_RULES, index=index, timings=timings, table=table)
+
+def default_output_path():
+    base_dir = os.path.dirname(os.path.abspath(__file__))  # Mapp där RFQ_GIT.py ligger
+    output_dir = os.path.join(base_dir, "output")
+    os.makedirs(output_dir, exist_ok=True)  # Skapar mappen om den inte finns
 
-    if global_data is None:
-        global_data = {}
-    global_data["datum"] = datetime.today().strftime("%Y-%m-%d")
+    return os.path.join(output_dir, "komplett_rfqdokument.docx")
 
-    # Första hissen fylls i i huvudmallen
-    combined_first = {**global_data, **elevator_groups[0]}
-    placeholders_to_check = ["prl", "ebd_emergency_battery_drive"]
-    if placeholders_missing_in_all_elevators(placeholders_to_check, all_elevators):
-        print(" Tar bort rader – ingen hiss har värden för:",placeholders_to_check)
-        remove_rows_for_placeholders(master,placeholders_to_check,combined_first)
+def write_output(document: bytes, output_path=None):
+    """Skriver färdiga dokumentbytes till en sökväg eller ström, som generate_final_doc."""
+    if output_path is None:
+        output_path = default_output_path()
+    if isinstance(output_path, (str, os.PathLike)):
+        with open(output_path, "wb") as f:
+            f.write(document)
     else:
-        print(" Behåller rader – minst en hiss har värden för:",placeholders_to_check)
+        output_path.write(document)
+    return output_path
 
-    fill_group_headings_dynamic(master, group_headings)
-    fill_placeholders_in_doc(master, combined_first)
-    print(" Fyller in grupprubriker:", group_headings)
-    copy_margins_from_template(master, master)
+# --- Utdata-paketering ---
+
+# composer.save() deflaterar om varje del vid varje sparning, även bilderna från
+# mallarna som är desamma i varje dokument. save_document skriver paketet som
+# python-docx men komprimerar varje unik mediadel en gång per process och
+# kopierar sedan de färdiga byten. Media som knappt krymper lagras okomprimerade.
+DEFLATE_LEVEL = int(os.environ.get("RFQ_DEFLATE_LEVEL", "6"))  # XML-delar, 0–9
+MEDIA_STORE_RATIO = 0.9  # Lagra okomprimerat om deflate sparar mindre än 10 %
+MEDIA_CACHE_ENTRIES = 32
+
+# Relationstyper vars mål bara används via r:id i källdelens XML. Övriga typer
+# (styles, numbering, theme, …) är implicita och behålls alltid.
+PRUNABLE_RELTYPES = frozenset((RT.IMAGE, RT.HYPERLINK, RT.HEADER, RT.FOOTER, RT.OLE_OBJECT, RT.PACKAGE, RT.CHART))
+R_ATTRIBUTES = etree.XPath("//@r:*", namespaces={"r": nsmap["r"]})
+
+_media_entries = OrderedDict()  # sha1 -> (crc, deflaterade byte) eller None för ZIP_STORED
+_media_lock = threading.Lock()
+
+def _media_entry(blob):
+    key = hashlib.sha1(blob).digest()
+    with _media_lock:
+        if key in _media_entries:
+            _media_entries.move_to_end(key)
+            return _media_entries[key]
+    compressor = zlib.compressobj(DEFLATE_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    payload = compressor.compress(blob) + compressor.flush()
+    entry = (zlib.crc32(blob), payload) if len(payload) < len(blob) * MEDIA_STORE_RATIO else None
+    with _media_lock:
+        _media_entries[key] = entry
+        while len(_media_entries) > MEDIA_CACHE_ENTRIES:
+            _media_entries.popitem(last=False)
+    return entry
+
+def _write_deflated(zf, name, size, crc, payload):
+    """Skriver redan deflaterade byte som en post utan att komprimera om dem."""
+    info = zipfile.ZipInfo(name, date_time=time.localtime(time.time())[:6])
+    info.compress_type = zipfile.ZIP_STORED
+    with zf.open(info, "w") as f:
+        f.write(payload)
+    # Posten skrevs som lagrad; rätta huvudet till deflate med originalets storlek och CRC.
+    end = zf.fp.tell()
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.file_size = size
+    info.CRC = crc
+    zf.fp.seek(info.header_offset)
+    zf.fp.write(info.FileHeader())
+    zf.fp.seek(end)
+
+@lru_cache(maxsize=None)
+def _deflated_copy_works():
+    """
+    _write_deflated skriver om zipfiles lokala huvud, vilket inte är ett
+    publikt API. Kontrolleras en gång per process: ger det inte en hel zip med
+    den här Python-versionen komprimeras media i stället vid varje sparning.
+    """
+    blob = b"RFQ " * 256
+    compressor = zlib.compressobj(DEFLATE_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    payload = compressor.compress(blob) + compressor.flush()
+    buffer = io.BytesIO()
+    try:
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+            _write_deflated(zf, "media.bin", len(blob), zlib.crc32(blob), payload)
+            zf.writestr("efter.xml", b"<ok/>")
+        with zipfile.ZipFile(buffer) as zf:
+            works = zf.testzip() is None and zf.read("media.bin") == blob and zf.read("efter.xml") == b"<ok/>"
+    except Exception:
+        works = False
+    if not works:
+        logger.warning("Förkomprimerad media fungerar inte med zipfile i Python %s; media komprimeras vid varje sparning.",
+                       sys.version.split()[0])
+    return works
+
+def prune_orphaned_parts(package):
+    """Tar bort explicita relationer som ingen r:id pekar på; delarna bakom dem skrivs då inte."""
+    dropped = 0
+    for part in package.iter_parts():
+        element = getattr(part, "_element", None)
+        if element is None or not len(part.rels):
+            continue
+        used = set(R_ATTRIBUTES(element))
+        for rId, rel in list(part.rels.items()):
+            if rel.reltype in PRUNABLE_RELTYPES and rId not in used:
+                part.drop_rel(rId)
+                dropped += 1
+    if dropped:
+        logger.debug("Tog bort %d oanvända relationer före sparning.", dropped)
+    return dropped
+
+def save_document(document, output_path):
+    """Sparar ett python-docx-dokument som composer.save(), med mediamedveten komprimering."""
+    package = document.part.package
+    prune_orphaned_parts(package)
+    parts = list(package.iter_parts())
+    for part in parts:
+        part.before_marshal()
+
+    if isinstance(output_path, (str, os.PathLike)):
+        with open(output_path, "wb") as f:
+            _write_package(f, package, parts)
+    elif output_path.seekable():
+        _write_package(output_path, package, parts)
+    else:
+        buffer = io.BytesIO()
+        _write_package(buffer, package, parts)
+        output_path.write(buffer.getvalue())
+    return output_path
 
-    composer = Composer(master)
+def _write_package(stream, package, parts):
+    copy_media = _deflated_copy_works()
+    with zipfile.ZipFile(stream, "w", zipfile.ZIP_DEFLATED, compresslevel=DEFLATE_LEVEL) as zf:
+        zf.writestr(CONTENT_TYPES_URI.membername, _ContentTypesItem.from_parts(parts).blob)
+        zf.writestr(PACKAGE_URI.rels_uri.membername, package.rels.xml)
+        for part in parts:
+            blob = part.blob
+            name = part.partname.membername
+            if part.content_type.endswith("xml") or not copy_media:
+                zf.writestr(name, blob)
+            else:
+                entry = _media_entry(blob)
+                if entry is None:
+                    zf.writestr(name, blob, compress_type=zipfile.ZIP_STORED)
+                else:
+                    _write_deflated(zf, name, len(blob), *entry)
+            if len(part.rels):
+                zf.writestr(part.partname.rels_uri.membername, part.rels.xml)
 
-    for elevator in elevator_groups[1:]:
-        doc = Document(hissida_path)
-        remove_different_first_page(doc)
-        remove_empty_paragraphs_before_first_table(doc)
-        remove_paragraphs_with_drawing_no_text_raw(doc)
-        clear_headers_and_footers(doc)
-        combined_data = {**global_data, **elevator}
-        fill_placeholders_in_doc(doc, combined_data)
-        copy_margins_from_template(master, doc)
-        insert_section_break_next_page(doc)
-        composer.append(doc)
-
-    # Avslutningsdelen → använd alla individuella hissar
-    avslut = Document(avslut_path)
-    remove_different_first_page(avslut)
-    remove_empty_paragraphs_before_first_table(avslut)
-    remove_paragraphs_with_drawing_no_text_raw(avslut)
-    clear_headers_and_footers(avslut)
-
-    fill_dynamic_text_rows(
-        avslut,
-        all_elevators,
-        key="ceiling_type",
-        placeholder="{{ceiling_type_group}}",
-        singular_template='Tak i hisskorgar ska vara av typ {}.',
-        grouped_template='Hissar med beteckning {} har tak i hisskorgen av typ {}.'
-    )
+class RepeatedPageComposer:
+    """
+    Snabb väg för att lägga samma mall (hissida.docx) många gånger efter
+    varandra i en Composer. Första sidan läggs till med Composer.append, som
+    slår ihop stilar, numrering, relationer och media; för följande sidor
+    klonas bara den ifyllda kroppen och stil-id skrivs om enligt samma
+    mappning. Alla sidor måste vara renderade från samma mall.
+
+    Sidor som använder numrering, fotnoter, diagram, inbäddade delar eller
+    stilar utanför mappningen läggs till med Composer.append som vanligt.
+    """
 
-    fill_dynamic_text_rows(
-        avslut,
-        all_elevators,
-        key="flooring_material",
-        placeholder="{{floor_type_group}}",
-        singular_template='Golv i hissar ska vara av typ {}.',
-        grouped_template='Hissar med beteckning {} skall ha golv av typ {}.',
-        passive_template="Hissar med beteckning {} skall ha lokalt golv av typ [fyll i vilket golv]."
-    )
+    def __init__(self, composer):
+        self.composer = composer
+        self.fast_appends = 0
+        self.full_appends = 0
+        self._style_map = None
 
+    def append(self, doc):
+        if self._style_map is not None and self._can_clone(doc):
+            self._clone(doc)
+            self.fast_appends += 1
+        else:
+            self._full_append(doc)
+            self.full_appends += 1
+
+    def finish(self):
+        """Numrerar om bokmärken och bild-id en gång för alla klonade sidor."""
+        if self.fast_appends:
+            self.composer.renumber_bookmarks()
+            self.composer.renumber_docpr_ids()
+            self.composer.renumber_nvpicpr_ids()
+
+    def _num_count(self):
+        try:
+            numbering = self.composer.doc.part.rels.part_with_reltype(RT.NUMBERING)
+        except KeyError:
+            return 0
+        return len(numbering.element.xpath("w:num"))
+
+    def _full_append(self, doc):
+        nums_before = self._num_count()
+        self.composer.append(doc)
+
+        # Stilmappningen från första sidan gäller för resten av sidorna, så länge
+        # Composer inte behövde lägga till eller starta om någon numrering
+        if self._style_map is None and self._num_count() == nums_before:
+            composer = self.composer
+            self._style_map = {
+                style_id: composer.mapped_style_id(style_id) for style_id in composer._style_id2name
+            }
 
-    fill_dynamic_text_rows(
-        avslut,
-        all_elevators,
-        key="car_door_panel_decoration_aside",
-        placeholder="{{car_door_panel_group}}",
-        singular_template='Korgdörrar skall vara av material {}.',
-        grouped_template='Hissar med beteckning {} skall ha korgdörrar av typ {}.'
-    )
+    def _can_clone(self, doc):
+        body = doc.element.body
+        if has_docproperty_fields(doc):
+            return False
+        if body.xpath(".//w:numId|.//w:footnoteReference|.//dgm:relIds"):
+            return False
+        for element in body.xpath(".//*[@r:id]"):
+            if element.tag in (W_HEADER_REF, W_FOOTER_REF):
+                continue
+            rel = doc.part.rels[element.get(qn("r:id"))]
+            if not rel.is_external and element.tag != V_IMAGEDATA:
+                return False
+        used_style_ids = body.xpath(".//w:tblStyle/@w:val|.//w:pStyle/@w:val|.//w:rStyle/@w:val")
+        return all(style_id in self._style_map for style_id in used_style_ids)
+
+    def _clone(self, doc):
+        composer = self.composer
+        target = composer.doc.element.body
+        index = composer.append_index()
+        for element in doc.element.body:
+            if element.tag == W_SECTPR:
+                continue
+            element = copy.deepcopy(element)
+            target.insert(index, element)
+            index += 1
+
+            for style in element.xpath(".//w:tblStyle|.//w:pStyle|.//w:rStyle"):
+                our_style_id = self._style_map[style.val]
+                if our_style_id is not None:
+                    style.val = our_style_id
+            for link in element.xpath(".//*[@r:id]"):
+                if link.tag in (W_HEADER_REF, W_FOOTER_REF, V_IMAGEDATA):
+                    continue
+                rel = doc.part.rels[link.get(qn("r:id"))]
+                link.set(qn("r:id"), composer.doc.part.rels.get_or_add_ext_rel(rel.reltype, rel.target_ref))
+            # Bilder slås ihop på sha1 av Composer, så varje bild finns bara en gång
+            composer.add_images(doc, element)
+            composer.add_shapes(doc, element)
+            composer.remove_header_and_footer_references(doc, element)
+
+        composer.fix_section_types(doc)
+        composer.fix_header_and_footers(doc)
+
+OPTIONAL_ROW_PLACEHOLDERS = ["prl", "ebd_emergency_battery_drive"]
+
+def render_master(template_path, first_group, group_headings, global_data, drop_optional_rows):
+    """
+    Huvudmallen med första hissgruppen och grupprubrikerna ifyllda.
+    `drop_optional_rows` anger att ingen hiss har värden för OPTIONAL_ROW_PLACEHOLDERS.
+    """
+    master = load_template(template_path)
 
-    fill_dynamic_text_rows(
-        avslut,
-        all_elevators,
-        key="car_front_wall_material",
-        placeholder="{{car_front_wall_material_group}}",
-        singular_template='Korgöppningar för hiss skall vara av material {}.',
-        grouped_template='Korgöppningar för hissar med beteckning {} skall vara av material {}.'
-    )
+    # Första hissen fylls i i huvudmallen
+    combined_first = {**global_data, **first_group}
+    placeholders_to_check = OPTIONAL_ROW_PLACEHOLDERS
+    if drop_optional_rows:
+        logger.debug("Tar bort rader – ingen hiss har värden för: %s", placeholders_to_check)
+    else:
+        logger.debug("Behåller rader – minst en hiss har värden för: %s", placeholders_to_check)
 
-    fill_dynamic_text_rows(
-        avslut,
-        all_elevators,
-        key="maximum_starts_per_hour",
-        placeholder="{{maximum_starts_per_hour_group}}",
-        singular_template='Drivsystem skall vara dimensionerat för minst {} starter per timma.',
-        grouped_template='Drivsystem för hissar med beteckning {} skall vara dimensionerat för minst {} starter per timme.'
-    )
+    plan = _template_plan(template_path, None, _compile_master_plan)
+    if plan is not None:
+        master = plan.render(master, combined_first, drop_optional_rows=drop_optional_rows,
+                             rows={"{{section_heading}}": group_headings})
+    else:
+        master_index = PlaceholderIndex(master)
+        if drop_optional_rows:
+            remove_rows_for_placeholders(master,placeholders_to_check,combined_first, index=master_index)
+        fill_group_headings_dynamic(master, group_headings, index=master_index)
+        fill_placeholders_in_doc(master, combined_first, index=master_index)
+    logger.debug("Fyller in grupprubriker: %s", group_headings)
+    copy_margins_from_template(master, master)
+    return master
 
+# --- Renderingsplaner ---
 
-    fill_static_row_if_present(
-        avslut,
-        all_elevators,
-        key="elevator_complementary_standard",
-        value_filter=lambda v: "EN81-72 2020" in v,
-        placeholder="{{elevator_complementary_standard_group}}",
-        text_template="Hissar med beteckning {} skall vara brandbekämpningshissar enligt {}.",
-        fallback_text="Inga hissar är brandbekämpningshissar."
-    )
+# Mallarna ändras sällan, men varje ifyllnad går igenom python-docx-objekt,
+# regex-sökningar och XML-ändringar. En renderingsplan gör det arbetet en gång
+# per mall: document.xml och sidhuvudena delas upp i statiska byte-fragment och luckor (runs
+# med platshållare, valfria rader, rader som upprepas per grupprubrik eller
+# per text från en radregel). Rendering blir sedan sammanfogning av fragment
+# och escapade värden, följt av en enda XML-parsning.
 
-    fill_dynamic_text_rows(
-        avslut,
-        all_elevators,
-        key=("handrail_type", "handrail_material"),
-        placeholder="{{handrail_group}}",
-        singular_template='Handledare skall vara {} i {}, på distans från korgvägg. Handledare monteras med överkant 900 mm över golv. Alla kanter, infästningar etc skall vara väl rundade och avfasade.',
-        grouped_template='Hissar med beteckning {} skall ha handledare av typ {} i {}, på distans från korgvägg. Handledare monteras med överkant 900 mm över golv. Alla kanter, infästningar etc skall vara väl rundade och avfasade.'
-    )
+RENDER_PLANS = True  # False: fyll alltid i via python-docx (för jämförelser)
 
-    fill_dynamic_text_rows(
-        avslut,
-        all_elevators,
-        key=("car_mirror_size", "car_mirror_position"),
-        placeholder="{{car_mirror_group}}",
-        singular_template="Spegel skall vara {}. Spegel skall monteras på korgs {}.",
-        grouped_template="Hissar med beteckning {} skall ha {} spegel, monterad på korgs {}.",
-        passive_template="Hissar med beteckning {} saknar angiven typ för spegel."
-    )
+PLAN_MARKER = re.compile(rb"<\?rfq-(begin|end|run) (\d+)\?>")
+RUN_TEXT_BREAKS = re.compile(r"(\t|\r|\n)")
+PLAN_SENTINEL = "\ue000{}\ue001"  # Privat Unicode-område, förekommer inte i mallarna
 
-    fill_dynamic_text_rows(
-        avslut,
-        all_elevators,
-        key="car_door_model_a_side",
-        placeholder="{{car_door_model_a_side_group}}",
-        singular_template="Korgdörr inklusive dörrmaskineri skall vara utförda och konstruerade för minst {} cykler (öppning och stängning) per år.",
-        grouped_template="Hissar med beteckning {} skall ha korgdörr inklusive dörrmaskineri utfört och konstruerat för minst {} cykler (öppning och stängning) per år."
-    )
+class TemplatePlanError(Exception):
+    """Mallen har en struktur som renderingsplanen inte kan återge; fyll i via python-docx."""
 
-    fill_dynamic_text_rows(
-        avslut,
-        all_elevators,
-        key="car_fan_type",
-        placeholder="{{car_fan_type_group}}",
-        singular_template="Hisskorgar skall förses med {} som skall styras med 5 minuters frånslagsfördröjning.",
-        grouped_template="Hissar med beteckning {} skall ha {}, styrd med 5 minuters frånslagsfördröjning.",
-        passive_template="Hissar med beteckning {} skall förses med passiv ventilation i erforderlig omfattning."
-    )
+def _escape_text(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
 
-    fill_dynamic_text_rows(
-        avslut,
-        all_elevators,
-        key="flip_chair_type",
-        placeholder="{{flip_chair_type_group}}",
-        singular_template="Fällsits skall monteras på korgvägg. Korgvägg skall förstärkas för infästning av fällsits.",
-        grouped_template="Hissar med beteckning {} skall ha fällsits monterad på korgvägg. Korgvägg skall förstärkas för infästning av fällsits."
-      )
-
-    fill_dynamic_text_rows(
-        avslut,
-        all_elevators,
-        key="buffer_rails_quantity",
-        placeholder="{{buffer_rails_quantity_group}}",
-        singular_template="{} rad/rader med avbärarlister skall monteras ovan sockel på vägg som ej har dörröppning.",
-        grouped_template="Hissar med beteckning {} skall ha {} rad/rader med avbärarlister monterad ovan sockel på vägg som ej har dörröppning.",
-        passive_template="Hissar med beteckning {} skall ej ha avbärarlister."
-    )
+def _run_content_xml(text):
+    """Samma run-innehåll som python-docx skapar för run.text = text, som XML."""
+    parts = []
+    for piece in RUN_TEXT_BREAKS.split(text):
+        if not piece:
+            continue
+        if piece == "\t":
+            parts.append("<w:tab/>")
+        elif piece in ("\r", "\n"):
+            parts.append("<w:br/>")
+        elif len(piece.strip()) < len(piece):
+            parts.append(f'<w:t xml:space="preserve">{_escape_text(piece)}</w:t>')
+        else:
+            parts.append(f"<w:t>{_escape_text(piece)}</w:t>")
+    return "".join(parts)
+
+class _RenderContext:
+    def __init__(self, data, replacements_for, drop_optional_rows, rows):
+        self.data = data
+        self.replacements_for = replacements_for
+        self.drop_optional_rows = drop_optional_rows
+        self.rows = rows
+        self.items = []
+        self.paragraph_texts = {}
+
+class _ParagraphSlot:
+    """Ett stycke med platshållare: de runs som berörs fylls i tillsammans."""
+
+    def __init__(self, texts, full_text, matches):
+        self.texts = texts
+        self.full_text = full_text
+        self.matches = matches
+
+    def run_texts(self, ctx):
+        texts = ctx.paragraph_texts.get(self)
+        if texts is None:
+            values = ctx.replacements_for(self.full_text, self.matches)
+            texts = ctx.paragraph_texts[self] = _splice_run_texts(self.texts, self.matches, values)
+        return texts
+
+class _RunSlot:
+    def __init__(self, paragraph, k):
+        self.paragraph = paragraph
+        self.k = k
+
+    def render(self, ctx, out):
+        out.append(_run_content_xml(self.paragraph.run_texts(ctx)[self.k]).encode("utf-8"))
+
+class _ItemSlot:
+    """Run vars text kommer från den upprepade raden (grupprubrik eller regeltext)."""
+
+    def __init__(self, prefix, suffix):
+        self.prefix = prefix
+        self.suffix = suffix
+
+    def render(self, ctx, out):
+        out.append(_run_content_xml(self.prefix + ctx.items[-1] + self.suffix).encode("utf-8"))
+
+class _Block:
+    """
+    Del av planen som renderas villkorligt eller upprepat:
+    "optional" – valfri rad som tas bort om någon av nycklarna saknar värde,
+    "unless" – originalraden, kvar bara om radregeln inte gav några rader,
+    "repeat" – en rad per text (grupprubrik eller regeltext).
+    """
 
-    fill_dynamic_text_rows(
-        avslut,
-        all_elevators,
-        key="car_door_panel_decoration_aside",
-        placeholder="{{car_door_panel_decoration_aside_group}}",
-        singular_template="Korgdörrar skall vara av {}.",
-        grouped_template="Hissar med beteckning {} skall ha korgdörrar av typ {}.",
-        passive_template="Hissar med beteckning {} saknar angivet material för korgdörrar."
-    )
+    def __init__(self, kind, arg):
+        self.kind = kind
+        self.arg = arg
+        self.children = []
+
+    def render(self, ctx, out):
+        if self.kind == "optional":
+            if ctx.drop_optional_rows and any(_is_empty_value(ctx.data.get(key, "")) for key in self.arg):
+                return
+            _render_nodes(self.children, ctx, out)
+        elif self.kind == "unless":
+            if ctx.rows.get(self.arg) is None:
+                _render_nodes(self.children, ctx, out)
+        else:
+            for item in ctx.rows.get(self.arg) or ():
+                ctx.items.append(item)
+                _render_nodes(self.children, ctx, out)
+                ctx.items.pop()
+
+def _render_nodes(nodes, ctx, out):
+    for node in nodes:
+        if node.__class__ is bytes:
+            out.append(node)
+        else:
+            node.render(ctx, out)
 
-    fill_static_row_if_present(
-        avslut,
-        all_elevators,
-        key="prl",
-        value_filter=lambda v: bool(v.strip()),
-        placeholder="{{prl_group}}",
-        text_template="Följande hissar skall ha prioriterad körning: {}."
-    )
+class TemplatePlan:
+    """
+    Kompilerad mall. Byggs av compile_template_plan på en kopia av mallen och
+    renderar sedan brödtexten och sidhuvudena direkt som XML; resultatet ska
+    vara identiskt med motsvarande anrop via python-docx (remove_rows_for_placeholders,
+    fill_group_headings_dynamic, replace_placeholder_row, fill_placeholders_in_doc).
+    """
 
-    fill_static_row_if_present(
-        avslut,
-        all_elevators,
-        key="ebd_emergency_battery_drive",
-        value_filter=lambda v: bool(v.strip()),
-        placeholder="{{ebd_emergency_battery_drive_group}}",
-        text_template="Automatisk nödsänkning krävs för följande hissar: {}."
-    )
+    def __init__(self, nodes, headers, slots):
+        self.nodes = nodes
+        self.headers = headers  # partnamn -> noder, för sidhuvuden med platshållare
+        self.slots = slots
+
+    def render(self, doc, data, suppress_keys=None, drop_optional_rows=True, rows=None):
+        """
+        Fyller `doc` (en kopia av samma mall) med `data` och returnerar det ifyllda
+        dokumentet; använd returvärdet, eftersom document.xml byts ut i sin helhet.
+        `rows` ger texterna per upprepad rad:
+        {"{{section_heading}}": rubriker, "{{..._group}}": regeltexter eller None}.
+        """
+        with stage("fill_placeholders"):
+            replacements_for = _placeholder_replacements(data, suppress_keys)
+            ctx = _RenderContext(data, replacements_for, drop_optional_rows, rows or {})
+            rendered_headers = set()
+            for section in doc.sections:
+                part = section.header.part
+                nodes = self.headers.get(part.partname)
+                if nodes is not None and part.partname not in rendered_headers:
+                    part._element = self._render_part(nodes, ctx)
+                    rendered_headers.add(part.partname)
+            # Att flytta in den renderade brödtexten i det gamla trädet kostar mer
+            # än själva renderingen; hela rotelementet byts i stället
+            doc.part._element = self._render_part(self.nodes, ctx)
+        return doc.part.document
+
+    @staticmethod
+    def _render_part(nodes, ctx):
+        out = []
+        _render_nodes(nodes, ctx, out)
+        return parse_xml(b"".join(out))
+
+class _PlanCompiler:
+    def __init__(self, doc):
+        self.doc = doc
+        self.index = PlaceholderIndex(doc)
+        self.slots = []
+        self._conditional_rows = set()
+
+    def _add_slot(self, slot):
+        self.slots.append(slot)
+        return str(len(self.slots) - 1)
+
+    def _wrap(self, tr, kind, arg):
+        slot = self._add_slot(_Block(kind, arg))
+        begin = etree.PI("rfq-begin", slot)
+        tr.addprevious(begin)
+        tr.addnext(etree.PI("rfq-end", slot))
+        return begin
+
+    def _mark_run(self, r, slot):
+        r.clear_content()
+        r.append(etree.PI("rfq-run", self._add_slot(slot)))
+
+    def optional_rows(self, keys):
+        norm_keys = {normalize_key(k) for k in keys}
+        for row, row_keys in _rows_with_placeholders(self.doc, norm_keys, self.index):
+            self._wrap(row._tr, "optional", tuple(row_keys))
+            self._conditional_rows.add(row._tr)
+
+    def repeated_row(self, placeholder, replace):
+        """Kör `replace` (som byter raden mot en ny rad per text) med en markör som enda text."""
+        found = self.index.first_cell(placeholder)
+        if found is None:
+            return
+        _, tr, _ = found
+        if tr in self._conditional_rows:
+            # Raden kan redan vara borttagen när steget körs
+            raise TemplatePlanError(f"{placeholder} ligger i en rad som tas bort villkorligt")
+        begin = self._wrap(tr, "unless", placeholder)
+        rows_before = set(found[0].iterchildren(W_TR))
+        replace(PLAN_SENTINEL.format(len(self.slots)))
+        new_rows = [new_tr for new_tr in found[0].iterchildren(W_TR) if new_tr not in rows_before]
+        if len(new_rows) != 1:
+            raise TemplatePlanError(f"Oväntad radstruktur för {placeholder}")
+        self._wrap(new_rows[0], "repeat", placeholder)
+        # Originalraden ligger kvar i planen men renderas bara när regeln inte gav några rader
+        begin.addnext(tr)
+        self.index.add_row(tr)
+        self._conditional_rows.add(tr)
+
+    def _mark_paragraph(self, paragraph):
+        runs = paragraph.runs
+        texts = [run.text for run in runs]
+        full_text = "".join(texts)
+        if "\ue000" in full_text:
+            raise TemplatePlanError("Platshållare i en upprepad rubrik- eller regelrad")
+        matches = list(PLACEHOLDER_PATTERN.finditer(full_text))
+        if not matches:
+            return
+        slot = _ParagraphSlot(texts, full_text, matches)
+        for k in _splice_run_texts(texts, matches, [""] * len(matches)):
+            self._mark_run(runs[k]._r, _RunSlot(slot, k))
 
-    fill_dynamic_text_rows(
-        avslut,
-        all_elevators,
-        key="door_type",
-        placeholder="{{door_type_group}}",
-        singular_template="Schaktdörr skall vara av typ {} och med dagöppningar motsvarande korgdörrar.",
-        grouped_template="Hissar med beteckning {} skall ha schaktdörr av typ {}, med dagöppningar motsvarande korgdörrar.",
-        passive_template="Hissar med beteckning {} saknar angiven schaktdörrstyp."
-    )
+    def _header_paragraphs(self, header):
+        # Samma stycken, i samma ordning, som _fill_header_placeholders går igenom
+        paragraphs = list(header.paragraphs)
+        for table in header.tables:
+            for row in table.rows:
+                for cell in row.cells:
+                    paragraphs.extend(cell.paragraphs)
+        seen = set()
+        for paragraph in paragraphs:
+            if paragraph._p not in seen and _may_contain_placeholder(paragraph._p):
+                seen.add(paragraph._p)
+                yield paragraph
+
+    def finish(self):
+        for p in self.index.paragraphs():
+            self._mark_paragraph(Paragraph(p, self.doc._body))
+
+        for t in list(self.doc.element.body.iter(W_T)):
+            if t.text and "\ue000" in t.text:
+                r = t.getparent()
+                text = r.text
+                start, end = text.index("\ue000"), text.index("\ue001") + 1
+                self._mark_run(r, _ItemSlot(text[:start], text[end:]))
+
+        headers = {}
+        for section in self.doc.sections:
+            header = section.header
+            partname = header.part.partname
+            if partname in headers:
+                continue
+            marked = len(self.slots)
+            for paragraph in self._header_paragraphs(header):
+                self._mark_paragraph(paragraph)
+            headers[partname] = self._split(header.part.element) if len(self.slots) > marked else None
+        headers = {partname: nodes for partname, nodes in headers.items() if nodes is not None}
+
+        return TemplatePlan(self._split(self.doc.element), headers, len(self.slots))
+
+    def _split(self, element):
+        """Delar upp elementets XML i statiska fragment och luckor vid markörerna."""
+        nodes = [[]]
+        blocks = []
+        pieces = PLAN_MARKER.split(etree.tostring(element, encoding="UTF-8"))
+        nodes[-1].append(pieces[0])
+        for i in range(1, len(pieces), 3):
+            kind, slot = pieces[i], self.slots[int(pieces[i + 1])]
+            if kind == b"begin":
+                nodes[-1].append(slot)
+                blocks.append(slot)
+                nodes.append(slot.children)
+            elif kind == b"end":
+                if blocks.pop() is not slot:
+                    raise TemplatePlanError("Överlappande block i mallen")
+                nodes.pop()
+            else:
+                nodes[-1].append(slot)
+            if pieces[i + 2]:
+                nodes[-1].append(pieces[i + 2])
+        return nodes[0]
 
-    fill_dynamic_text_rows(
-        avslut,
-        all_elevators,
-        key="landing_door_model",
-        placeholder="{{landing_door_model_group}}",
-        singular_template="Schaktdörrar skall vara utförda och konstruerade för minst {} cykler (öppning och stängning) per år.",
-        grouped_template="Schaktdörrar i hissar med beteckning {} skall vara utförda och konstruerade för minst {} cykler (öppning och stängning) per år."
-    )
+def compile_template_plan(doc, optional_rows_first=(), headings=False, row_placeholders=(), optional_rows_last=()):
+    """
+    Bygger en TemplatePlan av `doc` (som ändras) genom att köra samma steg som
+    renderingen i samma ordning: valfria rader, grupprubriker, radregler och
+    valfria rader igen, sedan platshållarna.
+    """
+    compiler = _PlanCompiler(doc)
+    if optional_rows_first:
+        compiler.optional_rows(optional_rows_first)
+    if headings:
+        compiler.repeated_row("{{section_heading}}",
+                              lambda text: fill_group_headings_dynamic(doc, [text], index=compiler.index))
+    for placeholder in row_placeholders:
+        compiler.repeated_row(placeholder,
+                              lambda text: replace_placeholder_row(doc, placeholder, [text], compiler.index))
+    if optional_rows_last:
+        compiler.optional_rows(optional_rows_last)
+    return compiler.finish()
+
+def _compile_master_plan(doc):
+    return compile_template_plan(doc, optional_rows_first=OPTIONAL_ROW_PLACEHOLDERS, headings=True)
+
+def _compile_page_plan(doc):
+    return compile_template_plan(doc)
+
+def _compile_avslut_plan(doc):
+    return compile_template_plan(doc, row_placeholders=[rule["placeholder"] for rule in AVSLUT_ROW_RULES],
+                                 optional_rows_last=OPTIONAL_ROW_PLACEHOLDERS)
+
+def _template_plan(path, prepare, compile):
+    """Mallens renderingsplan, eller None när ifyllnaden ska gå via python-docx."""
+    cache = active_template_cache()
+    if not RENDER_PLANS or cache.lazy:
+        return None
+    return cache.plan(path, prepare, compile)
+
+def prepare_page_template(doc):
+    """
+    Den del av städningen av hissida och avslut som inte beror på hissdata.
+    Körs en gång per inläst mall via TemplateCache i stället för per sida.
+    """
+    remove_different_first_page(doc)
+    remove_empty_paragraphs_before_first_table(doc)
+    remove_paragraphs_with_drawing_no_text_raw(doc)
+    clear_headers_and_footers(doc)
+    return doc
 
-    fill_dynamic_text_rows(
-        avslut,
-        all_elevators,
-        key="finishing_a",
-        placeholder="{{finishing_a_group}}",
-        singular_template="Schaktdörrar för hiss skall vara av typ {}.",
-        grouped_template="Hissar med beteckning {} skall ha schaktdörrar av typ {}.",
-        passive_template="Hissar med beteckning {} saknar angiven typ för schaktdörr."
-    )
+def render_hissida(master, hissida_path, elevator, global_data):
+    """En hissida för en hissgrupp, klar att läggas till efter huvudmallen."""
+    return _render_hissida(hissida_path, elevator, global_data, section_margins(master))
 
-    fill_dynamic_text_rows(
-        avslut,
-        all_elevators,
-        key=("landing_door_frame_front", "finishing_a"),
-        placeholder="{{landing_door_frame_front_group}}",  # Vi ersätter bara den ena, men båda behövs
-        singular_template="För hiss monteras schaktdörrar i {} utförande, samt skall vara av material {}.",
-        grouped_template="Hissar med beteckning {} skall ha schaktdörrar i {} utförande och av material {}.",
-        passive_template="Hissar med beteckning {} saknar angivet dörrkarm- eller materialutförande."
-    )
+def _render_hissida(hissida_path, elevator, global_data, margins, shell=None):
+    """
+    `shell` är ett dokument av samma mall som får återanvändas: en
+    renderingsplan byter bara document.xml, så hela mallen behöver inte kopieras
+    per sida. Det returnerade dokumentet gäller då bara till nästa rendering.
+    """
+    combined_data = {**global_data, **elevator}
+    plan = _template_plan(hissida_path, prepare_page_template, _compile_page_plan)
+    if plan is not None:
+        if shell is None or plan.headers:
+            shell = load_template(hissida_path, prepare_page_template)
+        doc = plan.render(shell, combined_data)
+    else:
+        doc = load_template(hissida_path, prepare_page_template)
+        fill_placeholders_in_doc(doc, combined_data)
+    apply_margins(doc, margins)
+    insert_section_break_next_page(doc)
+    return doc
 
-    fill_dynamic_text_rows(
-        avslut,
-        all_elevators,
-        key=("sill_type_a", "landing_door_sill_material"),
-        placeholder="{{sill_type_a_group}}",  # Vi använder bara en placeholder för radmatchning
-        singular_template="Trösklar skall utföras med placering {} med tröskelprofil i {}.",
-        grouped_template="Hissar med beteckning {} skall ha trösklar utförda med placering {} med tröskelprofil i {}.",
-        passive_template="Hissar med beteckning {} saknar uppgift om tröskeltyp eller material."
-    )
+def render_avslut(master, avslut_path, all_elevators, global_data, table: ElevatorTable = None):
+    """Avslutningsdelen → använd alla individuella hissar"""
+    avslut = load_template(avslut_path, prepare_page_template)
+    combined_all = merge_elevator_data(all_elevators, global_data)
+    suppress_keys = ["prl", "ebd_emergency_battery_drive"]
 
-    fill_dynamic_text_rows(
-        avslut,
-        all_elevators,
-        key="signalisation_series",
-        placeholder="{{signalisation_series_group}}",
-        singular_template="Manöver- och indikeringsdon i hissarna skall vara av typ {}.",
-        grouped_template="Hissar med beteckning {} skall ha manöver- och indikeringsdon av typ {}.",
-        passive_template="Hissar med beteckning {} saknar angiven typ av manöver- och indikeringsdon."
-    )
+    plan = _template_plan(avslut_path, prepare_page_template, _compile_avslut_plan)
+    if plan is not None:
+        with stage("avslut_rules"):
+            rows = row_rule_texts(all_elevators, AVSLUT_ROW_RULES, table=table)
+        avslut = plan.render(avslut, combined_all, suppress_keys=suppress_keys, rows=rows)
+    else:
+        avslut_index = PlaceholderIndex(avslut)
+        fill_avslut_rows(avslut, all_elevators, index=avslut_index, table=table)
 
-    fill_dynamic_text_rows(
-        avslut,
-        all_elevators,
-        key=("lcs_lci_material", "cop_face_plate_material"),
-        placeholder="{{cover_plate_materials_group}}",
-        singular_template="Täcklock för anrop skall vara av material {}, täcklock för tryckknappspanel i korg skall vara av material {}.",
-        grouped_template="Hissar med beteckning {} skall ha täcklock för anrop av material {}, och täcklock för tryckknappspanel i korg av material {}.",
-        passive_template="Hissar med beteckning {} saknar angivet material för täcklock vid anrop eller i korg."
-    )
+        # Sammanfoga och fyll i resterande placeholders
+        placeholders_to_check = OPTIONAL_ROW_PLACEHOLDERS
+        remove_rows_for_placeholders(avslut, placeholders_to_check, combined_all, index=avslut_index)
+        fill_placeholders_in_doc(avslut, combined_all, suppress_keys=suppress_keys, index=avslut_index)
+    copy_margins_from_template(master, avslut)
+    return avslut
 
-    fill_dynamic_text_rows(
-        avslut,
-        all_elevators,
-        key="control_system",
-        placeholder="{{control_system_group}}",
-        singular_template="Hissar skall ha styrning för {}.",
-        grouped_template="Hissar med beteckning {} skall ha styrning för {}.",
-        passive_template="Hissar med beteckning {} saknar angiven styrningstyp."
-    )
+def fallback_placeholders(parts, elevator_groups, all_elevators, global_data):
+    """
+    Platshållare som genereringen skulle fylla i med "fyll i manuellt", utan att
+    rendera något. `parts` är platshållarna i (huvudmall, hissida, avslut) som
+    (mallnamn, template_placeholders(mall)). Returnerar en lista med template, placeholder
+    och groups (1-baserade gruppnummer; tom för avslutet som gäller alla hissar).
+    """
+    (master_name, master_keys), (hissida_name, hissida_keys), (avslut_name, avslut_keys) = parts
+    global_data = dict(global_data, datum=datetime.today().strftime("%Y-%m-%d"))
+    row_placeholders = {"{{section_heading}}"} | {rule["placeholder"] for rule in AVSLUT_ROW_RULES}
+    optional = {normalize_key(k) for k in OPTIONAL_ROW_PLACEHOLDERS}
+    drop_optional_rows = placeholders_missing_in_all_elevators(OPTIONAL_ROW_PLACEHOLDERS, all_elevators)
+
+    pages = [(master_name, master_keys, 1, {**global_data, **elevator_groups[0]})]
+    pages += [(hissida_name, hissida_keys, i, {**global_data, **group})
+              for i, group in enumerate(elevator_groups[1:], start=2)]
+    pages.append((avslut_name, avslut_keys, None, merge_elevator_data(all_elevators, global_data)))
+    # Valfria rader tas bort när ingen hiss har värden (hissidan har inga) och töms alltid i avslutet
+    drops_rows = {master_name: drop_optional_rows, hissida_name: False, avslut_name: drop_optional_rows}
+
+    missing = {}
+    for name, placeholders, group, data in pages:
+        available = {normalize_key(k) for k in data}
+        for placeholder, optional_only in placeholders.items():
+            key = normalize_key(placeholder[2:-2])
+            if placeholder in row_placeholders or key in available:
+                continue
+            if (optional_only and drops_rows[name]) or (key in optional and (drops_rows[name] or name == avslut_name)):
+                continue
+            groups = missing.setdefault((name, placeholder), [])
+            if group is not None:
+                groups.append(group)
+    return [{"template": name, "placeholder": placeholder, "groups": groups}
+            for (name, placeholder), groups in missing.items()]
+
+def _cached_fragment(fragment_cache, key_inputs, render, copy_doc=False):
+    """Hämtar en renderad del ur fragmentcachen eller renderar (och sparar) den."""
+    with stage(key_inputs[0]):
+        return _lookup_or_render(fragment_cache, key_inputs, render, copy_doc)
+
+def _lookup_or_render(fragment_cache, key_inputs, render, copy_doc):
+    if fragment_cache is None:
+        return render(), False
+    key = FragmentCache.key(*key_inputs)
+    doc = fragment_cache.get(key, copy_doc=copy_doc)
+    if doc is not None:
+        return doc, True
+    doc = render()
+    fragment_cache.put(key, doc, copy_doc=copy_doc)
+    return doc, False
+
+def generate_final_doc(template_path, elevator_groups, all_elevators, hissida_path, avslut_path, translation_dict, group_defs, global_data=None, output_path=None, fragment_cache=None, elevator_table=None, page_pool=None):
+    """
+    Bygger hela RFQ-dokumentet. `output_path` kan vara en sökväg eller en
+    skrivbar ström (t.ex. io.BytesIO); utan den sparas till output/komplett_rfqdokument.docx.
+    Med en FragmentCache återanvänds huvudmall, hissidor och avslut vars indata
+    inte ändrats sedan förra genereringen. En ElevatorTable över `all_elevators`
+    som redan använts för grupperingen kan skickas med och återanvänds då.
+    Med en PagePool fylls hissidorna i parallellt och sätts ihop i ordning här.
+    """
+    # Skapa dynamiska grupprubriker från group_defs
+    group_headings = []
+    for i, group in enumerate(group_defs):
+        names = [e.strip().split()[0].upper() for e in group.get("hissbeteckning", "").split(",") if e.strip()]
+        if names:
+            if len(names) == 1:
+                heading = f"Grupp {i+1}: {names[0]}"
+            else:
+                heading = f"Grupp {i+1}: {names[0]}–{names[-1]}"
+            group_headings.append(heading)
 
-    fill_dynamic_text_rows(
-        avslut,
-        all_elevators,
-        key="lcs_lci_placement",
-        placeholder="{{lcs_lci_placement_group}}",
-        singular_template="Anropsknapp, var med hiss kan kallas till stannplanet, skall placeras vid sidan av schaktdörr. Anropsknappar skall placeras {}.",
-        grouped_template="Hissar med beteckning {} skall ha anropsknapp, var med hiss kan kallas till stannplanet, placerad vid sidan av schaktdörr. Anropsknappar skall placeras {}.",
-        passive_template="Hissar med beteckning {} saknar angiven placering för anropsknappar."
-    )
+    if global_data is None:
+        global_data = {}
+    global_data["datum"] = datetime.today().strftime("%Y-%m-%d")
 
-    fill_dynamic_text_rows(
-        avslut,
-        all_elevators,
-        key="wall_b_finishing",
-        placeholder="{{wall_b_finishing_group}}",
-        singular_template="Korgväggar i hiss skall vara av typ {}.",
-        grouped_template="Hissar med beteckning {} skall ha korgväggar av typ {}.",
-        passive_template="Hissar med beteckning {} saknar angiven typ för korgväggar."
+    # Gemensamt för alla delar: mallarnas och översättningarnas innehåll samt koden
+    sources = []
+    if fragment_cache is not None:
+        # Översättningarna räknas på den inlästa tabellen (refresh läser om den vid behov)
+        sources = [file_content_hash(path) for path in (template_path, hissida_path, avslut_path, os.path.abspath(__file__))]
+        sources.append(translation_store.refresh())
+
+    drop_optional_rows = placeholders_missing_in_all_elevators(OPTIONAL_ROW_PLACEHOLDERS, all_elevators)
+    master, reused = _cached_fragment(
+        fragment_cache,
+        ("master", sources, elevator_groups[0], group_headings, global_data, drop_optional_rows),
+        lambda: render_master(template_path, elevator_groups[0], group_headings, global_data, drop_optional_rows),
+        copy_doc=True,
     )
+    reused_count = int(reused)
 
+    page_xml = None
+    if page_pool is not None and len(elevator_groups) > 2:
+        # Hissidorna fylls i av poolen medan avslutet renderas här; de går då förbi fragmentcachen
+        page_xml = page_pool.render(hissida_path, elevator_groups[1:], global_data, section_margins(master))
 
+    avslut, reused = _cached_fragment(
+        fragment_cache,
+        ("avslut", sources, all_elevators, global_data),
+        lambda: render_avslut(master, avslut_path, all_elevators, global_data, table=elevator_table),
+    )
+    reused_count += reused
 
-    # Sammanfoga och fyll i resterande placeholders
-    combined_all = merge_elevator_data(all_elevators, global_data)
-    remove_rows_for_placeholders(avslut, placeholders_to_check, combined_all)
-    fill_placeholders_in_doc(avslut, combined_all, suppress_keys=["prl", "ebd_emergency_battery_drive"])
-    copy_margins_from_template(master, avslut)
-    composer.append(avslut)
+    composer = Composer(master)
+    pages = RepeatedPageComposer(composer)
+
+    if page_xml is None:
+        margins = section_margins(master)
+        # Utan fragmentcache sparas inga sidor, så alla renderas i samma skal
+        # (se _render_hissida); RepeatedPageComposer klonar kroppen innan nästa
+        reuse_shell = fragment_cache is None or fragment_cache.max_entries <= 0
+        shell = None
+        for elevator in elevator_groups[1:]:
+            if reuse_shell:
+                with stage("hissida"):
+                    doc = shell = _render_hissida(hissida_path, elevator, global_data, margins, shell)
+            else:
+                doc, reused = _cached_fragment(
+                    fragment_cache,
+                    ("hissida", sources, elevator, global_data),
+                    lambda: _render_hissida(hissida_path, elevator, global_data, margins),
+                )
+                reused_count += reused
+            with stage("compose"):
+                pages.append(doc)
+    else:
+        # Varje sida läses in i samma skal; RepeatedPageComposer klonar kroppen innan nästa
+        shell = load_template(hissida_path, prepare_page_template)
+        for xml in page_xml:
+            with stage("hissida"):
+                shell.part._element = parse_xml(xml)
+            with stage("compose"):
+                pages.append(shell.part.document)
+    with stage("compose"):
+        pages.finish()
+
+    with stage("compose"):
+        composer.append(avslut)
+
+    with stage("finalize"):
+        _finalize_composed(composer, len(elevator_groups))
+
+    if output_path is None:
+        output_path = default_output_path()
+
+    with stage("save"):
+        save_document(composer.doc, output_path)
+
+    if fragment_cache is not None:
+        logger.debug("Återanvände %d av %d delar från fragmentcachen.", reused_count, len(elevator_groups) + 1)
+    logger.info("Dokument klart: Huvudmall + %d hissidor + avslutningsmall.", len(elevator_groups))
+    return output_path
 
+def _finalize_composed(composer, group_count):
+    """Länkar sidhuvud/sidfot till föregående sektion och fyller i sidantalet."""
     try:
         for i in range(1, len(composer.doc.sections)):
             section = composer.doc.sections[i]
             section.header.is_linked_to_previous = True
             section.footer.is_linked_to_previous = True
     except Exception as e:
-        print(f" Kunde inte länka sektioner till föregående: {e}")
-
-    base_dir = os.path.dirname(os.path.abspath(__file__))  # Mapp där RFQ_GIT.py ligger
-    output_dir = os.path.join(base_dir, "output")
-    os.makedirs(output_dir, exist_ok=True)  # Skapar mappen om den inte finns
-
-    output_path = os.path.join(output_dir, "komplett_rfqdokument.docx")
+        logger.warning("Kunde inte länka sektioner till föregående: %s", e)
 
-    total_pages = 7 + (len(elevator_groups) - 1) + 18
+    total_pages = 7 + (group_count - 1) + 18
     for para in composer.doc.paragraphs:
         if "{{numpag}}" in para.text:
             for run in para.runs:
                 run.text = run.text.replace("{{numpag}}", str(total_pages))
 
-    composer.save(output_path)
+class RFQGenerator:
+    """
+    Återanvändbar generator: läser in översättningstabellen en gång och kan
+    sedan anropas för flera XML-filer i samma process (t.ex. från app.py).
+    Med one_shot=True (CLI:t) får generatorn en egen lat mallcache som inte
+    förladdar något och lämnar ut första inläsningen utan kopia, och ingen
+    fragmentcache byggs; andra generatorer i processen påverkas inte. Mallar som
+    projektet inte behöver (t.ex. hissida.docx för en enda grupp) läses aldrig.
+    Med page_workers > 0 fylls hissidorna i av en PagePool med så många processer.
+    """
 
-    print(f" Dokument klart: Huvudmall + {len(elevator_groups)} hissidor + avslutningsmall.")
-    return output_path
+    def __init__(self, base_path=BASE_PATH, result_cache: ResultCache = None, fragment_cache: FragmentCache = None,
+                 one_shot=False, page_workers=0):
+        self.result_cache = result_cache
+        if fragment_cache is None:
+            # Delar av dokumentet återanvänds mellan anrop (t.ex. reviderade XML-filer)
+            fragment_cache = FragmentCache(max_entries=0 if one_shot else 64)
+        self.fragment_cache = fragment_cache
+        self.template_cache = TemplateCache(lazy=True) if one_shot else template_cache
+        self.template_path = os.path.join(base_path, TEMPLATE_FILE)
+        self.translation_path = os.path.join(base_path, TRANSLATION_FILE)
+        self.hissida_path = os.path.join(base_path, HISSIDA_FILE)
+        self.avslut_path = os.path.join(base_path, AVSLUT_FILE)
+
+        for path in (self.template_path, self.translation_path, self.hissida_path, self.avslut_path):
+            if not os.path.exists(path):
+                raise RFQError(f"Mallfil saknas: {path}", stage="templates")
+
+        try:
+            self.translation_dict, _ = set_translation_file(self.translation_path).load()
+            self.template_cache.preload(self.template_path)
+            self.template_cache.preload(self.hissida_path, self.avslut_path, prepare=prepare_page_template)
+        except Exception as e:
+            raise RFQError(f"Kunde inte läsa mallar eller översättningstabell: {e}", stage="templates") from e
+
+        self.page_pool = None
+        if page_workers:
+            # Planen kompileras före start så att arbetarprocesserna ärver den
+            with self.template_cache.activate():
+                _template_plan(self.hissida_path, prepare_page_template, _compile_page_plan)
+            self.page_pool = PagePool(page_workers)
+
+    def warm_up(self):
+        """
+        Kompilerar renderingsplaner och platshållarlistor för alla mallar i
+        förväg, t.ex. i en server som sedan forkar arbetare som delar dem.
+        """
+        for path, prepare, compile in ((self.template_path, None, _compile_master_plan),
+                                       (self.hissida_path, prepare_page_template, _compile_page_plan),
+                                       (self.avslut_path, prepare_page_template, _compile_avslut_plan)):
+            with self.template_cache.activate():
+                _template_plan(path, prepare, compile)
+            self.template_cache.placeholders(path, prepare)
+
+    def extract(self, xml_source):
+        try:
+            with stage("extract"):
+                elevators, global_data, group_defs = extract_project(xml_source)
+        except (ET.ParseError, OSError) as e:
+            raise RFQInputError(f"Kunde inte läsa XML-filen: {e}") from e
+        if not elevators:
+            raise RFQInputError("Inga hissar hittades i XML-filen.")
+        return elevators, global_data, group_defs
+
+    def preview(self, xml_source, report: StageReport = None):
+        """
+        Bara extraktion och gruppering: hissar, globala data, gruppdefinitioner,
+        spec-grupper och platshållare som skulle bli "fyll i manuellt". Inget dokument byggs.
+        """
+        with self.template_cache.activate():
+            if report is None:
+                return self._preview(xml_source)
+            with report.activate():
+                return self._preview(xml_source)
+
+    def _preview(self, xml_source):
+        elevators, global_data, group_defs = self.extract(xml_source)
+        with stage("group"):
+            spec_groups = group_elevators_by_spec(elevators)
+        with stage("placeholders"):
+            parts = [
+                (os.path.basename(path), self.template_cache.placeholders(path, prepare))
+                for path, prepare in ((self.template_path, None),
+                                      (self.hissida_path, prepare_page_template),
+                                      (self.avslut_path, prepare_page_template))
+            ]
+            manual = fallback_placeholders(parts, spec_groups, elevators, global_data)
+        return {
+            "elevators": elevators,
+            "global_data": global_data,
+            "group_defs": group_defs,
+            "spec_groups": spec_groups,
+            "manual_placeholders": manual,
+        }
+
+    def generate(self, xml_source, output_path=None, report: StageReport = None):
+        """
+        `xml_source` och `output_path` kan vara sökvägar eller filobjekt. Med en
+        StageReport mäts tid och anrop per steg för just den här genereringen.
+        """
+        with self.template_cache.activate():
+            if report is None:
+                return self._generate(xml_source, output_path)
+            with report.activate():
+                return self._generate(xml_source, output_path)
+
+    def _generate(self, xml_source, output_path):
+        elevators, global_data, group_defs = self.extract(xml_source)
+        report = _active_report.get()
+        if report is not None:
+            report.info["elevators"] = len(elevators)
+        translation_hash = translation_store.refresh()
+
+        if self.result_cache is None:
+            return self._generate_document(elevators, global_data, group_defs, output_path)
+
+        with stage("result_cache"):
+            key = ResultCache.key(elevators, global_data, group_defs, self.dependencies(translation_hash))
+            document = self.result_cache.get(key)
+        if report is not None:
+            report.info["result_cache_hit"] = document is not None
+        if document is None:
+            buffer = io.BytesIO()
+            self._generate_document(elevators, global_data, group_defs, buffer)
+            document = buffer.getvalue()
+            # Lästes tabellen om under genereringen stämmer dokumentet inte säkert med nyckeln
+            if translation_store.refresh() == translation_hash:
+                self.result_cache.put(key, document)
+        else:
+            logger.info("Dokument hämtat från resultatcachen.")
+        return write_output(document, output_path)
+
+    def dependency_paths(self):
+        """Filer vars innehåll påverkar resultatet (mallar och koden; översättningarna se dependencies)."""
+        return [self.template_path, self.hissida_path, self.avslut_path, os.path.abspath(__file__)]
+
+    def dependencies(self, translation_hash=None):
+        """Innehållshashar för resultatcachens nyckel: filerna ovan plus den inlästa översättningstabellen."""
+        if translation_hash is None:
+            translation_hash = translation_store.refresh()
+        return [file_content_hash(path) for path in self.dependency_paths()] + [translation_hash]
+
+    def _generate_document(self, elevators, global_data, group_defs, output_path):
+        with stage("group"):
+            elevator_table = ElevatorTable(elevators)
+            elevator_groups = group_elevators_by_spec(elevators, table=elevator_table)
+        report = _active_report.get()
+        if report is not None:
+            report.info["groups"] = len(elevator_groups)
+
+        try:
+            return generate_final_doc(
+                self.template_path,
+                elevator_groups,
+                elevators,
+                self.hissida_path,
+                self.avslut_path,
+                self.translation_dict,
+                group_defs,
+                global_data,
+                output_path=output_path,
+                fragment_cache=self.fragment_cache,
+                elevator_table=elevator_table,
+                page_pool=self.page_pool,
+            )
+        except Exception as e:
+            raise RFQError(f"Kunde inte generera dokumentet: {e}") from e
+
+    def close(self):
+        if self.page_pool is not None:
+            self.page_pool.close()
+            self.page_pool = None
+
+    def generate_bytes(self, xml_bytes, report: StageReport = None):
+        """Extraktion och generering helt i minnet: XML-bytes in, docx som BytesIO ut."""
+        document = io.BytesIO()
+        self.generate(io.BytesIO(xml_bytes), document, report=report)
+        document.seek(0)
+        return document
+
+# --- Parallella hissidor ---
+
+_page_shells = {}  # hissida-sökväg -> (mallsignatur, dokument) i arbetarprocesserna
+
+def _init_page_worker():
+    # Arbetarna renderar många sidor var, så de använder den gemensamma cachen med
+    # planer även om föräldern forkade dem med en lat cache aktiv
+    configure_logging(os.environ.get("RFQ_LOG_LEVEL", "WARNING"))
+    _active_templates.set(None)
+
+def _warm_page_worker():
+    return os.getpid()
+
+def _page_shell(hissida_path):
+    signature = TemplateCache._signature(hissida_path)
+    entry = _page_shells.get(hissida_path)
+    if entry is None or entry[0] != signature:
+        entry = (signature, load_template(hissida_path, prepare_page_template))
+        _page_shells[hissida_path] = entry
+    return entry[1]
+
+def _render_hissida_xml(hissida_path, elevators, global_data, margins):
+    """Renderar en följd hissidor i en arbetarprocess; document.xml per sida som bytes."""
+    translation_store.refresh()  # Arbetaren har en egen kopia av tabellen sedan fork
+    shell = _page_shell(hissida_path)
+    return [etree.tostring(_render_hissida(hissida_path, elevator, global_data, margins, shell).element)
+            for elevator in elevators]
+
+class PagePool:
+    """
+    Processpool som fyller i hissidorna för ett dokument parallellt. Varje
+    arbetare renderar en följd sidor och skickar tillbaka deras document.xml;
+    sammanfogningen i rätt ordning sker i generate_final_doc. Processerna
+    startas direkt (innan servern startar trådar) så att de ärver inlästa mallar.
+    Sidorna renderas i ett återanvänt skal även i tur och ordning, så poolen
+    lönar sig bara med flera lediga kärnor (se benchmark.py pages).
+    """
+
+    def __init__(self, workers, chunks_per_worker=2):
+        self.workers = workers
+        self.chunks_per_worker = chunks_per_worker
+        self._executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_page_worker)
+        for future in [self._executor.submit(_warm_page_worker) for _ in range(workers)]:
+            future.result()
+
+    def render(self, hissida_path, elevators, global_data, margins):
+        """Skickar sidorna till poolen och returnerar en iterator över document.xml i sidordning."""
+        size = -(-len(elevators) // (self.workers * self.chunks_per_worker))
+        futures = [
+            self._executor.submit(_render_hissida_xml, hissida_path, elevators[i:i + size], global_data, margins)
+            for i in range(0, len(elevators), size)
+        ]
+        return (xml for future in futures for xml in future.result())
+
+    def close(self):
+        self._executor.shutdown()
+
+# --- Batch ---
+
+_batch_generator = None
+
+def _init_batch_worker(base_path):
+    # Varje arbetarprocess läser in mallar och översättningstabell en gång;
+    # arbetarna loggar bara varningar om inte RFQ_LOG_LEVEL säger annat
+    global _batch_generator
+    configure_logging(os.environ.get("RFQ_LOG_LEVEL", "WARNING"))
+    _batch_generator = RFQGenerator(base_path)
+
+def _generate_batch_file(xml_path, output_path):
+    start = time.perf_counter()
+    try:
+        _batch_generator.generate(xml_path, output_path)
+        return xml_path, output_path, time.perf_counter() - start, None
+    except RFQError as e:
+        return xml_path, None, time.perf_counter() - start, f"{e.stage}: {e}"
+    except Exception as e:
+        # En trasig fil ska inte stoppa resten av körningen
+        return xml_path, None, time.perf_counter() - start, f"{type(e).__name__}: {e}"
+
+def run_batch(input_dir, output_dir, workers=None, base_path=BASE_PATH):
+    """
+    Genererar ett RFQ-dokument per XML-fil i `input_dir` över en processpool.
+    Resultatet skrivs till `output_dir/<filnamn>.docx`. Returnerar en lista med
+    (xml_path, output_path, sekunder, fel) per fil. Filer som skulle ge samma
+    utdatafil (t.ex. a.xml och a.XML) räknas som fel utom den första.
+    """
+    try:
+        names = sorted(name for name in os.listdir(input_dir) if name.lower().endswith(".xml"))
+    except OSError as e:
+        raise RFQInputError(f"Kunde inte läsa indatakatalogen: {e}") from e
+    # Mallar och översättningstabell kontrolleras här, innan några arbetare startas
+    RFQGenerator(base_path)
+    os.makedirs(output_dir, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+
+    results, jobs, claimed = [], [], {}
+    for name in names:
+        output_name = os.path.splitext(name)[0] + ".docx"
+        xml_path = os.path.join(input_dir, name)
+        # Jämförs utan skiftläge, så att det gäller även på skiftlägesokänsliga filsystem
+        if output_name.lower() in claimed:
+            error = f"{output_name} skulle skriva över resultatet för {claimed[output_name.lower()]}"
+            print(f" FEL {0:7.2f} s  {name}  – {error}")
+            results.append((xml_path, None, 0.0, error))
+            continue
+        claimed[output_name.lower()] = name
+        jobs.append((xml_path, os.path.join(output_dir, output_name)))
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker, initargs=(base_path,)) as pool:
+        futures = [pool.submit(_generate_batch_file, xml_path, output_path) for xml_path, output_path in jobs]
+        for future in as_completed(futures):
+            result = future.result()
+            xml_path, _, seconds, error = result
+            status = "OK " if error is None else "FEL"
+            print(f" {status} {seconds:7.2f} s  {os.path.basename(xml_path)}" + (f"  – {error}" if error else ""))
+            results.append(result)
+
+    return sorted(results)
+
+def batch_main(argv):
+    parser = argparse.ArgumentParser(prog="RFQ_GIT.py batch", description="Generera RFQ-dokument för en hel katalog med XML-filer")
+    parser.add_argument("input_dir")
+    parser.add_argument("output_dir")
+    parser.add_argument("--workers", type=int, default=None, help="antal arbetarprocesser (standard: antal kärnor)")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    try:
+        results = run_batch(args.input_dir, args.output_dir, args.workers)
+    except RFQError as e:
+        print(f" Fel ({e.stage}): {e}", file=sys.stderr)
+        return 1
+    except BrokenProcessPool as e:
+        print(f" Fel: en arbetarprocess avslutades oväntat ({e})", file=sys.stderr)
+        return 1
+    except OSError as e:
+        print(f" Fel: {e}", file=sys.stderr)
+        return 1
+    elapsed = time.perf_counter() - start
+
+    failures = [r for r in results if r[3] is not None]
+    busy = sum(r[2] for r in results)
+    print(f"\n {len(results)} filer, {len(results) - len(failures)} klara, {len(failures)} fel"
+          f" på {elapsed:.2f} s (summa per fil {busy:.2f} s, {len(results) / elapsed if elapsed else 0:.2f} filer/s)")
+    for xml_path, _, _, error in failures:
+        print(f"   {os.path.basename(xml_path)}: {error}")
+    return 1 if failures else 0
 
 # --- Main ---
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print(" Du måste ange XML-sökväg som argument.")
-        sys.exit(1)
-
-    xml_path = sys.argv[1]
+    configure_logging()
 
-    # Hårdkodade mallvägar (relativa till script)
-    base_path = os.path.join(os.path.dirname(__file__), "backend_data")
-    docx_file = os.path.join(base_path, "startmall lägga till rader.docx")
-    translation_file = os.path.join(base_path, "database_RFQ.xlsx")
-    hissida_path = os.path.join(base_path, "hissida.docx")
-    avslut_path = os.path.join(base_path, "avslutningsmall dynamisk ta bort delar.docx")
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        sys.exit(batch_main(sys.argv[2:]))
 
-    # Läs in översättningstabell
-    df = pd.read_excel(translation_file)
-    translation_dict = {
-        normalize_key(str(row["english"]).strip()): str(row["generic_swedish"]).strip()
-        for _, row in df.iterrows()
-        if pd.notna(row["english"]) and pd.notna(row["generic_swedish"])
-    }
+    if len(sys.argv) < 2:
+        print(" Du måste ange XML-sökväg som argument (eller: batch <indatakatalog> <utdatakatalog> [--workers N]).")
+        sys.exit(1)
 
-    # Kör extraktion och grupperingar
-    elevators, global_data = extract_multiple_elevators(xml_path)
-    group_defs = extract_elevator_groups_from_xml(xml_path)
-    elevator_groups = group_elevators_by_spec(elevators)
-
-    # Skicka in den sammansatta datan till dokumentgenerering
-    final_path = generate_final_doc(
-        docx_file,
-        elevator_groups,
-        elevators,
-        hissida_path,
-        avslut_path,
-        translation_dict,
-        group_defs,
-        global_data
-    )
+    parser = argparse.ArgumentParser(prog="RFQ_GIT.py", description="Generera ett RFQ-dokument från en XML-fil")
+    parser.add_argument("xml_path")
+    parser.add_argument("--report", metavar="FIL", help="skriv tid, anrop och minne per steg som JSON ('-' för stdout)")
+    parser.add_argument("--profile", metavar="FIL", help="spara en cProfile-dump av genereringen")
+    parser.add_argument("--page-workers", type=int, default=0, metavar="N",
+                        help="fyll i hissidorna parallellt i N processer (för projekt med många grupper på en maskin med flera kärnor)")
+    parser.add_argument("--extract", action="store_true",
+                        help="skriv bara tolkade hissar, grupper och platshållare utan värde som JSON (inget dokument)")
+    args = parser.parse_args()
+    xml_path = args.xml_path
+
+    if args.extract:
+        try:
+            preview = RFQGenerator(one_shot=True).preview(xml_path)
+        except RFQError as e:
+            print(f" Fel ({e.stage}): {e}", file=sys.stderr)
+            sys.exit(1)
+        print(json.dumps(preview, indent=2, ensure_ascii=False))
+        sys.exit(0)
+
+    report = StageReport()
+    profiler = None
+    generator = None
+    try:
+        generator = RFQGenerator(one_shot=True, page_workers=args.page_workers)
+        if args.profile:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        final_path = generator.generate(xml_path, report=report)
+    except RFQError as e:
+        print(f" Fel ({e.stage}): {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if generator is not None:
+            generator.close()
+
+    if args.report:
+        report_json = json.dumps(report.as_dict(), indent=2)
+        if args.report == "-":
+            print(report_json)
+        else:
+            with open(args.report, "w", encoding="utf-8") as f:
+                f.write(report_json + "\n")
 
     # Flytta utdata till samma katalog som XML-filen finns i
     output_path = os.path.join(os.path.dirname(xml_path), "komplett_rfqdokument.docx")
@@ -1,10 +1,48 @@
-from flask import Flask, request, render_template, send_file
+from flask import Flask, request, render_template, send_file, jsonify, url_for
+import io
 import os
-import tempfile
-import subprocess
+
+from RFQ_GIT import (RFQGenerator, RFQError, RFQInputError, ResultCache, StageReport, StageMetrics,
+                     configure_logging, memo_stats)
+from jobs import JobQueue, QueueFullError
 
 app = Flask(__name__)  # <- Denna rad måste finnas
 
+# Nivån styrs med RFQ_LOG_LEVEL (DEBUG, INFO, ...; TRACE visar varje enskilt värde)
+configure_logging()
+
+# Skapas en gång vid uppstart och återanvänds för varje uppladdning
+# Samma XML (och samma mallar) ger samma dokument; färdiga dokument cachas på disk
+result_cache = ResultCache(
+    max_bytes=int(os.environ.get('RFQ_CACHE_MAX_BYTES', 200 * 2**20)),
+    max_entries=int(os.environ.get('RFQ_CACHE_MAX_ENTRIES', 500)),
+)
+# RFQ_PAGE_WORKERS > 0 fyller i hissidorna för stora projekt i så många processer
+generator = RFQGenerator(result_cache=result_cache, page_workers=int(os.environ.get('RFQ_PAGE_WORKERS', 0)))
+
+# Tid per steg för alla genereringar (synkrona och jobb), se /api/metrics
+metrics = StageMetrics()
+
+DOCX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+
+# Asynkrona jobb för stora projekt; gränserna styrs med miljövariabler
+job_queue = JobQueue(
+    generator.generate_bytes,
+    metrics=metrics,
+    workers=int(os.environ.get('RFQ_JOB_WORKERS', 2)),
+    queue_depth=int(os.environ.get('RFQ_JOB_QUEUE_DEPTH', 8)),
+    result_ttl=int(os.environ.get('RFQ_JOB_RESULT_TTL', 3600)),
+    max_result_bytes=int(os.environ.get('RFQ_JOB_RESULT_MAX_MB', 64)) * 1024 * 1024,
+)
+
+
+def disable_job_api():
+    """Kön finns i minnet i en process; gunicorn.conf.py stänger av den med flera arbetare."""
+    global job_queue
+    if job_queue is not None:
+        job_queue.shutdown(wait=False)
+        job_queue = None
+
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
@@ -14,33 +52,120 @@ def index():
         if not xml_file:
             return " Ingen XML-fil bifogad.", 400
 
-        with tempfile.TemporaryDirectory() as tmpdir:
-            xml_path = os.path.join(tmpdir, 'input.xml')
+        # Allt sker i minnet: ingen temporär XML-fil och ingen utdatafil på disk
+        report = StageReport()
+        try:
+            document = generator.generate_bytes(xml_file.read(), report=report)
+        except RFQInputError as e:
+            metrics.add(failed=True)
+            return f" Ogiltig XML-fil:\n\n{e}", 400
+        except RFQError as e:
+            metrics.add(failed=True)
+            return f" Genereringen misslyckades ({e.stage}):\n\n{e}", 500
+        metrics.add(report)
 
-            # Skapa output-mapp i projektet
-            output_dir = os.path.join(os.getcwd(), 'output')
-            os.makedirs(output_dir, exist_ok=True)
+        response = send_file(document, as_attachment=True, download_name='komplett_rfqdokument.docx',
+                             mimetype=DOCX_MIMETYPE)
+        response.headers['Server-Timing'] = report.server_timing()
+        return response
 
-            xml_file.save(xml_path)
+    return render_template('form.html')
 
-            result = subprocess.run(
-                ['python', 'RFQ_GIT.py', xml_path, output_dir],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
 
-            if result.returncode != 0:
-                return f" RFQ_GIT.py misslyckades:\n\n{result.stderr}", 500
+@app.route('/api/extract', methods=['POST'])
+def extract_preview():
+    """Tolkade hissar och grupper som JSON, utan att bygga något dokument."""
+    xml_file = request.files.get('xml')
+    if not xml_file:
+        return jsonify(error="Ingen XML-fil bifogad."), 400
 
-            output_path = os.path.join(output_dir, 'komplett_rfqdokument.docx')
+    report = StageReport()
+    try:
+        preview = generator.preview(io.BytesIO(xml_file.read()), report=report)
+    except RFQError as e:
+        return jsonify(error=str(e), stage=e.stage), 400 if isinstance(e, RFQInputError) else 500
 
-            if not os.path.exists(output_path):
-                return " Dokumentet kunde inte genereras.", 500
+    response = jsonify(preview)
+    response.headers['Server-Timing'] = report.server_timing()
+    return response
 
-            return send_file(output_path, as_attachment=True)
 
-    return render_template('form.html')
+def _jobs_disabled():
+    return jsonify(error="Jobb-API:t är avstängt när servern kör flera arbetare; "
+                         "använd / eller starta gunicorn med -w 1."), 503
+
+
+def _job_links(job_id):
+    return {
+        'status_url': url_for('job_status', job_id=job_id),
+        'download_url': url_for('job_document', job_id=job_id),
+    }
+
+
+@app.route('/api/jobs', methods=['POST'])
+def create_job():
+    if job_queue is None:
+        return _jobs_disabled()
+    xml_file = request.files.get('xml')
+    if not xml_file:
+        return jsonify(error="Ingen XML-fil bifogad."), 400
+
+    try:
+        job_id = job_queue.submit(xml_file.read(), filename=xml_file.filename)
+    except QueueFullError as e:
+        return jsonify(error=str(e)), 503, {'Retry-After': '10'}
+
+    return jsonify(job_id=job_id, status='queued', **_job_links(job_id)), 202
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    if job_queue is None:
+        return _jobs_disabled()
+    info = job_queue.status(job_id)
+    if info is None:
+        return jsonify(error="Okänt jobb."), 404
+    return jsonify(**info, **_job_links(job_id))
+
+
+@app.route('/api/jobs/<job_id>/document', methods=['GET'])
+def job_document(job_id):
+    if job_queue is None:
+        return _jobs_disabled()
+    info = job_queue.status(job_id)
+    if info is None:
+        return jsonify(error="Okänt jobb."), 404
+    if info['status'] == 'failed':
+        code = 400 if info['error']['stage'] == 'xml' else 500
+        return jsonify(status='failed', error=info['error']), code
+    if info['status'] == 'expired':
+        return jsonify(status='expired', error="Dokumentet har rensats; skicka jobbet igen."), 410
+    if info['status'] != 'done':
+        return jsonify(status=info['status'], error="Dokumentet är inte klart än."), 409, {'Retry-After': '2'}
+
+    document = job_queue.document(job_id)
+    if document is None:
+        return jsonify(status='expired', error="Dokumentet har rensats; skicka jobbet igen."), 410
+    return send_file(io.BytesIO(document), as_attachment=True,
+                     download_name='komplett_rfqdokument.docx', mimetype=DOCX_MIMETYPE)
+
+
+@app.route('/api/cache', methods=['GET'])
+def cache_stats():
+    return jsonify(**result_cache.stats())
+
+
+@app.route('/api/metrics', methods=['GET'])
+def generation_metrics():
+    return jsonify(
+        generation=metrics.snapshot(),
+        result_cache=result_cache.stats(),
+        fragment_cache=generator.fragment_cache.stats(),
+        memo=memo_stats(),
+        jobs=job_queue.stats() if job_queue is not None else None,
+    )
+
 
 if __name__ == '__main__':
+    # Utvecklingsserver; för flera förladdade arbetarprocesser: gunicorn -w 4 app:app (se gunicorn.conf.py)
     app.run(debug=True)
@@ -0,0 +1,1402 @@
+"""
+Prestandamätningar för RFQ-genereringen.
+
+    python benchmark.py inprocess [--xml fil.xml] [--runs 10]
+    python benchmark.py templates [--runs 10]
+    python benchmark.py extract [--xml fil.xml] [--buildings 20] [--runs 3]
+    python benchmark.py placeholders [--xml fil.xml] [--runs 10]
+    python benchmark.py rules [--xml fil.xml] [--runs 10]
+    python benchmark.py concurrency [--clients 8]
+    python benchmark.py incremental [--runs 5]
+    python benchmark.py compose [--runs 3]
+    python benchmark.py batch [--runs 3]
+    python benchmark.py save [--runs 10]
+    python benchmark.py pages [--xml fil.xml] [--runs 3]
+    python benchmark.py prefork [--xml fil.xml]
+    python benchmark.py runs [--runs 10]
+    python benchmark.py memo [--runs 5]
+    python benchmark.py grouping [--xml fil.xml] [--runs 10]
+    python benchmark.py firstbyte [--xml fil.xml] [--runs 10]
+    python benchmark.py plans [--xml fil.xml] [--runs 10]
+    python benchmark.py logging [--runs 5]
+    python benchmark.py suite [--runs 5] [--save-baseline] [--baseline fil.json] [--threshold 0.25]
+
+Utan --xml skapas en syntetisk XML-fil med samma Table/TR/TH/TD-struktur
+som extract_multiple_elevators förväntar sig.
+
+benchmark_baseline.json är uppmätt på en enda maskin (processor, antal kärnor
+och Python-version står i filen). På en annan maskin jämför suite bara
+storlek och minne; spara en egen baslinje med --save-baseline för tiderna.
+"""
+import argparse
+import contextlib
+import io
+import json
+import platform
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# --- Syntetisk XML ---
+
+SYNTHETIC_FIELDS = [
+    ("Range of use", ["passenger elevator", "bed passenger elevator", "goods passenger elevator"]),
+    ("Rated load Q [kg]", ["630", "1000", "1275"]),
+    ("Rated speed v [m/s]", ["1.0", "1.6"]),
+    ("Number of floors", ["5", "8", "12"]),
+    ("Car entrance type", ["1", "2"]),
+    ("Door type", ["1C; Two-panel centre opening", "2L; Two-panel to left opening"]),
+    ("Car shell width BB [mm]", ["1100", "1200", "1400"]),
+    ("Car shell depth DD [mm]", ["1400", "2100"]),
+    ("Shaft width WW [mm]", ["1600", "1800"]),
+    ("Shaft depth WD [mm]", ["1900", "2600"]),
+    # Ett specifikationsfält med många värden, så att `specs` ger lika många grupper
+    ("Min shaft pit depth PH [mm]", [str(1100 + 10 * k) for k in range(100)]),
+    ("Control system", ["KES800"]),
+    ("Counterweight with safety gear", ["1", "0"]),
+    ("Network description", ["PW 630", "GT 1000", "BS 1275"]),
+    ("Ceiling type", ["LED ceiling", "Spot ceiling"]),
+    ("Flooring material", ["", "Rubber", "Stone"]),
+    ("Handrail type", ["Straight"]),
+    ("Handrail material", ["Steel", "Brushed steel"]),
+    ("Car fan type", ["Fan", ""]),
+    ("PRL", ["", "yes"]),
+    ("Wall B finishing", ["AISI 441", "Laminate"]),
+]
+
+GLOBAL_FIELDS = [
+    ("Sales office", "Stockholm"),
+    ("Product platform", "S3000"),
+]
+
+
+def _esc(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def _value(field_values, index, specs):
+    return field_values[(index % specs) % len(field_values)]
+
+
+def iter_synthetic_xml(grouped=3, single=2, specs=2, buildings=1, extra_fields=0, global_fields=GLOBAL_FIELDS):
+    """
+    Ger XML-raderna för ett syntetiskt projekt: `grouped` hissar i en
+    flerkolumnstabell och `single` hissar i egna tvåkolumnstabeller per
+    byggnad. `specs` styr hur många olika specifikationer som förekommer
+    (och därmed antal grupper), `extra_fields` lägger till utfyllnadsrader
+    per hiss för att efterlikna stora exporter.
+    """
+    fields = SYNTHETIC_FIELDS + [(f"Extra field {k}", [f"value {k}"]) for k in range(extra_fields)]
+
+    yield "<Root>"
+    yield "<Table>"
+    for name, value in global_fields:
+        yield f"<TR><TD>{_esc(name)}</TD><TD>{_esc(value)}</TD></TR>"
+    yield "</Table>"
+
+    if grouped:
+        yield "<Table><TR><TH>General information</TH>"
+        for i in range(grouped):
+            yield f"<TH>A{i + 1} Hiss</TH>"
+        yield "</TR>"
+        for name, values in fields:
+            cells = "".join(f"<TD>{_esc(_value(values, i, specs))}</TD>" for i in range(grouped))
+            yield f"<TR><TD>{_esc(name)}</TD>{cells}</TR>"
+        yield "</Table>"
+
+    index = grouped
+    for b in range(buildings):
+        if buildings > 1:
+            yield f'<Building name="Hus {b + 1}">'
+        for j in range(single):
+            label = f"B{j + 1}" if buildings == 1 else f"B{b + 1}.{j + 1}"
+            yield f"<Table><TR><TD>General information</TD><TD>{label} Hiss</TD></TR>"
+            for name, values in fields:
+                yield f"<TR><TD>{_esc(name)}</TD><TD>{_esc(_value(values, index, specs))}</TD></TR>"
+            yield "</Table>"
+            index += 1
+        if buildings > 1:
+            yield "</Building>"
+
+    yield "</Root>"
+
+
+def make_synthetic_xml(**kwargs):
+    return "\n".join(iter_synthetic_xml(**kwargs))
+
+
+def write_synthetic_xml(path, **kwargs):
+    with open(path, "w", encoding="utf-8") as f:
+        for line in iter_synthetic_xml(**kwargs):
+            f.write(line)
+            f.write("\n")
+    return path
+
+# --- Hjälpfunktioner ---
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def report(name, samples):
+    print(f"{name:<12} n={len(samples):<3} p50={percentile(samples, 50) * 1000:8.1f} ms"
+          f"  p99={percentile(samples, 99) * 1000:8.1f} ms")
+
+
+@contextlib.contextmanager
+def quiet():
+    import logging
+
+    logging.disable(logging.CRITICAL)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        logging.disable(logging.NOTSET)
+
+# --- Mätningar ---
+
+
+def _baseline_cli(tmpdir):
+    """
+    Den första committen (CLI:t före optimeringarna) utpackad i tmpdir, så att
+    CLI:t skriver sitt output/ där. Utan git används en kopia av nuvarande kod.
+    Returnerar (RFQ_GIT.py, beskrivning).
+    """
+    import shutil
+    import tarfile
+
+    target = os.path.join(tmpdir, "baslinje")
+    try:
+        rev = subprocess.run(["git", "rev-list", "--max-parents=0", "HEAD"], cwd=BASE_DIR,
+                             capture_output=True, text=True, check=True).stdout.split()[0]
+        archive = subprocess.run(["git", "archive", rev], cwd=BASE_DIR, capture_output=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError, IndexError):
+        shutil.copytree(os.path.join(BASE_DIR, "backend_data"), os.path.join(target, "backend_data"))
+        shutil.copy(os.path.join(BASE_DIR, "RFQ_GIT.py"), target)
+        return os.path.join(target, "RFQ_GIT.py"), "nuvarande CLI (git saknas)"
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(target)
+    return os.path.join(target, "RFQ_GIT.py"), f"CLI:t från {rev[:7]} (före optimeringarna)"
+
+
+def bench_inprocess(args, tmpdir):
+    """
+    En ny CLI-process per fil (ursprungliga RFQ_GIT.py) mot en återanvänd
+    RFQGenerator, till fil och i minnet. Alla dokument skrivs i tmpdir.
+    """
+    from RFQ_GIT import RFQGenerator
+
+    xml_path = args.xml or write_synthetic_xml(os.path.join(tmpdir, "input.xml"))
+    cli_path, cli_label = _baseline_cli(tmpdir)
+    print(f"subprocess: {cli_label}")
+
+    subprocess_times = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, cli_path, xml_path],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True
+        )
+        subprocess_times.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    generator = RFQGenerator()
+    print(f"RFQGenerator() uppstart: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    inprocess_times = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        with quiet():
+            generator.generate(xml_path, os.path.join(tmpdir, "inprocess.docx"))
+        inprocess_times.append(time.perf_counter() - start)
+
+    with open(xml_path, "rb") as f:
+        xml_bytes = f.read()
+    memory_times = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        with quiet():
+            generator.generate_bytes(xml_bytes)
+        memory_times.append(time.perf_counter() - start)
+
+    report("subprocess", subprocess_times)
+    report("in-process", inprocess_times)
+    report("i minnet", memory_times)
+
+
+def _part_sizes(doc):
+    """Ungefärligt minnesavtryck: serialiserad XML respektive binära delar (media)."""
+    from lxml import etree
+
+    xml_bytes = media_bytes = 0
+    for part in doc.part.package.iter_parts():
+        element = getattr(part, "_element", None)
+        if element is not None:
+            xml_bytes += len(etree.tostring(element))
+        else:
+            media_bytes += len(part.blob)
+    return xml_bytes, media_bytes
+
+
+def bench_templates(args, tmpdir):
+    from docx import Document
+    import RFQ_GIT
+
+    paths = [os.path.join(RFQ_GIT.BASE_PATH, name)
+             for name in (RFQ_GIT.TEMPLATE_FILE, RFQ_GIT.HISSIDA_FILE, RFQ_GIT.AVSLUT_FILE)]
+    cache = RFQ_GIT.TemplateCache()
+
+    print(f"{'mall':<45} {'fil':>8} {'parse':>9} {'kopia':>9} {'xml':>8} {'media':>8}")
+    for path in paths:
+        parse_times = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            Document(path)
+            parse_times.append(time.perf_counter() - start)
+
+        cache.preload(path)
+        copy_times = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            cache.get(path)
+            copy_times.append(time.perf_counter() - start)
+        xml_bytes, media_bytes = _part_sizes(cache.get(path))
+
+        print(f"{os.path.basename(path):<45} {os.path.getsize(path) / 1024:7.0f}K"
+              f" {percentile(parse_times, 50) * 1000:7.1f}ms {percentile(copy_times, 50) * 1000:7.1f}ms"
+              f" {xml_bytes / 1024:7.0f}K {media_bytes / 1024:7.0f}K")
+    print("Media-delarna delas mellan kopiorna; endast XML-träden kopieras per användning.")
+
+
+def peak_rss_bytes():
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _legacy_two_pass(xml_path):
+    """Det tidigare upplägget: hela trädet parsas med ET.parse, två gånger."""
+    import xml.etree.ElementTree as ET
+    import RFQ_GIT
+
+    def tables():
+        root = ET.parse(xml_path).getroot()
+        for table in root.findall(".//Table"):
+            rows = table.findall("TR")
+            if rows:
+                yield [[c for c in row if c.tag in ("TH", "TD")] for row in rows]
+
+    extractor = RFQ_GIT.ElevatorExtractor()
+    for rows in tables():
+        extractor._collect_elevators(rows, [c.text.strip() if c.text else "" for c in rows[0]])
+    groups = RFQ_GIT.ElevatorExtractor()
+    for rows in tables():
+        groups._collect_group_def([c.text.strip() if c.text else "" for c in rows[0]])
+    extractor.group_defs = groups.group_defs
+    return extractor.finish()
+
+
+def _extract_worker(args):
+    import RFQ_GIT
+
+    func = _legacy_two_pass if args.mode == "twopass" else RFQ_GIT.extract_project
+    times = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        with quiet():
+            elevators, _, _ = func(args.xml)
+        times.append(time.perf_counter() - start)
+    print(f"{len(elevators)} {percentile(times, 50)} {peak_rss_bytes()}")
+
+
+def bench_extract(args, tmpdir):
+    if args.mode:
+        return _extract_worker(args)
+
+    xml_path = args.xml or write_synthetic_xml(
+        os.path.join(tmpdir, "large.xml"),
+        grouped=20, single=25, specs=5, buildings=args.buildings, extra_fields=150
+    )
+    print(f"XML: {os.path.getsize(xml_path) / 2**20:.1f} MB")
+
+    # Varje variant körs i en egen process så att topp-RSS inte påverkas av den andra
+    for mode, name in (("twopass", "tvåpass (ET.parse x2)"), ("stream", "ett pass (iterparse)")):
+        result = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "extract", "--mode", mode,
+             "--xml", xml_path, "--runs", str(args.runs)],
+            stdout=subprocess.PIPE, text=True, check=True
+        )
+        count, median, peak = result.stdout.split()
+        print(f"{name:<24} hissar={count:<5} p50={float(median) * 1000:8.1f} ms"
+              f"  topp-RSS={int(peak) / 2**20:7.1f} MB")
+
+
+def _prepared_avslut(RFQ_GIT, cache):
+    return cache.get(os.path.join(RFQ_GIT.BASE_PATH, RFQ_GIT.AVSLUT_FILE), RFQ_GIT.prepare_page_template)
+
+
+def bench_placeholders(args, tmpdir):
+    import RFQ_GIT
+
+    xml_path = args.xml or write_synthetic_xml(os.path.join(tmpdir, "input.xml"), grouped=10, single=5, specs=3)
+    with quiet():
+        elevators, global_data, _ = RFQ_GIT.extract_project(xml_path)
+    combined_all = RFQ_GIT.merge_elevator_data(elevators, global_data)
+    suppress = ["prl", "ebd_emergency_battery_drive"]
+    cache = RFQ_GIT.TemplateCache()
+
+    # Utan delat index bygger varje ifyllnadsfunktion ett eget (ett varv över trädet per anrop)
+    for name, shared in (("ett varv per anrop", False), ("delat index", True)):
+        times = []
+        for _ in range(args.runs):
+            doc = _prepared_avslut(RFQ_GIT, cache)
+            builds = RFQ_GIT.PlaceholderIndex.builds
+            start = time.perf_counter()
+            with quiet():
+                index = RFQ_GIT.PlaceholderIndex(doc) if shared else None
+                RFQ_GIT.fill_avslut_rows(doc, elevators, index=index)
+                RFQ_GIT.remove_rows_for_placeholders(doc, suppress, combined_all, index=index)
+                RFQ_GIT.fill_placeholders_in_doc(doc, combined_all, suppress_keys=suppress, index=index)
+            times.append(time.perf_counter() - start)
+            traversals = RFQ_GIT.PlaceholderIndex.builds - builds
+        print(f"{name:<20} trädgenomgångar={traversals:<3} p50={percentile(times, 50) * 1000:8.1f} ms")
+
+
+def bench_rules(args, tmpdir):
+    import RFQ_GIT
+
+    xml_path = args.xml or write_synthetic_xml(os.path.join(tmpdir, "input.xml"), grouped=10, single=5, specs=3)
+    with quiet():
+        elevators, _, _ = RFQ_GIT.extract_project(xml_path)
+    rules = RFQ_GIT.AVSLUT_ROW_RULES
+    cache = RFQ_GIT.TemplateCache()
+
+    grouping_times, index_times, total_times = [], [], []
+    timings = {}
+    for _ in range(args.runs):
+        doc = _prepared_avslut(RFQ_GIT, cache)
+        start = time.perf_counter()
+        RFQ_GIT.group_elevators_for_rules(elevators, rules)
+        grouping_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        index = RFQ_GIT.PlaceholderIndex(doc)
+        index_times.append(time.perf_counter() - start)
+        with quiet():
+            RFQ_GIT.fill_avslut_rows(doc, elevators, index=index, timings=timings)
+        total_times.append(time.perf_counter() - start)
+
+    print(f"{len(rules)} regler, {len(elevators)} hissar")
+    print(f"{'gruppering (alla regler)':<45} {percentile(grouping_times, 50) * 1000:8.2f} ms")
+    print(f"{'index (en genomgång)':<45} {percentile(index_times, 50) * 1000:8.2f} ms")
+    for placeholder, seconds in sorted(timings.items(), key=lambda item: -item[1]):
+        print(f"{placeholder:<45} {seconds / args.runs * 1000:8.2f} ms")
+    print(f"{'totalt':<45} {percentile(total_times, 50) * 1000:8.2f} ms")
+
+
+def bench_concurrency(args, tmpdir):
+    """
+    Skickar N samtidiga uppladdningar till app.py och kontrollerar att varje
+    svar är genererat från just sin egen XML-fil (unik markör i sales_office).
+    """
+    import threading
+    import zipfile
+    from app import app
+
+    markers = [f"rfqjobb{i}x" for i in range(args.clients)]
+    payloads = [
+        make_synthetic_xml(grouped=i % 3 + 1, specs=i % 3 + 1,
+                           global_fields=[("Sales office", marker)] + GLOBAL_FIELDS[1:]).encode("utf-8")
+        for i, marker in enumerate(markers)
+    ]
+    barrier = threading.Barrier(args.clients)
+    results = [None] * args.clients
+
+    def upload(i):
+        client = app.test_client()
+        barrier.wait()
+        start = time.perf_counter()
+        response = client.post("/", data={"xml": (io.BytesIO(payloads[i]), f"projekt{i}.xml")},
+                               content_type="multipart/form-data")
+        results[i] = (response.status_code, response.get_data(), time.perf_counter() - start)
+
+    threads = [threading.Thread(target=upload, args=(i,)) for i in range(args.clients)]
+    start = time.perf_counter()
+    with quiet():  # redirect_stdout är processglobal, så den sätts en gång här
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    elapsed = time.perf_counter() - start
+
+    failures = 0
+    for i, (status, body, seconds) in enumerate(results):
+        problem = None
+        if status != 200:
+            problem = f"status {status}"
+        else:
+            with zipfile.ZipFile(io.BytesIO(body)) as docx:
+                xml = docx.read("word/document.xml").decode("utf-8")
+            found = [m for m in markers if m in xml]
+            if found != [markers[i]]:
+                problem = f"innehåller {found or 'ingen markör'}"
+        failures += problem is not None
+        print(f"klient {i}: {'OK ' if problem is None else 'FEL'} {seconds:6.2f} s" + (f"  {problem}" if problem else ""))
+    print(f"{args.clients} samtidiga uppladdningar på {elapsed:.2f} s, {failures} fel")
+    if failures:
+        sys.exit(1)
+
+
+def _edit_one_elevator(xml_text):
+    """Ändrar väggbeklädnaden för den sista hissen i projektet (en revidering)."""
+    marker = "<TR><TD>Wall B finishing</TD>"
+    position = xml_text.rindex(marker)
+    end = xml_text.index("</TR>", position)
+    return xml_text[:position] + marker + "<TD>Glass</TD>" + xml_text[end:]
+
+
+def _document_xml(docx_bytes):
+    import zipfile
+
+    with zipfile.ZipFile(io.BytesIO(docx_bytes)) as docx:
+        return docx.read("word/document.xml")
+
+
+def bench_incremental(args, tmpdir):
+    """
+    Full mot inkrementell generering när en hiss ändras i ett projekt med 30
+    hissar: den inkrementella körningen har fragmentcachen fylld från den
+    ursprungliga XML-filen och bygger bara om de delar vars indata ändrats.
+    """
+    import RFQ_GIT
+
+    original = make_synthetic_xml(grouped=20, single=10, specs=6)
+    edited = _edit_one_elevator(original).encode("utf-8")
+    original = original.encode("utf-8")
+
+    generator = RFQ_GIT.RFQGenerator()
+    with quiet():
+        generator.generate_bytes(original)  # värm upp mallar och översättningar
+
+    full_times, incremental_times = [], []
+    for _ in range(args.runs):
+        generator.fragment_cache.clear()
+        with quiet():
+            start = time.perf_counter()
+            full = generator.generate_bytes(edited).getvalue()
+            full_times.append(time.perf_counter() - start)
+
+        generator.fragment_cache.clear()
+        with quiet():
+            generator.generate_bytes(original)
+        hits_before = generator.fragment_cache.stats()["hits"]
+        with quiet():
+            start = time.perf_counter()
+            incremental = generator.generate_bytes(edited).getvalue()
+            incremental_times.append(time.perf_counter() - start)
+        reused = generator.fragment_cache.stats()["hits"] - hits_before
+
+        if _document_xml(full) != _document_xml(incremental):
+            print("FEL: inkrementellt dokument skiljer sig från fullt")
+            sys.exit(1)
+
+    fragments = len(RFQ_GIT.group_elevators_by_spec(generator.extract(io.BytesIO(edited))[0])) + 1
+    print(f"Återanvände {reused} av {fragments} delar från fragmentcachen.")
+    report("full", full_times)
+    report("inkrementell", incremental_times)
+
+
+def _rendered_pages(RFQ_GIT, groups):
+    """Huvudmall plus `groups` ifyllda hissidor (utan att sätta ihop dem)."""
+    with quiet():
+        elevators, global_data, _ = RFQ_GIT.extract_project(io.BytesIO(make_synthetic_xml(grouped=6, single=0, specs=6).encode("utf-8")))
+        global_data["datum"] = "2026-01-01"
+        master = RFQ_GIT.render_master(os.path.join(RFQ_GIT.BASE_PATH, RFQ_GIT.TEMPLATE_FILE),
+                                       elevators[0], ["Grupp 1"], global_data, True)
+        hissida_path = os.path.join(RFQ_GIT.BASE_PATH, RFQ_GIT.HISSIDA_FILE)
+        pages = [
+            RFQ_GIT.render_hissida(master, hissida_path,
+                                   dict(elevators[i % len(elevators)], general_information=f"H{i + 1} Hiss"), global_data)
+            for i in range(groups)
+        ]
+    return master, pages
+
+
+def _compose(RFQ_GIT, master, pages, fast):
+    import copy
+    import zipfile
+
+    composer = RFQ_GIT.Composer(copy.deepcopy(master))
+    start = time.perf_counter()
+    if fast:
+        repeated = RFQ_GIT.RepeatedPageComposer(composer)
+        for page in pages:
+            repeated.append(page)
+        repeated.finish()
+    else:
+        for page in pages:
+            composer.append(page)
+    elapsed = time.perf_counter() - start
+    buffer = io.BytesIO()
+    composer.save(buffer)
+    with zipfile.ZipFile(buffer) as docx:
+        media = sum(1 for name in docx.namelist() if name.startswith("word/media/"))
+        document = docx.read("word/document.xml")
+    return elapsed, len(buffer.getvalue()), media, document
+
+
+def bench_compose(args, tmpdir):
+    """
+    Composer.append per hissida mot RepeatedPageComposer (stilar, numrering och
+    media slås ihop en gång, därefter klonas bara kroppen) för 1-100 grupper.
+    """
+    import RFQ_GIT
+
+    print(f"{'grupper':>8} {'append':>12} {'snabb':>12} {'storlek':>12} {'media':>6}")
+    for groups in (1, 10, 50, 100):
+        master, pages = _rendered_pages(RFQ_GIT, groups)
+        times = {False: [], True: []}
+        for _ in range(args.runs):
+            for fast in (False, True):
+                with quiet():
+                    elapsed, size, media, document = _compose(RFQ_GIT, master, pages, fast)
+                times[fast].append(elapsed)
+                if not fast:
+                    reference = (size, document)
+                elif (size, document) != reference:
+                    print(f"FEL: olika dokument för {groups} grupper")
+                    sys.exit(1)
+        print(f"{groups:>8} {percentile(times[False], 50) * 1000:9.1f} ms {percentile(times[True], 50) * 1000:9.1f} ms"
+              f" {size / 1024:9.0f} kB {media:>6}")
+
+
+def _legacy_process_runs(paragraph, value_for):
+    """Den tidigare process_runs: hela texten byggs om och skrivs i första run."""
+    import re
+
+    full_text = "".join(run.text for run in paragraph.runs)
+    matches = re.findall(r"\{\{(.*?)\}\}", full_text)
+    if not matches:
+        return 0
+    for match in matches:
+        full_text = full_text.replace(f"{{{{{match}}}}}", value_for(match))
+    for run in paragraph.runs:
+        run.text = ""
+    paragraph.runs[0].text = full_text
+    return len(matches)
+
+
+def bench_runs(args, tmpdir):
+    """
+    Platshållarersättning per stycke i de riktiga mallarna: den tidigare
+    process_runs mot replace_placeholders_in_runs (förfiltrering på "{{" och
+    omskrivning av bara berörda runs).
+    """
+    import RFQ_GIT
+    from docx.text.paragraph import Paragraph
+
+    value_for = lambda key: f"värde för {key.strip()}"
+    replacements_for = lambda text, matches: [value_for(m.group(1)) for m in matches]
+    cache = RFQ_GIT.TemplateCache()
+
+    print(f"{'mall':<12} {'stycken':>8} {'berörda':>8} {'platsh.':>8} {'tidigare':>12} {'nu':>12}")
+    for name in (RFQ_GIT.TEMPLATE_FILE, RFQ_GIT.HISSIDA_FILE, RFQ_GIT.AVSLUT_FILE):
+        path = os.path.join(RFQ_GIT.BASE_PATH, name)
+        legacy_times, engine_times = [], []
+        for _ in range(args.runs):
+            doc = cache.get(path)
+            paragraphs = [Paragraph(p, doc._body) for p in doc.element.body.iter(RFQ_GIT.W_P)]
+            start = time.perf_counter()
+            for paragraph in paragraphs:
+                _legacy_process_runs(paragraph, value_for)
+            legacy_times.append(time.perf_counter() - start)
+
+            doc = cache.get(path)
+            paragraphs = [Paragraph(p, doc._body) for p in doc.element.body.iter(RFQ_GIT.W_P)]
+            touched = replaced = 0
+            start = time.perf_counter()
+            for paragraph in paragraphs:
+                if RFQ_GIT._may_contain_placeholder(paragraph._p):
+                    count = RFQ_GIT.replace_placeholders_in_runs(paragraph, replacements_for)
+                    touched += bool(count)
+                    replaced += count
+            engine_times.append(time.perf_counter() - start)
+
+        print(f"{name[:12]:<12} {len(paragraphs):>8} {touched:>8} {replaced:>8}"
+              f" {percentile(legacy_times, 50) * 1000:9.2f} ms {percentile(engine_times, 50) * 1000:9.2f} ms")
+
+
+def _legacy_text_functions(RFQ_GIT, out):
+    """De tidigare (omemoiserade) normalize/translate/adjust, för jämförelse."""
+    import re
+
+    def normalize_key(text):
+        text = text.lower().strip()
+        text = re.sub(r"[ /,\[\];:()\-]", "_", text)
+        text = re.sub(r"_+", "_", text)
+        return text.strip("_")
+
+    def translate_value_if_possible(value, key=None):
+        if key == "numpag":
+            return "{{numpag}}"
+        norm_key = normalize_key(value)
+        if key == "counterweight_with_safety_gear":
+            return "Ja" if value.strip() == "1" else "Nej"
+        result = RFQ_GIT.translation_store.get(norm_key, value)
+        print(f" Placeholder: '{key}' - '{value}' - '{result}'", file=out)
+        return result
+
+    def adjust_translation_by_context(paragraph_text, placeholder, translated):
+        try:
+            before = paragraph_text.split(placeholder)[0].strip()
+            starts_sentence = not before or before.endswith((". ", ": ", "? ", "! ", "\n"))
+            if re.match(r"^[A-ZÅÄÖ]{2,}([- ]|$)", translated):
+                return translated
+            if translated.isupper() or (
+                len(translated) >= 2 and translated[:2].isupper() and any(char.isdigit() for char in translated)
+            ):
+                return translated
+            if starts_sentence:
+                return translated[0].upper() + translated[1:]
+            return translated[0].lower() + translated[1:]
+        except Exception:
+            return translated
+
+    return {
+        "normalize_key": normalize_key,
+        "translate_value_if_possible": translate_value_if_possible,
+        "adjust_translation_by_context": adjust_translation_by_context,
+    }
+
+
+def bench_memo(args, tmpdir):
+    """
+    Spelar upp de normalize/translate/adjust-anrop som en generering av ett
+    projekt med 100 (till stor del identiska) hissar gör, med de tidigare
+    funktionerna och med de memoiserade, och visar träffstatistiken.
+    """
+    import RFQ_GIT
+
+    xml = make_synthetic_xml(grouped=60, single=40, specs=2).encode("utf-8")
+    names = ("normalize_key", "translate_value_if_possible", "adjust_translation_by_context")
+    calls = []
+    originals = {name: getattr(RFQ_GIT, name) for name in names}
+
+    def recording(name):
+        function = originals[name]
+
+        def record(*args, **kwargs):
+            calls.append((name, args, kwargs))
+            return function(*args, **kwargs)
+        return record
+
+    generator = RFQ_GIT.RFQGenerator(fragment_cache=RFQ_GIT.FragmentCache(max_entries=0))
+    RFQ_GIT.clear_memo_caches()
+    for name in names:
+        setattr(RFQ_GIT, name, recording(name))
+    try:
+        with quiet():
+            start = time.perf_counter()
+            generator.generate_bytes(xml)
+            generation = time.perf_counter() - start
+    finally:
+        for name, function in originals.items():
+            setattr(RFQ_GIT, name, function)
+    stats = RFQ_GIT.memo_stats()
+
+    legacy_times, memo_times = [], []
+    for _ in range(args.runs):
+        sink = io.StringIO()
+        legacy = _legacy_text_functions(RFQ_GIT, sink)
+        start = time.perf_counter()
+        for name, call_args, call_kwargs in calls:
+            legacy[name](*call_args, **call_kwargs)
+        legacy_times.append(time.perf_counter() - start)
+
+        RFQ_GIT.clear_memo_caches()
+        with quiet():
+            start = time.perf_counter()
+            for name, call_args, call_kwargs in calls:
+                originals[name](*call_args, **call_kwargs)
+            memo_times.append(time.perf_counter() - start)
+
+    counts = {name: sum(1 for call in calls if call[0] == name) for name in names}
+    print(f"generering: {generation * 1000:.0f} ms, anrop: " + ", ".join(f"{name} {count}" for name, count in counts.items()))
+    for name, info in stats.items():
+        print(f"{name:<14} träffar {info['hits']:>6}  missar {info['misses']:>5}  träffkvot {info['hit_rate']:6.1%}")
+    report("tidigare", legacy_times)
+    report("memoiserad", memo_times)
+
+
+def _first_byte_worker(args):
+    """Körs i en ny process: skapa generatorn, generera och meddela när dokumentet finns."""
+    import RFQ_GIT
+
+    with quiet():
+        generator = RFQ_GIT.RFQGenerator(one_shot=args.startup == "lazy")
+        document = generator.generate_bytes(open(args.xml, "rb").read())
+    loads = {os.path.basename(path): stats["loads"] for path, stats in generator.template_cache.stats.items()}
+    print(json.dumps({"size": len(document.getvalue()), "loads": loads}), flush=True)
+
+
+def bench_firstbyte(args, tmpdir):
+    """
+    Tid från processstart till färdigt dokument för ett projekt med en
+    hissgrupp: förladdade mallar (som app.py) mot lata mallar (CLI:t), där
+    hissida.docx aldrig läses och mallarna inte kopieras.
+    """
+    if args.startup:
+        return _first_byte_worker(args)
+
+    xml_path = args.xml or write_synthetic_xml(os.path.join(tmpdir, "input.xml"), grouped=1, single=0, specs=1)
+
+    for mode, label in (("preload", "förladdad"), ("lazy", "lat")):
+        times = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            child = subprocess.Popen(
+                [sys.executable, __file__, "firstbyte", "--xml", xml_path, "--startup", mode],
+                stdout=subprocess.PIPE, text=True
+            )
+            line = child.stdout.readline()
+            times.append(time.perf_counter() - start)
+            child.wait()
+        result = json.loads(line)
+        report(label, times)
+        print(f"{'':13}inläsningar: " + ", ".join(f"{name} {count}" for name, count in result["loads"].items()))
+
+
+def _dom_fill(RFQ_GIT, name, doc, data, elevators, headings):
+    """Ifyllnaden som render_master/render_hissida/render_avslut gör den via python-docx."""
+    if name == RFQ_GIT.TEMPLATE_FILE:
+        index = RFQ_GIT.PlaceholderIndex(doc)
+        RFQ_GIT.remove_rows_for_placeholders(doc, RFQ_GIT.OPTIONAL_ROW_PLACEHOLDERS, data, index=index)
+        RFQ_GIT.fill_group_headings_dynamic(doc, headings, index=index)
+        RFQ_GIT.fill_placeholders_in_doc(doc, data, index=index)
+    elif name == RFQ_GIT.AVSLUT_FILE:
+        index = RFQ_GIT.PlaceholderIndex(doc)
+        RFQ_GIT.fill_avslut_rows(doc, elevators, index=index)
+        RFQ_GIT.remove_rows_for_placeholders(doc, RFQ_GIT.OPTIONAL_ROW_PLACEHOLDERS, data, index=index)
+        RFQ_GIT.fill_placeholders_in_doc(doc, data, suppress_keys=["prl", "ebd_emergency_battery_drive"], index=index)
+    else:
+        RFQ_GIT.fill_placeholders_in_doc(doc, data)
+
+
+def _plan_fill(RFQ_GIT, name, plan, doc, data, elevators, headings):
+    if name == RFQ_GIT.TEMPLATE_FILE:
+        return plan.render(doc, data, rows={"{{section_heading}}": headings})
+    if name == RFQ_GIT.AVSLUT_FILE:
+        rows = RFQ_GIT.row_rule_texts(elevators, RFQ_GIT.AVSLUT_ROW_RULES)
+        return plan.render(doc, data, suppress_keys=["prl", "ebd_emergency_battery_drive"], rows=rows)
+    return plan.render(doc, data)
+
+
+def bench_plans(args, tmpdir):
+    """
+    Ifyllnad av varje mall via python-docx (index, radoperationer och
+    fill_placeholders_in_doc) mot dess kompilerade renderingsplan. Mallkopian
+    hämtas utanför mätningen; planens tid inkluderar parsningen av resultatet.
+    Båda vägarna ska ge samma document.xml. Till sist genereras hela dokument
+    med en one_shot-generator (CLI:t, utan planer) och en vanlig (webben, med
+    planer); alla delar ska vara lika, så att vägarna inte glider isär.
+    """
+    import RFQ_GIT
+
+    xml_path = args.xml or write_synthetic_xml(os.path.join(tmpdir, "input.xml"), grouped=10, single=5, specs=3)
+    with quiet():
+        elevators, global_data, _ = RFQ_GIT.extract_project(xml_path)
+    groups = RFQ_GIT.group_elevators_by_spec(elevators)
+    headings = [f"Grupp {i + 1}: {group['hissbeteckning']}" for i, group in enumerate(groups)]
+    cache = RFQ_GIT.TemplateCache()
+    templates = (
+        (RFQ_GIT.TEMPLATE_FILE, None, RFQ_GIT._compile_master_plan, {**global_data, **groups[0]}),
+        (RFQ_GIT.HISSIDA_FILE, RFQ_GIT.prepare_page_template, RFQ_GIT._compile_page_plan, {**global_data, **groups[-1]}),
+        (RFQ_GIT.AVSLUT_FILE, RFQ_GIT.prepare_page_template, RFQ_GIT._compile_avslut_plan,
+         RFQ_GIT.merge_elevator_data(elevators, global_data)),
+    )
+
+    print(f"{'mall':<14} {'kompilering':>12} {'python-docx':>12} {'plan':>10} {'faktor':>7}")
+    for name, prepare, compile_plan, data in templates:
+        path = os.path.join(RFQ_GIT.BASE_PATH, name)
+        start = time.perf_counter()
+        with quiet():
+            plan = compile_plan(cache.get(path, prepare))
+        compile_time = time.perf_counter() - start
+
+        dom_times, plan_times = [], []
+        for _ in range(args.runs):
+            doc = cache.get(path, prepare)
+            start = time.perf_counter()
+            with quiet():
+                _dom_fill(RFQ_GIT, name, doc, data, elevators, headings)
+            dom_times.append(time.perf_counter() - start)
+            dom_xml = doc.element.xml
+
+            doc = cache.get(path, prepare)
+            start = time.perf_counter()
+            with quiet():
+                doc = _plan_fill(RFQ_GIT, name, plan, doc, data, elevators, headings)
+            plan_times.append(time.perf_counter() - start)
+            if doc.element.xml != dom_xml:
+                print(f"FEL: planen ger annan document.xml för {name}")
+                sys.exit(1)
+
+        dom, planned = percentile(dom_times, 50), percentile(plan_times, 50)
+        print(f"{name[:14]:<14} {compile_time * 1000:9.1f} ms {dom * 1000:9.1f} ms {planned * 1000:7.2f} ms {dom / planned:6.1f}x")
+
+    inputs = [xml_path]
+    if not args.xml:
+        for i, shape in enumerate((dict(grouped=1, single=0, specs=1), dict(grouped=0, single=8, specs=4),
+                                   dict(grouped=30, single=10, specs=12))):
+            inputs.append(write_synthetic_xml(os.path.join(tmpdir, f"projekt{i}.xml"), **shape))
+    planned_generator = RFQ_GIT.RFQGenerator(fragment_cache=RFQ_GIT.FragmentCache(max_entries=0))
+    for path in inputs:
+        with open(path, "rb") as f:
+            xml_bytes = f.read()
+        documents = []
+        for generator in (RFQ_GIT.RFQGenerator(one_shot=True), planned_generator):
+            with quiet():
+                document = generator.generate_bytes(xml_bytes).getvalue()
+            # Numreringarnas w:nsid slumpas av docxcompose vid varje generering
+            documents.append({name: re.sub(rb'w:nsid w:val="[0-9A-F]+"', b"", data)
+                              for name, data in _docx_parts(document).items()})
+        if documents[0] != documents[1]:
+            differs = sorted(name for name in documents[0].keys() | documents[1].keys()
+                             if documents[0].get(name) != documents[1].get(name))
+            print(f"FEL: {os.path.basename(path)} ger olika dokument med och utan planer: {', '.join(differs)}")
+            sys.exit(1)
+    print(f"hela dokument: samma med och utan planer för {len(inputs)} projekt")
+
+
+def _legacy_grouping(RFQ_GIT):
+    """De tidigare group_elevators_by_spec och group_elevators_for_rules (en dict per hiss och regel)."""
+    from collections import defaultdict
+
+    def label(e):
+        return e.get("general_information", "").strip().split()[0].upper()
+
+    def by_spec(elevators):
+        groups = defaultdict(list)
+        for e in elevators:
+            groups[tuple((k, e.get(k, "")) for k in RFQ_GIT.SPEC_KEY_FIELDS)].append(e)
+        grouped = []
+        for group in groups.values():
+            base = group[0].copy()
+            base["antal_hissar"] = str(len(group))
+            base["hissbeteckning"] = ", ".join(e.get("general_information", "").split()[0].upper() for e in group if e.get("general_information"))
+            mr_type = RFQ_GIT.extract_machineroom_type(base.get("network_description", ""))
+            if mr_type:
+                base["machineroom_type"] = mr_type + "2" if len(group) > 1 else mr_type
+            grouped.append(base)
+        return grouped
+
+    def for_rules(elevators, rules):
+        results = [{"labels": [], "value": None} if "value_filter" in rule else defaultdict(list) for rule in rules]
+        for e in elevators:
+            name = label(e)
+            for rule, groups in zip(rules, results):
+                key = rule["key"]
+                if "value_filter" in rule:
+                    value = e.get(key, "").strip()
+                    if rule["value_filter"](value):
+                        groups["labels"].append(name)
+                        groups["value"] = value
+                elif isinstance(key, tuple):
+                    values = tuple(e.get(k, "").strip() for k in key)
+                    groups[values if all(values) else None].append(name)
+                else:
+                    value = e.get(key, "").strip()
+                    groups[value or None].append(name)
+        return results
+
+    return by_spec, for_rules
+
+
+def bench_grouping(args, tmpdir):
+    """
+    Gruppering av 600 hissar per specifikation och för avslutsreglerna: de
+    tidigare funktionerna (egna dicts per anrop) mot ElevatorTable, där
+    kolumnerna och grupperingarna byggs en gång och delas.
+    """
+    import RFQ_GIT
+
+    xml_path = args.xml or write_synthetic_xml(os.path.join(tmpdir, "input.xml"), grouped=400, single=200, specs=40)
+    with quiet():
+        elevators, _, _ = RFQ_GIT.extract_project(xml_path)
+    rules = RFQ_GIT.AVSLUT_ROW_RULES
+    by_spec, for_rules = _legacy_grouping(RFQ_GIT)
+
+    table = RFQ_GIT.ElevatorTable(elevators)
+    legacy_rules = [dict(groups) for groups in for_rules(elevators, rules)]
+    if (by_spec(elevators) != RFQ_GIT.group_elevators_by_spec(elevators, table=table)
+            or legacy_rules != RFQ_GIT.group_elevators_for_rules(elevators, rules, table=table)):
+        print("FEL: olika grupperingar")
+        sys.exit(1)
+
+    legacy_times, table_times, build_times = [], [], []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        groups = by_spec(elevators)
+        for_rules(elevators, rules)
+        legacy_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        table = RFQ_GIT.ElevatorTable(elevators)
+        build_times.append(time.perf_counter() - start)
+        RFQ_GIT.group_elevators_by_spec(elevators, table=table)
+        RFQ_GIT.group_elevators_for_rules(elevators, rules, table=table)
+        table_times.append(time.perf_counter() - start)
+
+    print(f"{len(elevators)} hissar, {len(groups)} specifikationsgrupper, {len(rules)} regler")
+    report("tidigare", legacy_times)
+    report("tabell", table_times)
+    report("  varav bygge", build_times)
+
+
+def bench_logging(args, tmpdir):
+    """
+    Extrahering och generering av ett stort projekt (200 hissar) med loggning
+    på olika nivåer till en buffert i minnet.
+    """
+    import logging
+    import RFQ_GIT
+
+    xml = make_synthetic_xml(grouped=150, single=50, specs=6, extra_fields=40).encode("utf-8")
+    generator = RFQ_GIT.RFQGenerator(fragment_cache=RFQ_GIT.FragmentCache(max_entries=0))
+    buffer = io.StringIO()
+    handler = logging.StreamHandler(buffer)
+    RFQ_GIT.logger.addHandler(handler)
+    RFQ_GIT.logger.propagate = False
+    with quiet():
+        generator.generate_bytes(xml)  # värm upp mallar och översättningar
+    try:
+        for level in ("WARNING", "INFO", "DEBUG", "TRACE"):
+            RFQ_GIT.logger.setLevel(level)
+            extract_times, generate_times = [], []
+            buffer.seek(0)
+            buffer.truncate()
+            for _ in range(args.runs):
+                start = time.perf_counter()
+                generator.extract(io.BytesIO(xml))
+                extract_times.append(time.perf_counter() - start)
+            for _ in range(args.runs):
+                RFQ_GIT.clear_memo_caches()
+                start = time.perf_counter()
+                generator.generate_bytes(xml)
+                generate_times.append(time.perf_counter() - start)
+            print(f"{level:<8} extrahering {percentile(extract_times, 50) * 1000:7.1f} ms"
+                  f"  generering {percentile(generate_times, 50) * 1000:7.1f} ms"
+                  f"  logg {len(buffer.getvalue()) / args.runs / 1024:7.1f} kB/körning")
+    finally:
+        RFQ_GIT.logger.removeHandler(handler)
+        RFQ_GIT.logger.propagate = True
+
+
+# --- Svit ---
+
+# Syntetiska projekt av växande storlek: antal hissar, flerkolumns- mot
+# tvåkolumnstabeller och antal olika specifikationer (= antal hissidor)
+SUITE_SCENARIOS = {
+    "grupp-10": dict(grouped=10, single=0, specs=3),
+    "grupp-50": dict(grouped=50, single=0, specs=6),
+    "grupp-200": dict(grouped=200, single=0, specs=6),
+    "singel-10": dict(grouped=0, single=10, specs=3),
+    "singel-50": dict(grouped=0, single=50, specs=6),
+    "blandad-100": dict(grouped=60, single=40, specs=6),
+    "en-spec-100": dict(grouped=100, single=0, specs=1),
+    "specs-25": dict(grouped=100, single=0, specs=25),
+    "specs-100": dict(grouped=100, single=0, specs=100),
+}
+
+SUITE_METRICS = ("extract", "group", "generate_final_doc", "total", "size", "peak_rss")
+DEFAULT_BASELINE = os.path.join(BASE_DIR, "benchmark_baseline.json")
+# Tidsskillnader under detta räknas aldrig som regression (brus i små steg)
+MIN_TIME_DELTA = 0.005
+
+
+def _suite_worker(args):
+    import RFQ_GIT
+
+    xml = make_synthetic_xml(**SUITE_SCENARIOS[args.scenario]).encode("utf-8")
+    # Utan fragment- och resultatcache så att varje körning gör hela arbetet
+    generator = RFQ_GIT.RFQGenerator(fragment_cache=RFQ_GIT.FragmentCache(max_entries=0))
+    with quiet():
+        generator.generate_bytes(xml)
+
+    samples = {name: [] for name in SUITE_METRICS if name not in ("size", "peak_rss")}
+    for _ in range(args.runs):
+        RFQ_GIT.clear_memo_caches()
+        report = RFQ_GIT.StageReport()
+        with quiet():
+            document = generator.generate_bytes(xml, report=report)
+        extract = report.stages["extract"]["seconds"]
+        group = report.stages["group"]["seconds"]
+        samples["extract"].append(extract)
+        samples["group"].append(group)
+        samples["generate_final_doc"].append(report.total_seconds - extract - group)
+        samples["total"].append(report.total_seconds)
+
+    _check_docx(document.getvalue(), args.scenario)
+    result = {name: percentile(values, 50) for name, values in samples.items()}
+    result.update(
+        elevators=report.info["elevators"],
+        groups=report.info["groups"],
+        size=len(document.getvalue()),
+        peak_rss=peak_rss_bytes(),
+    )
+    print(json.dumps(result))
+
+
+def _machine_info():
+    """Det som avgör om tider från en sparad baslinje går att jämföra med den här maskinen."""
+    processor = platform.processor()
+    try:
+        with open("/proc/cpuinfo", encoding="utf-8") as f:
+            processor = next(line.split(":", 1)[1].strip() for line in f if line.startswith("model name"))
+    except (OSError, StopIteration):
+        pass
+    return {"python": platform.python_version(), "machine": platform.machine(),
+            "processor": processor, "cpus": os.cpu_count()}
+
+
+def _regressions(result, baseline, threshold, metrics=SUITE_METRICS):
+    problems = []
+    for name in metrics:
+        if name not in baseline:
+            continue
+        old, new = baseline[name], result[name]
+        if not old or new <= old * (1 + threshold):
+            continue
+        if name not in ("size", "peak_rss") and new - old < MIN_TIME_DELTA:
+            continue
+        problems.append(f"{name} +{(new / old - 1) * 100:.0f}%")
+    return problems
+
+
+def bench_suite(args, tmpdir):
+    """
+    Skalningssvit: varje scenario körs i en egen process (ren topp-RSS) och
+    mäter extrahering, group_elevators_by_spec, generate_final_doc, totalt,
+    dokumentstorlek och topp-RSS. Resultatet jämförs med en sparad baslinje;
+    tid, storlek eller minne som ökat mer än --threshold räknas som regression.
+    Baslinjen är maskinberoende och sparas om med --save-baseline; kommer den
+    från en annan maskin jämförs bara storlek och minne.
+    """
+    if args.scenario:
+        return _suite_worker(args)
+
+    baseline_path = args.baseline or DEFAULT_BASELINE
+    baseline, metrics = {}, SUITE_METRICS
+    if os.path.exists(baseline_path) and not args.save_baseline:
+        with open(baseline_path, encoding="utf-8") as f:
+            saved = json.load(f)
+        baseline = saved["scenarios"]
+        here = _machine_info()
+        differs = [key for key in here if saved.get(key) != here[key]]
+        if differs:
+            metrics = ("size", "peak_rss")
+            print(f"Baslinjen ({saved.get('created')}) är från en annan maskin ({', '.join(differs)} skiljer);"
+                  f" tiderna jämförs inte. Spara en lokal baslinje med --save-baseline.")
+
+    print(f"{'scenario':<12} {'hissar':>6} {'grupper':>7} {'extrahering':>11} {'gruppering':>10}"
+          f" {'generate_final_doc':>18} {'totalt':>9} {'storlek':>9} {'topp-RSS':>9}")
+    results, failures = {}, 0
+    for name in SUITE_SCENARIOS:
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "suite", "--scenario", name, "--runs", str(args.runs)],
+            stdout=subprocess.PIPE, text=True, check=True
+        )
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        results[name] = result
+        problems = _regressions(result, baseline[name], args.threshold, metrics) if name in baseline else []
+        failures += bool(problems)
+        status = "ny" if name not in baseline else ("REGRESSION: " + ", ".join(problems) if problems else "OK")
+        print(f"{name:<12} {result['elevators']:>6} {result['groups']:>7} {result['extract'] * 1000:8.1f} ms"
+              f" {result['group'] * 1000:7.1f} ms {result['generate_final_doc'] * 1000:15.1f} ms"
+              f" {result['total'] * 1000:6.0f} ms {result['size'] / 1024:6.0f} kB"
+              f" {result['peak_rss'] / 2**20:6.0f} MB  {status}")
+
+    if args.save_baseline:
+        with open(baseline_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "created": time.strftime("%Y-%m-%d"),
+                **_machine_info(),
+                "runs": args.runs,
+                "scenarios": results,
+            }, f, indent=2)
+            f.write("\n")
+        print(f"Baslinje sparad: {baseline_path}")
+    elif failures:
+        print(f"{failures} scenario(n) över tröskeln {args.threshold:.0%}")
+        sys.exit(1)
+
+
+def _docx_parts(data):
+    import zipfile
+
+    with zipfile.ZipFile(io.BytesIO(data)) as docx:
+        return {name: docx.read(name) for name in docx.namelist()}
+
+
+def bench_batch(args, tmpdir):
+    """
+    `RFQ_GIT.py batch` på samma katalog med 16 projekt: en arbetarprocess mot
+    2, 4 och antal kärnor. Uppsnabbningen visar hur nära linjärt batchen skalar.
+    """
+    import RFQ_GIT
+
+    input_dir = os.path.join(tmpdir, "xml")
+    os.makedirs(input_dir)
+    for i in range(16):
+        write_synthetic_xml(os.path.join(input_dir, f"projekt{i:02}.xml"), grouped=5 + i, single=i % 4, specs=3)
+    print(f"{os.cpu_count()} kärnor, 16 filer")
+    print(f"{'processer':>10} {'p50':>10} {'filer/s':>9} {'uppsnabbning':>13}")
+
+    serial = None
+    for workers in sorted({1, 2, 4, os.cpu_count() or 1}):
+        times = []
+        for run in range(args.runs):
+            output_dir = os.path.join(tmpdir, f"docx-{workers}-{run}")
+            start = time.perf_counter()
+            with quiet():
+                results = RFQ_GIT.run_batch(input_dir, output_dir, workers)
+            times.append(time.perf_counter() - start)
+            if any(error for _, _, _, error in results):
+                print(f"FEL: misslyckade filer med {workers} processer")
+                sys.exit(1)
+        p50 = percentile(times, 50)
+        serial = serial or p50
+        print(f"{workers:>10} {p50 * 1000:7.0f} ms {16 / p50:9.2f} {serial / p50:12.2f}x")
+
+
+def _check_docx(data, label):
+    """Röktest för paketeringen: zipfilen ska vara hel och gå att öppna med python-docx."""
+    import zipfile
+    from docx import Document
+
+    try:
+        with zipfile.ZipFile(io.BytesIO(data)) as docx:
+            broken = docx.testzip()
+        if broken is None:
+            Document(io.BytesIO(data))
+    except Exception as e:
+        broken = f"{type(e).__name__}: {e}"
+    if broken is not None:
+        print(f"FEL: trasigt dokument ({label}): {broken}")
+        sys.exit(1)
+
+
+def bench_save(args, tmpdir):
+    """
+    composer.save() mot save_document (media komprimeras en gång per process och
+    kopieras sedan, XML-delar med RFQ_DEFLATE_LEVEL) för ett färdigsatt dokument.
+    Varje variant ska ge samma delar och ett dokument som zipfile och python-docx
+    kan öppna (suite kontrollerar detsamma för varje scenario).
+    """
+    import RFQ_GIT
+
+    default_level = RFQ_GIT.DEFLATE_LEVEL
+    print(f"{'grupper':>8} {'variant':>16} {'första':>10} {'median':>10} {'storlek':>10}")
+    for groups in (1, 20):
+        master, pages = _rendered_pages(RFQ_GIT, groups)
+        composer = RFQ_GIT.Composer(master)
+        repeated = RFQ_GIT.RepeatedPageComposer(composer)
+        for page in pages:
+            repeated.append(page)
+        repeated.finish()
+
+        variants = [("composer.save", None, lambda buffer: composer.save(buffer))]
+        for level in sorted({default_level, 1}, reverse=True):
+            variants.append((f"save_document L{level}", level,
+                             lambda buffer: RFQ_GIT.save_document(composer.doc, buffer)))
+        reference = None
+        for name, level, save in variants:
+            if level is not None:
+                RFQ_GIT.DEFLATE_LEVEL = level
+                RFQ_GIT._media_entries.clear()
+            times = []
+            for _ in range(args.runs + 1):
+                buffer = io.BytesIO()
+                start = time.perf_counter()
+                with quiet():
+                    save(buffer)
+                times.append(time.perf_counter() - start)
+            data = buffer.getvalue()
+            _check_docx(data, f"{groups} grupper, {name}")
+            if reference is None:
+                reference = _docx_parts(data)
+            elif _docx_parts(data) != reference:
+                print(f"FEL: olika innehåll för {groups} grupper ({name})")
+                sys.exit(1)
+            print(f"{groups:>8} {name:>16} {times[0] * 1000:7.1f} ms {percentile(times[1:], 50) * 1000:7.1f} ms"
+                  f" {len(data) / 1024:7.0f} kB")
+
+
+def bench_pages(args, tmpdir):
+    """
+    Hela genereringen för ett projekt med 40 hissgrupper: hissidorna i tur och
+    ordning mot en PagePool med 1, 2, 4 och 8 processer (samma dokument krävs).
+    Båda vägarna renderar sidorna i ett återanvänt skal utan fragmentcache, så
+    skillnaden är bara parallelliteten.
+    """
+    import RFQ_GIT
+
+    xml_path = args.xml or write_synthetic_xml(os.path.join(tmpdir, "input.xml"), grouped=40, single=0, specs=40)
+    with open(xml_path, "rb") as f:
+        xml_bytes = f.read()
+    print(f"{os.cpu_count()} kärnor")
+    print(f"{'processer':>10} {'uppstart':>10} {'p50':>10} {'p95':>10} {'uppsnabbning':>13}")
+
+    reference = serial = None
+    for workers in (0, 1, 2, 4, 8):
+        start = time.perf_counter()
+        with quiet():
+            generator = RFQ_GIT.RFQGenerator(fragment_cache=RFQ_GIT.FragmentCache(max_entries=0), page_workers=workers)
+        startup = time.perf_counter() - start
+        times = []
+        for _ in range(args.runs + 1):
+            start = time.perf_counter()
+            with quiet():
+                document = generator.generate_bytes(xml_bytes).getvalue()
+            times.append(time.perf_counter() - start)
+        generator.close()
+        times = times[1:]  # första körningen kompilerar planer och fyller bildcachen
+
+        # Numreringarnas w:nsid slumpas av docxcompose vid varje generering
+        parts = {name: re.sub(rb'w:nsid w:val="[0-9A-F]+"', b"", data) for name, data in _docx_parts(document).items()}
+        if reference is None:
+            reference, serial = parts, percentile(times, 50)
+        elif parts != reference:
+            print(f"FEL: annat dokument med {workers} processer")
+            sys.exit(1)
+        label = "i tur" if workers == 0 else str(workers)
+        print(f"{label:>10} {startup * 1000:7.0f} ms {percentile(times, 50) * 1000:7.0f} ms"
+              f" {percentile(times, 95) * 1000:7.0f} ms {serial / percentile(times, 50):12.2f}x")
+
+
+def _memory_kb(pid):
+    """Rss och Pss (delat minne fördelat på processerna som delar det) från /proc."""
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            name, _, rest = line.partition(":")
+            if name in ("Rss", "Pss"):
+                values[name] = int(rest.split()[0])
+    return values
+
+
+def _post_xml(url, xml_bytes):
+    import urllib.request
+    import uuid
+
+    boundary = uuid.uuid4().hex
+    body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"xml\"; filename=\"input.xml\"\r\n"
+            f"Content-Type: text/xml\r\n\r\n").encode() + xml_bytes + f"\r\n--{boundary}--\r\n".encode()
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": f"multipart/form-data; boundary={boundary}"})
+    with urllib.request.urlopen(request) as response:
+        return response.read()
+
+
+def bench_prefork(args, tmpdir):
+    """
+    gunicorn (gunicorn.conf.py) med och utan förladdning: tid tills arbetarna
+    är redo och Rss/Pss per arbetare i vila och efter några genereringar per arbetare.
+    """
+    workers = 4
+    xml_path = args.xml or write_synthetic_xml(os.path.join(tmpdir, "input.xml"))
+    with open(xml_path, "rb") as f:
+        xml_bytes = f.read()
+
+    for preload in (True, False):
+        env = dict(os.environ, RFQ_LOG_LEVEL="WARNING", RFQ_PAGE_WORKERS="0", RFQ_PRELOAD="1" if preload else "0")
+        start = time.perf_counter()
+        server = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "-c", os.path.join(BASE_DIR, "gunicorn.conf.py"),
+             "--chdir", BASE_DIR, "-b", "127.0.0.1:0", "-w", str(workers), "app:app"],
+            stderr=subprocess.PIPE, text=True, env=env, cwd=tmpdir,
+        )
+        ready, port = [], None
+        while len(ready) < workers or port is None:
+            line = server.stderr.readline()
+            if not line:
+                print("FEL: servern avslutades")
+                sys.exit(1)
+            if match := re.search(r"Arbetare (\d+) redo efter ([\d.]+) ms", line):
+                ready.append((int(match.group(1)), float(match.group(2))))
+            elif match := re.search(r"Listening at: http://[\d.]+:(\d+)", line):
+                port = int(match.group(1))
+        all_ready = time.perf_counter() - start
+        pids = [pid for pid, _ in ready]
+        idle = [_memory_kb(pid) for pid in [server.pid] + pids]
+
+        for _ in range(workers * 2):
+            _post_xml(f"http://127.0.0.1:{port}/", xml_bytes)
+        busy = [_memory_kb(pid) for pid in [server.pid] + pids]
+        server.terminate()
+        server.wait()
+
+        label = "förladdad" if preload else "utan förladdning"
+        startups = [ms for _, ms in ready]
+        print(f"{label}: alla {workers} arbetare redo efter {all_ready * 1000:.0f} ms,"
+              f" per arbetare {min(startups):.0f}-{max(startups):.0f} ms efter fork")
+        for state, (master, *samples) in (("vila", idle), (f"efter {workers * 2} genereringar", busy)):
+            rss = sum(sample["Rss"] for sample in samples) / len(samples) / 1024
+            pss = sum(sample["Pss"] for sample in samples) / len(samples) / 1024
+            total = (master["Pss"] + sum(sample["Pss"] for sample in samples)) / 1024
+            print(f"  {state:20} per arbetare Rss {rss:6.1f} MB  Pss {pss:6.1f} MB;"
+                  f"  totalt Pss {total:6.1f} MB med huvudprocessen")
+
+BENCHMARKS = {
+    "inprocess": bench_inprocess,
+    "templates": bench_templates,
+    "extract": bench_extract,
+    "placeholders": bench_placeholders,
+    "rules": bench_rules,
+    "concurrency": bench_concurrency,
+    "incremental": bench_incremental,
+    "compose": bench_compose,
+    "batch": bench_batch,
+    "save": bench_save,
+    "pages": bench_pages,
+    "prefork": bench_prefork,
+    "runs": bench_runs,
+    "memo": bench_memo,
+    "grouping": bench_grouping,
+    "firstbyte": bench_firstbyte,
+    "plans": bench_plans,
+    "logging": bench_logging,
+    "suite": bench_suite,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prestandamätningar för RFQ-genereringen")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--xml", help="XML-fil att mäta på (annars syntetisk)")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--buildings", type=int, default=20, help="antal byggnader i syntetisk XML (extract)")
+    parser.add_argument("--clients", type=int, default=8, help="antal samtidiga uppladdningar (concurrency)")
+    parser.add_argument("--baseline", help="baslinjefil för suite (standard: benchmark_baseline.json)")
+    parser.add_argument("--save-baseline", action="store_true", help="spara resultatet som ny baslinje (suite)")
+    parser.add_argument("--threshold", type=float, default=0.25, help="tillåten försämring mot baslinjen (suite)")
+    parser.add_argument("--mode", choices=("twopass", "stream"), help=argparse.SUPPRESS)
+    parser.add_argument("--scenario", choices=sorted(SUITE_SCENARIOS), help=argparse.SUPPRESS)
+    parser.add_argument("--startup", choices=("preload", "lazy"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        BENCHMARKS[args.benchmark](args, tmpdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+gunicorn-inställningar för app.py; gunicorn läser filen automatiskt från
+arbetskatalogen:
+
+    gunicorn -w 4 app:app
+
+Huvudprocessen läser in app.py innan arbetarna forkas (preload_app): mallar,
+översättningstabell och kompilerade regex. when_ready kompilerar dessutom
+renderingsplanerna och fryser skräpsamlaren (gc.freeze) så att det inlästa
+tillståndet inte skrivs om i onödan; arbetarna delar det copy-on-write och är
+redo direkt. Med RFQ_PRELOAD=0 läser varje arbetare in app.py själv.
+
+En arbetare som inte blir klar inom `timeout` sekunder, t.ex. för att en
+klient slutat skicka mitt i en uppladdning, avslutas och ersätts av gunicorn.
+
+Jobb-API:t (/api/jobs) håller jobben i minnet per process; med flera arbetare
+kan en statusfråga hamna hos en annan arbetare än den som tog emot jobbet, så
+då stängs det av. Resultatcachen ligger på disk och delas.
+"""
+import ctypes
+import gc
+import os
+import time
+
+bind = os.environ.get("RFQ_BIND", "127.0.0.1:8000")
+timeout = int(os.environ.get("RFQ_WORKER_TIMEOUT", 120))
+# PagePool startar processer och trådar när app.py läses in; de går inte att dela med arbetarna
+preload_app = os.environ.get("RFQ_PRELOAD", "1") != "0" and not int(os.environ.get("RFQ_PAGE_WORKERS", 0))
+
+
+def _release_free_heap():
+    # Kompileringen av renderingsplaner kopierar och släpper hela mallar; glibc
+    # behåller det frigjorda minnet, som annars räknas till varje arbetare
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass  # Inte glibc
+
+
+def when_ready(server):
+    if not server.cfg.preload_app:
+        return
+    start = time.perf_counter()
+    from app import generator
+    generator.warm_up()
+    gc.collect()
+    gc.freeze()
+    _release_free_heap()
+    server.log.info("Renderingsplaner klara efter %.0f ms", (time.perf_counter() - start) * 1000)
+
+
+def pre_fork(server, worker):
+    worker.forked_at = time.perf_counter()
+
+
+def post_worker_init(worker):
+    if worker.cfg.workers > 1:
+        import app
+        app.disable_job_api()
+    worker.log.info("Arbetare %d redo efter %.1f ms", worker.pid, (time.perf_counter() - worker.forked_at) * 1000)
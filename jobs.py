@@ -0,0 +1,148 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from RFQ_GIT import RFQError, StageReport
+
+
+class QueueFullError(Exception):
+    """Kön är full; klienten bör försöka igen senare."""
+
+
+class JobQueue:
+    """
+    Lokal jobbkö för RFQ-genereringar (ingen extern broker). Jobben körs på en
+    begränsad trådpool; högst `workers + queue_depth` jobb får vara ofärdiga
+    samtidigt, därefter avvisas nya med QueueFullError. Färdiga dokument hålls
+    i minnet i `result_ttl` sekunder, efter första hämtningen bara `download_ttl`
+    sekunder till. Tillsammans får de ta högst `max_result_bytes`; blir det fler
+    släpps de äldsta dokumenten och jobben får status "expired". Utgångna jobb
+    rensas vid varje anrop. `generate(xml_bytes, report=...)` får en
+    StageReport per jobb; tiderna visas i jobbstatusen och läggs till `metrics`.
+    """
+
+    def __init__(self, generate, workers=2, queue_depth=8, result_ttl=3600, metrics=None,
+                 max_result_bytes=64 * 1024 * 1024, download_ttl=60):
+        self._generate = generate
+        self._metrics = metrics
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rfq-jobb")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.result_ttl = result_ttl
+        self.max_result_bytes = max_result_bytes
+        self.download_ttl = download_ttl
+        self._result_bytes = 0
+
+    def _unfinished(self):
+        return sum(1 for job in self._jobs.values() if job["status"] in ("queued", "running"))
+
+    def _purge_expired(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job["expires"] is not None and job["expires"] < now]
+        for job_id in expired:
+            self._release(self._jobs.pop(job_id))
+
+    def _release(self, job):
+        if job["document"] is not None:
+            self._result_bytes -= len(job["document"])
+            job["document"] = None
+
+    def _enforce_result_limit(self, keep):
+        """Släpper de äldsta färdiga dokumenten tills summan ryms (utom `keep`)."""
+        if self._result_bytes <= self.max_result_bytes:
+            return
+        retained = sorted((job for job in self._jobs.values()
+                           if job["document"] is not None and job is not keep),
+                          key=lambda job: job["finished"])
+        for job in retained:
+            if self._result_bytes <= self.max_result_bytes:
+                break
+            self._release(job)
+            job["status"] = "expired"
+
+    def submit(self, xml_bytes, filename=None):
+        with self._lock:
+            self._purge_expired()
+            if self._unfinished() >= self.workers + self.queue_depth:
+                raise QueueFullError(f"Kön är full ({self.workers + self.queue_depth} jobb pågår eller väntar).")
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {
+                "id": job_id,
+                "filename": filename,
+                "status": "queued",
+                "created": time.time(),
+                "started": None,
+                "finished": None,
+                "expires": None,
+                "error": None,
+                "timings": None,
+                "document": None,
+            }
+        self._executor.submit(self._run, job_id, xml_bytes)
+        return job_id
+
+    def _run(self, job_id, xml_bytes):
+        with self._lock:
+            job = self._jobs[job_id]
+            job["status"] = "running"
+            job["started"] = time.time()
+        report = StageReport()
+        try:
+            document = self._generate(xml_bytes, report=report).getvalue()
+            error = None
+        except RFQError as e:
+            document, error = None, {"stage": e.stage, "message": str(e)}
+        except Exception as e:
+            document, error = None, {"stage": "generate", "message": f"{type(e).__name__}: {e}"}
+        if self._metrics is not None:
+            self._metrics.add(report if error is None else None, failed=error is not None)
+        with self._lock:
+            job["document"] = document
+            job["error"] = error
+            job["timings"] = report.as_dict() if error is None else None
+            job["status"] = "done" if error is None else "failed"
+            job["finished"] = time.time()
+            job["expires"] = job["finished"] + self.result_ttl
+            if document is not None:
+                self._result_bytes += len(document)
+                self._enforce_result_limit(keep=job)
+
+    def status(self, job_id):
+        with self._lock:
+            self._purge_expired()
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            info = {k: v for k, v in job.items() if k != "document"}
+            if job["status"] == "queued":
+                info["queue_position"] = sum(
+                    1 for other in self._jobs.values()
+                    if other["status"] == "queued" and other["created"] <= job["created"]
+                )
+            return info
+
+    def document(self, job_id):
+        """Dokumentet för ett klart jobb (None annars); efter hämtning sparas det bara `download_ttl` s."""
+        with self._lock:
+            self._purge_expired()
+            job = self._jobs.get(job_id)
+            if job is None or job["document"] is None:
+                return None
+            job["expires"] = min(job["expires"], time.time() + self.download_ttl)
+            return job["document"]
+
+    def stats(self):
+        with self._lock:
+            self._purge_expired()
+            counts = {}
+            for job in self._jobs.values():
+                counts[job["status"]] = counts.get(job["status"], 0) + 1
+            return {"workers": self.workers, "queue_depth": self.queue_depth, "jobs": counts,
+                    "result_bytes": self._result_bytes, "max_result_bytes": self.max_result_bytes}
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)